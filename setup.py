@@ -4,6 +4,9 @@ with open("README.md", "r") as fh:
     long_description = fh.read()
 
 INSTALL_REQUIRES = []
+EXTRAS_REQUIRE = {
+    'numpy': ['numpy']  # array block conversion, tapscreen
+}
 setuptools.setup(
     name="zxtaputils",
     version="1.0.0",
@@ -15,6 +18,7 @@ setuptools.setup(
     url="https://github.com/weiju/zxtaputils",
     packages=['zxtaputils'],
     install_requires = INSTALL_REQUIRES,
+    extras_require = EXTRAS_REQUIRE,
     classifiers=[
         "Development Status :: 5 - Production/Stable",
         "Environment :: Console",
@@ -34,4 +38,7 @@ setuptools.setup(
     keywords=[
         "sinclair", "zx", "spectrum", "tap", "development"
     ],
-    scripts=['bin/bas2tap', 'bin/tapextract', 'bin/tapify', 'bin/tapinfo', 'bin/tapsplit', 'bin/tap2bas'])
+    scripts=['bin/bas2tap', 'bin/tapextract', 'bin/tapify', 'bin/tapinfo', 'bin/tapsplit', 'bin/tap2bas',
+             'bin/tapnumcheck', 'bin/basxref',
+             'bin/tapscreen', 'bin/tapdis', 'bin/taprepair', 'bin/tapdiff', 'bin/tapbuild',
+             'bin/tapedit', 'bin/dskextract'])
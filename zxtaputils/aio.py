@@ -0,0 +1,121 @@
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .tapinfo import next_tap_block
+from .bas2asc import detokenize_bytes, detokenize_range, MAX_LINE_NUMBER
+from .archive import open_input
+
+"""
+aio.py - Read TAP files and detokenize programs from asyncio code
+
+    async for block in aiter_blocks('game.tap'):
+        ...
+    listing = await detokenize_async(prog_bytes)
+
+File I/O runs in a thread pool, detokenizing in a process pool, both are shared by
+all calls and bounded, so the event loop is never blocked and many files can be
+read at the same time:
+
+  - aiter_blocks() reads batches of blocks in the thread pool and asks for the
+    next batch while the current one is consumed, at most one batch is read ahead
+    of the consumer (backpressure)
+  - breaking out of the loop or cancelling the task stops reading, the file is
+    closed after the running batch is done
+  - detokenize_async() can be cancelled while it waits for a worker, a program that
+    is already being detokenized is finished by the worker
+
+Pass executor= to use other executors, e.g. a ThreadPoolExecutor for
+detokenize_async() when the programs are small.
+
+Needs Python 3.7 (asyncio.get_running_loop()), before 3.9 shutdown() can't cancel
+the calls that are still queued and waits for them.
+"""
+
+BATCH_SIZE = 64  # blocks read by one call in the thread pool
+MAX_IO_THREADS = min(32, (os.cpu_count() or 1) + 4)
+MAX_PROCESSES = os.cpu_count() or 1
+
+_io_executor = None
+_cpu_executor = None
+
+
+def io_executor():
+    global _io_executor
+    if _io_executor is None:
+        _io_executor = ThreadPoolExecutor(max_workers=MAX_IO_THREADS, thread_name_prefix='zxtaputils-io')
+    return _io_executor
+
+
+def cpu_executor():
+    global _cpu_executor
+    if _cpu_executor is None:
+        _cpu_executor = ProcessPoolExecutor(max_workers=MAX_PROCESSES)
+    return _cpu_executor
+
+
+def shutdown():
+    """stop the shared executors, e.g. when the service shuts down"""
+    global _io_executor, _cpu_executor
+    for executor in (_io_executor, _cpu_executor):
+        if executor is None:
+            continue
+        if sys.version_info >= (3, 9):
+            executor.shutdown(wait=True, cancel_futures=True)
+        else:
+            executor.shutdown(wait=True)
+    _io_executor = _cpu_executor = None
+
+
+def read_batch(infile, size):
+    """up to size blocks, fewer at the end of the file"""
+    blocks = []
+    while len(blocks) < size:
+        block = next_tap_block(infile)
+        if block is None:
+            break
+        blocks.append(block)
+    return blocks
+
+
+async def aiter_blocks(path, executor=None, batch_size=BATCH_SIZE):
+    """iterate over the blocks of a TAP file (ZXHeader or ZXData like
+    tapinfo.next_tap_block()), path can also be an archive member"""
+    loop = asyncio.get_running_loop()
+    executor = executor if executor is not None else io_executor()
+    infile = await loop.run_in_executor(executor, open_input, path)
+    pending = None  # the concurrent.futures.Future of the batch that is read ahead
+    try:
+        pending = executor.submit(read_batch, infile, batch_size)
+        while pending is not None:
+            blocks = await asyncio.wrap_future(pending)
+            pending = None
+            if len(blocks) == batch_size:
+                pending = executor.submit(read_batch, infile, batch_size)
+            for block in blocks:
+                yield block
+    finally:
+        if pending is not None:
+            # a running batch can't be interrupted, let it finish before closing the file
+            pending.cancel()
+            await asyncio.wait([asyncio.wrap_future(pending)])
+        await loop.run_in_executor(executor, infile.close)
+
+
+def listing(data_bytes, show_numbers=False, first=None, last=None):
+    """the detokenized program as a string"""
+    outfile = io.StringIO()
+    if first is None and last is None:
+        detokenize_bytes(data_bytes, outfile, show_numbers)
+    else:
+        last = last if last is not None else MAX_LINE_NUMBER
+        detokenize_range(data_bytes, first or 0, last, outfile, show_numbers)
+    return outfile.getvalue()
+
+
+async def detokenize_async(data_bytes, show_numbers=False, first=None, last=None, executor=None):
+    """the listing of the program bytes, detokenized in a worker process"""
+    loop = asyncio.get_running_loop()
+    executor = executor if executor is not None else cpu_executor()
+    return await loop.run_in_executor(executor, listing, bytes(data_bytes), show_numbers, first, last)
@@ -0,0 +1,92 @@
+import zipfile
+from collections import OrderedDict
+
+"""
+archive.py - Read TAP files directly from ZIP archives
+
+Input paths of the TAP reading tools can be:
+
+  - a plain file
+  - archive.zip!inner.tap: the member inner.tap of archive.zip
+  - archive.zip: tools that process several files read all TAP members, the
+    others the only TAP member of the archive
+
+Members are streamed with zipfile, nothing is extracted to disk. Open archives
+are kept in a small cache, so reading many members of one archive opens and
+parses its directory once.
+"""
+
+ARCHIVE_SEPARATOR = '!'
+TAP_EXTENSIONS = ('.tap',)
+MAX_OPEN_ARCHIVES = 16
+
+_open_archives = OrderedDict()  # path -> ZipFile, least recently used first
+
+
+def is_archive(path):
+    return path.lower().endswith('.zip')
+
+
+def split_path(path):
+    """returns (archive path, member name) for archive.zip!member, (path, None) otherwise"""
+    pos = path.lower().find('.zip' + ARCHIVE_SEPARATOR)
+    if pos < 0:
+        return path, None
+    return path[:pos + 4], path[pos + 5:]
+
+
+def open_archive(path):
+    """the ZipFile for path, from the cache if it is already open"""
+    archive = _open_archives.get(path)
+    if archive is not None:
+        _open_archives.move_to_end(path)
+        return archive
+    archive = zipfile.ZipFile(path)
+    _open_archives[path] = archive
+    if len(_open_archives) > MAX_OPEN_ARCHIVES:
+        _, oldest = _open_archives.popitem(last=False)
+        oldest.close()
+    return archive
+
+
+def close_archives():
+    while _open_archives:
+        _, archive = _open_archives.popitem()
+        archive.close()
+
+
+def tap_members(archive):
+    return [info.filename for info in archive.infolist()
+            if not info.is_dir() and info.filename.lower().endswith(TAP_EXTENSIONS)]
+
+
+def open_input(path):
+    """open a TAP file for reading, which can also be an archive member"""
+    archive_path, member = split_path(path)
+    if member is None and not is_archive(path):
+        return open(path, 'rb')
+    archive = open_archive(archive_path)
+    if member is None:
+        members = tap_members(archive)
+        if len(members) != 1:
+            raise ValueError("'%s' contains %d TAP files, specify one with %s%sNAME" %
+                             (path, len(members), path, ARCHIVE_SEPARATOR))
+        member = members[0]
+    return archive.open(member)
+
+
+def expand_paths(paths):
+    """replace archives by their TAP members"""
+    for path in paths:
+        if is_archive(path):
+            for member in tap_members(open_archive(path)):
+                yield path + ARCHIVE_SEPARATOR + member
+        else:
+            yield path
+
+
+def input_files(paths):
+    """iterate over all inputs, archives expanded, yields (path, open file)"""
+    for path in expand_paths(paths):
+        with open_input(path) as infile:
+            yield path, infile
@@ -0,0 +1,188 @@
+import csv
+import numpy as np
+from .util import BT_NUM_ARRAY, BT_CHAR_ARRAY
+
+"""
+arraycodec.py - Convert the contents of array blocks (SAVE ... DATA) from and to NumPy arrays
+
+The data block of a saved array has the same layout as the array in the
+variables area, minus the name byte and the 2 byte length word:
+
+  - 1 byte number of dimensions (n)
+  - n * 2 bytes dimension sizes (little endian)
+  - the elements, last subscript varying fastest:
+    - number arrays: 5 bytes per element in Spectrum floating point format
+    - character arrays: 1 byte per element
+
+A number is either stored as
+
+  - a small integer (-65535 to 65535):
+    0x00, sign byte (0x00 or 0xff), low byte, high byte, 0x00
+    (negative numbers are stored as n + 65536)
+
+  - a floating point number:
+    exponent + 128, 4 bytes mantissa (big endian), where the top bit of the
+    mantissa is replaced by the sign bit
+
+All conversions work on whole arrays at once, so even large tables
+are converted at NumPy speed.
+"""
+
+NUM_BYTES = 5
+
+
+def decode_numbers(data_bytes):
+    """decode a buffer of 5 byte Spectrum numbers into a float64 array"""
+    raw = np.frombuffer(data_bytes, dtype=np.uint8).reshape(-1, NUM_BYTES)
+    exponent = raw[:, 0].astype(np.int64)
+    sign = raw[:, 1] >= 0x80
+
+    # floating point form: restore the implicit top bit of the mantissa
+    mantissa = (((raw[:, 1] | 0x80).astype(np.uint32) << 24) | (raw[:, 2].astype(np.uint32) << 16) |
+                (raw[:, 3].astype(np.uint32) << 8) | raw[:, 4].astype(np.uint32))
+    floats = np.ldexp(mantissa.astype(np.float64), exponent - 128 - 32)
+    floats = np.where(sign, -floats, floats)
+
+    # small integer form
+    ints = raw[:, 2].astype(np.int64) | (raw[:, 3].astype(np.int64) << 8)
+    ints = np.where(raw[:, 1] == 0xff, ints - 65536, ints)
+    return np.where(exponent == 0, ints.astype(np.float64), floats)
+
+
+def encode_numbers(values):
+    """encode a sequence of numbers into the 5 byte Spectrum format, returns a bytes object"""
+    values = np.asarray(values, dtype=np.float64).ravel()
+    if not np.all(np.isfinite(values)):
+        raise ValueError("can not encode NaN or infinite values")
+    out = np.zeros((len(values), NUM_BYTES), dtype=np.uint8)
+
+    is_int = (values == np.rint(values)) & (np.abs(values) <= 65535)
+    small = values[is_int].astype(np.int64)
+    out[is_int, 1] = np.where(small < 0, 0xff, 0x00)
+    out[is_int, 2] = small & 0xff
+    out[is_int, 3] = (small >> 8) & 0xff
+
+    is_float = ~is_int
+    fraction, exponent = np.frexp(np.abs(values[is_float]))  # fraction is in [0.5, 1)
+    mantissa = np.rint(np.ldexp(fraction, 32)).astype(np.uint64)
+    overflow = mantissa == (1 << 32)  # rounding carried into the next power of 2
+    mantissa[overflow] = 1 << 31
+    exponent = exponent.astype(np.int64) + overflow + 128
+    if np.any(exponent > 0xff):
+        raise OverflowError("number too big for the Spectrum floating point format")
+    underflow = exponent < 1  # the ROM turns these into zero
+    exponent[underflow] = 0
+    mantissa = (mantissa & 0x7fffffff) | ((values[is_float] < 0).astype(np.uint64) << np.uint64(31))
+    mantissa[underflow] = 0
+    float_bytes = np.stack([exponent.astype(np.uint64), mantissa >> np.uint64(24),
+                            mantissa >> np.uint64(16), mantissa >> np.uint64(8), mantissa], axis=1)
+    out[is_float] = (float_bytes & np.uint64(0xff)).astype(np.uint8)
+    return out.tobytes()
+
+
+def read_dimensions(data_bytes):
+    """returns the dimensions of the array and the offset of the first element"""
+    num_dims = data_bytes[0]
+    dims = np.frombuffer(data_bytes, dtype='<u2', count=num_dims, offset=1)
+    return tuple(int(d) for d in dims), 1 + num_dims * 2
+
+
+def dimension_bytes(shape):
+    if len(shape) == 0 or len(shape) > 255:
+        raise ValueError("arrays must have between 1 and 255 dimensions")
+    if any(d < 1 or d > 65535 for d in shape):
+        raise ValueError("array dimensions must be between 1 and 65535")
+    return bytes([len(shape)]) + np.asarray(shape, dtype='<u2').tobytes()
+
+
+def decode_num_array(data_bytes):
+    """decode the data of a BT_NUM_ARRAY block into a float64 array of the saved dimensions"""
+    dims, offset = read_dimensions(data_bytes)
+    count = int(np.prod(dims))
+    values = decode_numbers(data_bytes[offset:offset + count * NUM_BYTES])
+    return values.reshape(dims)
+
+
+def encode_num_array(arr):
+    """encode a numeric array into the data of a BT_NUM_ARRAY block"""
+    arr = np.asarray(arr, dtype=np.float64)
+    if arr.ndim == 0:
+        arr = arr.reshape(1)
+    return dimension_bytes(arr.shape) + encode_numbers(arr)
+
+
+def decode_char_array(data_bytes):
+    """decode the data of a BT_CHAR_ARRAY block into a uint8 array of the saved dimensions"""
+    dims, offset = read_dimensions(data_bytes)
+    count = int(np.prod(dims))
+    return np.frombuffer(data_bytes, dtype=np.uint8, count=count, offset=offset).reshape(dims)
+
+
+def encode_char_array(arr):
+    """encode a byte array into the data of a BT_CHAR_ARRAY block"""
+    arr = np.asarray(arr, dtype=np.uint8)
+    if arr.ndim == 0:
+        arr = arr.reshape(1)
+    return dimension_bytes(arr.shape) + arr.tobytes()
+
+
+def decode_array(block_type, data_bytes):
+    if block_type == BT_NUM_ARRAY:
+        return decode_num_array(data_bytes)
+    elif block_type == BT_CHAR_ARRAY:
+        return decode_char_array(data_bytes)
+    raise ValueError("not an array block")
+
+
+def encode_array(block_type, arr):
+    if block_type == BT_NUM_ARRAY:
+        return encode_num_array(arr)
+    elif block_type == BT_CHAR_ARRAY:
+        return encode_char_array(arr)
+    raise ValueError("not an array block")
+
+
+def strings_to_char_array(strings):
+    """turn a list of strings into a 2 dimensional character array, padded with spaces
+    like DIM a$(n, len) does"""
+    width = max([len(s) for s in strings] + [1])
+    rows = [s.ljust(width).encode('latin-1') for s in strings]
+    return np.frombuffer(b''.join(rows), dtype=np.uint8).reshape(len(rows), width)
+
+
+def read_csv(path, block_type):
+    """Read an array from a CSV file. For number arrays, every row is a row of the
+    array, a single row or column results in a 1 dimensional array.
+    For character arrays, every row is one string (columns are joined with ',')"""
+    with open(path, newline='') as infile:
+        rows = [row for row in csv.reader(infile) if len(row) > 0]
+    if len(rows) == 0:
+        raise ValueError("'%s' has no rows" % path)
+    if block_type == BT_CHAR_ARRAY:
+        return strings_to_char_array([','.join(row) for row in rows])
+    for num, row in enumerate(rows):
+        if len(row) != len(rows[0]):
+            raise ValueError("'%s' row %d has %d values, the first row has %d" %
+                             (path, num + 1, len(row), len(rows[0])))
+    try:
+        arr = np.array([[float(cell) for cell in row] for row in rows], dtype=np.float64)
+    except ValueError as error:
+        raise ValueError("'%s': %s" % (path, error))
+    if arr.shape[0] == 1 or arr.shape[1] == 1:
+        arr = arr.ravel()
+    return arr
+
+
+def write_csv(arr, path, block_type):
+    """Write an array to a CSV file, arrays with more than 2 dimensions are flattened
+    into rows of the last dimension"""
+    with open(path, 'w', newline='') as outfile:
+        writer = csv.writer(outfile)
+        if block_type == BT_CHAR_ARRAY:
+            rows = arr.reshape(-1, arr.shape[-1])
+            for row in rows:
+                writer.writerow([row.tobytes().decode('latin-1').rstrip()])
+        else:
+            rows = arr.reshape(1, -1) if arr.ndim == 1 else arr.reshape(-1, arr.shape[-1])
+            for row in rows:
+                writer.writerow(['%.10g' % value for value in row])
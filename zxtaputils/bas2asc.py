@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 
+import math
+import re
 import struct
 import traceback
+from array import array
+from bisect import bisect_left, bisect_right
 from .basic_tokens import REV_TOKENS
-from .util import BLOCK_TYPES, BT_PROGRAM, BT_NUM_ARRAY, BT_CHAR_ARRAY, BT_BINARY, compute_checksum
+from .util import BLOCK_TYPES, BT_PROGRAM, BT_NUM_ARRAY, BT_CHAR_ARRAY, BT_BINARY, compute_checksum, TapFormatError
 
 """
 bas2asc.py - Turn tokenized ZX Spectrum BASIC file into an ASCII source
@@ -20,7 +24,8 @@ Additional rules:
 
   - numbers are encoded in a funny format:
     - first the characters of the number, followed by code 0x0e, the "number marker",
-      followed by 5 bytes float representation (we can skip that)
+      followed by 5 bytes float representation (the value the interpreter actually uses,
+      it does not have to match the characters)
 
   - for longer files, there will be additional code appended to the program
 """
@@ -31,16 +36,92 @@ def is_token(b):
 def is_number(b):
     return b == 0x0e
 
-def detokenize_statement(line_bytes, pos, outline):
+NUMBER_LENGTH = 5
+BIN_TOKEN = 0xc4
+
+# the characters of a number literal, matched at the end of the text before a number marker
+NUMBER_TEXT = re.compile(rb'(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?$')
+BIN_TEXT = re.compile(rb'\xc4 *([01]*)$')
+
+
+def number_value(exponent, mantissa):
+    """the value of a number in the 5 byte format, given the exponent byte and the
+    4 mantissa bytes as big endian integer"""
+    if exponent == 0:  # small integer: sign byte, low byte, high byte, 0
+        value = ((mantissa >> 16) & 0xff) | (mantissa & 0xff00)
+        if (mantissa >> 24) == 0xff:
+            value -= 65536
+        return value
+    value = math.ldexp(mantissa | 0x80000000, exponent - 128 - 32)
+    return -value if mantissa & 0x80000000 else value
+
+
+def decode_numbers(number_bytes):
+    """decode a buffer of consecutive 5 byte numbers in one batch"""
+    return [number_value(e, m) for e, m in struct.iter_unpack('>BL', number_bytes)]
+
+
+def number_text(line_bytes, marker_pos, start=0):
+    """returns the characters of the number literal that ends at the number marker
+    at marker_pos, and whether it is a BIN literal. start limits the search to the
+    part of the line after the previous number"""
+    window = line_bytes[max(start, marker_pos - 64):marker_pos]
+    match = BIN_TEXT.search(window)
+    if match is not None:
+        return match.group(1).decode('ascii'), True
+    match = NUMBER_TEXT.search(window)
+    if match is None:
+        return None, False
+    return match.group(0).decode('ascii'), False
+
+
+def is_placeholder(line_bytes, marker_pos):
+    """the ROM stores every parameter of DEF FN a(x)=... as the name, a number marker
+    and 5 bytes for the argument, there are no characters of a number in front of them"""
+    if marker_pos == 0:
+        return False
+    b = line_bytes[marker_pos - 1]
+    return (0x41 <= b <= 0x5a) or (0x61 <= b <= 0x7a) or b == ord('$')
+
+
+def text_value(text, is_bin):
+    """the value of a number literal's characters, None if it can not be read"""
+    try:
+        if is_bin:
+            return int(text, 2) if len(text) > 0 else 0
+        return float(text)
+    except ValueError:
+        return None
+
+
+def numbers_match(text_val, binary_val):
+    """the ROM's decimal conversion is not exact, allow for a difference in the last
+    bits of the 32 bit mantissa"""
+    return abs(text_val - binary_val) <= abs(text_val) * 2.0 ** -30
+
+
+def format_number(value):
+    if value == int(value) and abs(value) < 1e10:
+        return '%d' % value
+    return '%.10g' % value
+
+
+def detokenize_statement(line_bytes, pos, outline, show_numbers=False):
+    text_start = pos  # the characters of a number start after the previous number or string
     while pos < len(line_bytes):
         b = line_bytes[pos]
         if is_token(b):
             outline = outline + ' ' + REV_TOKENS[b] + ' '
             pos = pos + 1
         elif is_number(b):
+            if show_numbers:
+                outline += true_value_str(line_bytes, pos, text_start)
             pos = pos + 6  # skip the float representation
+            text_start = pos
         else:
             c = chr(b)
+            if c == '"':
+                text_start = pos + 1
 
             if c == '\r':  # carriage return -> LF
                 c = '\n'
@@ -49,14 +130,28 @@ def detokenize_statement(line_bytes, pos, outline):
     return pos, outline
 
 
-def detokenize_line(line_bytes, line_number):
+def true_value_str(line_bytes, marker_pos, start=0):
+    """an annotation with the binary value of the number at marker_pos if it differs
+    from its characters, start is the end of the previous number or string"""
+    number_bytes = line_bytes[marker_pos + 1:marker_pos + 1 + NUMBER_LENGTH]
+    if len(number_bytes) < NUMBER_LENGTH or is_placeholder(line_bytes, marker_pos):
+        return ''
+    binary_val = decode_numbers(number_bytes)[0]
+    text, is_bin = number_text(line_bytes, marker_pos, start)
+    text_val = text_value(text, is_bin) if text is not None else None
+    if text_val is not None and numbers_match(text_val, binary_val):
+        return ''
+    return '[=%s]' % format_number(binary_val)
+
+
+def detokenize_line(line_bytes, line_number, show_numbers=False):
     # read the token, it's one byte
     outline = '%d' % line_number
     end_pos = len(line_bytes)
 
     pos = 0
     while pos < end_pos:
-        pos, outline = detokenize_statement(line_bytes, pos, outline)
+        pos, outline = detokenize_statement(line_bytes, pos, outline, show_numbers)
     return outline
 
 
@@ -173,6 +268,20 @@ def plus3dos_info(infile):
     return autostart, progoffset
 
 
+PLUS3DOS_HEADER_LENGTH = 128
+
+
+def plus3dos_header_from_bytes(data_bytes):
+    """Make a Plus3DOSHeader from the first 128 bytes of a file, None if the file
+    does not start with a valid header"""
+    if len(data_bytes) < PLUS3DOS_HEADER_LENGTH or data_bytes[:8] != b'PLUS3DOS' or \
+       compute_checksum2(data_bytes[:PLUS3DOS_HEADER_LENGTH - 1]) != data_bytes[PLUS3DOS_HEADER_LENGTH - 1]:
+        return None
+    filelen = struct.unpack_from('<L', data_bytes, 11)[0]
+    block_type, inner_file_len, param1, param2 = struct.unpack_from('<BHHH', data_bytes, 15)
+    return Plus3DOSHeader(filelen, block_type, inner_file_len, [param1, param2])
+
+
 def detokenize_file(infile, autostart, progoffset, outfile=None):
     outline = ''
     try:
@@ -187,14 +296,14 @@ def detokenize_file(infile, autostart, progoffset, outfile=None):
         traceback.print_exc()
 
 
-def detokenize_bytes(data_bytes, outfile=None):
+def detokenize_bytes(data_bytes, outfile=None, show_numbers=False):
     offset = 0
     while offset < len(data_bytes):
         line_number = struct.unpack_from(">H", data_bytes, offset)[0]  # Big endian
         num_line_bytes = struct.unpack_from("<H", data_bytes, offset + 2)[0]
         start = offset + 4
         line_bytes = data_bytes[start:start+num_line_bytes]
-        outline = detokenize_line(line_bytes, line_number)
+        outline = detokenize_line(line_bytes, line_number, show_numbers)
         if outfile is None:
             print(outline, end="")
         else:
@@ -202,7 +311,134 @@ def detokenize_bytes(data_bytes, outfile=None):
         offset += num_line_bytes + 4
 
 
+# LIST only goes up to 9999, but the interpreter runs lines up to 16383 (a protection
+# trick), the top two bits of the first byte are set for variables
+MAX_LINE_NUMBER = 0x3fff
+
+
+def line_index(data_bytes):
+    """Build the line index of a tokenized program in one pass over the 4 byte line
+    headers, without looking at the line contents. Returns two arrays: the line numbers
+    and the offsets of their headers. The index ends at the first line number that is
+    out of range, e.g. because the variables follow the program"""
+    line_numbers = array('H')
+    offsets = array('L')
+    offset = 0
+    end = len(data_bytes)
+    unpack_from = struct.unpack_from
+    while offset + 4 <= end:
+        line_number = unpack_from(">H", data_bytes, offset)[0]  # Big endian
+        if line_number > MAX_LINE_NUMBER:
+            break
+        line_numbers.append(line_number)
+        offsets.append(offset)
+        offset += unpack_from("<H", data_bytes, offset + 2)[0] + 4
+    return line_numbers, offsets
+
+
+class BasicProgram:
+    """A tokenized program with a line index, so single lines or ranges of lines can
+    be detokenized without processing the whole program"""
+
+    def __init__(self, data_bytes):
+        self.data_bytes = data_bytes
+        self.line_numbers, self.offsets = line_index(data_bytes)
+
+    def __len__(self):
+        return len(self.line_numbers)
+
+    def __contains__(self, line_number):
+        i = bisect_left(self.line_numbers, line_number)
+        return i < len(self.line_numbers) and self.line_numbers[i] == line_number
+
+    def line_bytes(self, i):
+        """the tokenized contents of the i-th line"""
+        offset = self.offsets[i]
+        num_line_bytes = struct.unpack_from("<H", self.data_bytes, offset + 2)[0]
+        return self.data_bytes[offset + 4:offset + 4 + num_line_bytes]
+
+    def line(self, line_number, show_numbers=False):
+        """the detokenized line with the specified number, raises KeyError if it does not exist"""
+        i = bisect_left(self.line_numbers, line_number)
+        if i == len(self.line_numbers) or self.line_numbers[i] != line_number:
+            raise KeyError(line_number)
+        return detokenize_line(self.line_bytes(i), line_number, show_numbers)
+
+    def next_line_number(self, line_number):
+        """the number of the line the interpreter executes for GO TO line_number
+        (the first line >= line_number), None if there is none"""
+        i = bisect_left(self.line_numbers, line_number)
+        return self.line_numbers[i] if i < len(self.line_numbers) else None
+
+    def lines(self, first=0, last=MAX_LINE_NUMBER, show_numbers=False):
+        """generates the detokenized lines first to last (inclusive)"""
+        start = bisect_left(self.line_numbers, first)
+        stop = bisect_right(self.line_numbers, last)
+        for i in range(start, stop):
+            yield detokenize_line(self.line_bytes(i), self.line_numbers[i], show_numbers)
+
+
+def parse_line_range(spec):
+    """parse a line range of the form 'A-B', 'A-', '-B' or 'A'"""
+    if '-' in spec:
+        first, last = spec.split('-', 1)
+        first = int(first) if first else 0
+        last = int(last) if last else MAX_LINE_NUMBER
+    else:
+        first = last = int(spec)
+    return first, last
+
+
+def detokenize_range(data_bytes, first, last, outfile=None, show_numbers=False):
+    """detokenize only the lines first to last (inclusive)"""
+    for outline in BasicProgram(data_bytes).lines(first, last, show_numbers):
+        if outfile is None:
+            print(outline, end="")
+        else:
+            outfile.write(outline)
+
+
+def bas2asc_strict(args):
+    """like bas2asc(), but the file is read with the size limit of strict mode and the
+    whole program is checked before anything is listed"""
+    from .strict import read_limited, strict_listing
+    with open(args.infile, 'rb') as infile:
+        buf = read_limited(infile)
+    if buf[:8] == b'PLUS3DOS':
+        header = plus3dos_header_from_bytes(buf)
+        if header is None:
+            raise TapFormatError("invalid +3DOS header", 0)
+        if header.block_type != BT_PROGRAM:
+            raise TapFormatError("+3DOS file is not a program", 0)
+        print(header)
+        buf = buf[PLUS3DOS_HEADER_LENGTH:]
+        prog_bytes = buf[:header.params[1]]  # without the variables
+    else:
+        prog_bytes = buf  # assume, we just have plain tokenized Spectrum BASIC
+
+    if args.outformat == 'source':
+        first, last = parse_line_range(args.lines) if args.lines is not None else (0, MAX_LINE_NUMBER)
+        listing = strict_listing(prog_bytes, show_numbers=args.numbers, first=first, last=last)
+        if args.outfile is not None:
+            with open(args.outfile, 'w') as outfile:
+                outfile.write(listing)
+        else:
+            print("\nBASIC source code:")
+            print("-------------------")
+            print(listing, end="")
+    else:
+        if args.outfile is not None:
+            with open(args.outfile, 'wb') as outfile:
+                outfile.write(buf)
+        else:
+            print("you need to specify an output file for writing tokens")
+    print('\nDone')
+
+
 def bas2asc(args):
+    if getattr(args, 'strict', False):
+        bas2asc_strict(args)
+        return
     with open(args.infile, 'rb') as infile:
         # first see if we have an PLUS3DOS header
         try:
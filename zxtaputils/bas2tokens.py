@@ -6,6 +6,7 @@ from .basic_tokens import TOKENS, REV_TOKENS
 from .tapinfo import ZXHeader, ZXData
 from .bas2asc import Plus3DOSHeader
 from .util import BT_PROGRAM
+from .snapshot import Snapshot, write_snapshot
 from math import log2
 import sys
 
@@ -205,13 +206,13 @@ def next_token(line, current_tokens):
         c = line[i]
 
         # handle strings
-        if c in ['"', '(', ')', ',', '='] and i > 0 and not in_string:  # handle as separate tokens
+        if c in ['"', '(', ')', ',', '=', ':', ';'] and i > 0 and not in_string:  # handle as separate tokens
             break
         elif c == '"' and i == 0:
             in_string = True
         elif c == '"' and in_string:  # end the string
             in_string = False
-        elif c in ['(', ')', ',', '='] and i == 0:
+        elif c in ['(', ')', ',', '=', ':', ';'] and i == 0:
             i = i + 1
             token = c
             break
@@ -228,13 +229,47 @@ def next_token(line, current_tokens):
         token = convert_token(token, current_tokens)
     return token, line[i:]
 
+def token_text(token):
+    if isinstance(token, BasicKeyword):
+        return REV_TOKENS[token.value]
+    if isinstance(token, BasicSyntaxChars):
+        return token.value
+    return None
+
+
+STATEMENT_STARTS = (':', 'THEN')
+
+
+def merge_keywords(tokens):
+    """keywords that contain a space (GO TO, GO SUB, DEF FN, OPEN #, CLOSE #) were split
+    by next_token(), join them into a single keyword. They are all statements, so only
+    words at the start of a statement are joined, GO in FOR i=GO TO 10 is a variable"""
+    result = []
+    for token in tokens:
+        prev = None
+        if len(result) == 2 or (len(result) > 2 and token_text(result[-2]) in STATEMENT_STARTS):
+            prev = token_text(result[-1])
+        text = token_text(token)
+        if prev is not None and text is not None:
+            if prev + ' ' + text in TOKENS:
+                result[-1] = BasicKeyword(TOKENS[prev + ' ' + text])
+                continue
+            if text.startswith('#') and prev + ' #' in TOKENS:  # e.g. OPEN #4
+                result[-1] = BasicKeyword(TOKENS[prev + ' #'])
+                if len(text) > 1:
+                    result.append(convert_token(text[1:], result))
+                continue
+        result.append(token)
+    return result
+
+
 def tokenize_line(line):
     result = []
     while len(line) > 0:  # ignore empty lines
         token, line = next_token(line, result)
         if token is not None:
             result.append(token)
-    return result
+    return merge_keywords(result)
 
 
 def render_line(tokenized):
@@ -251,24 +286,33 @@ def render_line(tokenized):
     return outbytes
 
 
-def bas2token_bytes(infile):
+def bas2token_lines(infile):
     """Reads the BASIC source code from the specified input file and
-    returns a bytes object that contains the entire program"""
-    result = None
+    returns the list of tokenized lines"""
+    result = []
     while True:
         line = infile.readline()
         if not line or len(line) == 0:
             break
         tokenized = tokenize_line(line)
         if len(tokenized) > 0:
-            outbytes = render_line(tokenized)
-            if result is None:
-                result = outbytes
-            else:
-                result += outbytes
+            result.append(tokenized)
     return result
 
 
+def render_lines(lines):
+    """the bytes of the entire program, None if there are no lines"""
+    if len(lines) == 0:
+        return None
+    return b''.join(render_line(tokenized) for tokenized in lines)
+
+
+def bas2token_bytes(infile):
+    """Reads the BASIC source code from the specified input file and
+    returns a bytes object that contains the entire program"""
+    return render_lines(bas2token_lines(infile))
+
+
 def mantissa_int_part(n):
     """convert the integral part of a decimal number to mantissa digits"""
     result = []
@@ -335,11 +379,19 @@ def make_float(n, num_bits=32, bias=128):
 
 
 def bas2tap(args):
+    autostart = args.autostart
     with open(args.infile) as infile:
-        outbytes = bas2token_bytes(infile)
+        if args.optimize:
+            from .basopt import optimize
+            optimization = optimize(bas2token_lines(infile), autostart)
+            print(optimization)
+            outbytes = render_lines(optimization.lines)
+            autostart = optimization.autostart
+        else:
+            outbytes = bas2token_bytes(infile)
 
     if args.format == 'tap':
-        zxheader = ZXHeader(BT_PROGRAM, "", len(outbytes), [args.autostart, len(outbytes)])
+        zxheader = ZXHeader(BT_PROGRAM, "", len(outbytes), [autostart, len(outbytes)])
         zxdata = ZXData(outbytes)
         header_bytes = zxheader.bytes()
         dblock_bytes = zxdata.bytes()
@@ -351,6 +403,14 @@ def bas2tap(args):
             # write the data block (2 + |data_bytes| | + 2 bytes)
             outfile.write(struct.pack('<H', len(dblock_bytes)))  # size word
             outfile.write(dblock_bytes)
+    elif args.format == 'tzx':
+        # imported here, tzx uses the tokenizer for its loader program
+        from .tzx import standard_tzx
+        zxheader = ZXHeader(BT_PROGRAM, "", len(outbytes), [autostart, len(outbytes)])
+        with open(args.outfile, "wb") as outfile:
+            outfile.write(standard_tzx([zxheader.bytes(), ZXData(outbytes).bytes()]))
+    elif args.format in ('sna', 'z80'):
+        write_snapshot(args.outfile, Snapshot(outbytes, autostart), args.format)
     elif args.format == 'plain':
         with open(args.outfile, "wb") as outfile:
             outfile.write(outbytes)
@@ -359,7 +419,7 @@ def bas2tap(args):
         with open(args.outfile, "wb") as outfile:
             inner_file_len = len(outbytes)
             file_len = len(outbytes) + 128
-            header = Plus3DOSHeader(file_len, BT_PROGRAM, inner_file_len, [args.autostart, inner_file_len])
+            header = Plus3DOSHeader(file_len, BT_PROGRAM, inner_file_len, [autostart, inner_file_len])
             header.write(outfile)
             outfile.write(outbytes)
 
@@ -0,0 +1,319 @@
+import re
+from bisect import bisect_left
+from .basic_tokens import TOKENS
+from .bas2tokens import (BasicLineNumber, BasicInt, BasicFloat, BasicString,
+                         BasicSyntaxChars, BasicKeyword)
+
+"""
+basopt.py - Make tokenized BASIC programs smaller
+
+Works on the token lists of bas2tokens.tokenize_line() (line number first) in these
+passes, each of them one walk over the program:
+
+  1. strip REMs: a REM statement and the ':' before it are removed, lines that
+     become empty are removed. This is safe even for jump targets: GO TO, GO SUB,
+     RESTORE and RUN continue at the next existing line, which is exactly where a
+     line consisting of only a REM would have continued.
+  2. pool constants: number literals that are used often enough are assigned to
+     unused single letter variables in a new line in front of the program. Only done
+     if the program does not contain RUN or CLEAR (they delete the variables) and it
+     starts at its first line.
+  3. rewrite number literals: a literal costs its text + 6 bytes (number marker and
+     5 byte value), VAL "text" costs the text + 3 bytes, SGN PI (1) 2 bytes and NOT PI
+     (0) 2 bytes, but since NOT has a low priority, only where the expression ends
+     right after it. BIN literals are never cheaper, they are stored with their value
+     as well.
+  4. merge lines: a line is appended to the previous one with ':', unless it is a
+     jump target, or the previous line contains IF (the merged statements would
+     become conditional) or REM. If the program contains jumps to computed line
+     numbers, no lines are merged.
+
+Literals that are line numbers (GO TO 100, SAVE ... LINE 10) are left alone.
+"""
+
+GO_TO = TOKENS['GO TO']
+GO_SUB = TOKENS['GO SUB']
+THEN = TOKENS['THEN']
+REM = TOKENS['REM']
+IF = TOKENS['IF']
+LINE = TOKENS['LINE']
+BIN = TOKENS['BIN']
+VAL = TOKENS['VAL']
+VAL_STR = TOKENS['VAL$']
+LET = TOKENS['LET']
+NOT = TOKENS['NOT']
+SGN = TOKENS['SGN']
+PI = TOKENS['PI']
+USR = TOKENS['USR']
+
+JUMP_TOKENS = {GO_TO, GO_SUB, TOKENS['RUN'], TOKENS['RESTORE'], TOKENS['LIST'], TOKENS['LLIST']}
+# statements that can continue at lines the analysis does not know about
+UNTRACKED_TOKENS = {TOKENS['ON'], TOKENS['ERROR']}
+# lines starting with these must stay lines of their own
+LINE_START_TOKENS = {TOKENS['DEFPROC']}
+# keep the merged lines to a size that can still be edited
+MAX_LINE_BYTES = 255
+# these delete the variables, so pooled constants would be lost
+CLEARING_TOKENS = {TOKENS['RUN'], TOKENS['CLEAR']}
+NOT_PI_FOLLOWERS = {THEN, TOKENS['TO'], TOKENS['STEP'], TOKENS['AND'], TOKENS['OR']}
+IDENTIFIER = re.compile(r'[A-Za-z][A-Za-z0-9]*')
+NO_AUTOSTART = 0x8000
+
+
+def is_keyword(token, value):
+    return isinstance(token, BasicKeyword) and token.value == value
+
+
+def is_separator(token):
+    return (isinstance(token, BasicSyntaxChars) and token.value == ':') or is_keyword(token, THEN)
+
+
+def is_literal(token):
+    return isinstance(token, (BasicInt, BasicFloat)) and token.value >= 0
+
+
+def statements(line):
+    """yield (start, end) token index ranges of the statements of a line"""
+    start = 1
+    for i in range(1, len(line)):
+        if is_separator(line[i]):
+            yield start, i
+            start = i + 1
+    yield start, len(line)
+
+
+def program_size(lines):
+    """the size of the rendered program: 4 bytes line header, tokens and 0x0d"""
+    return sum(5 + sum(token.num_bytes() for token in line[1:]) for line in lines)
+
+
+class ProgramInfo:
+    """What the passes need to know about a program: the line number literals, the line
+    targets and whether there are jumps the analysis can't follow"""
+
+    def __init__(self, lines):
+        self.line_literals = set()  # id() of literal tokens that are line numbers
+        targets = set()
+        self.computed = False
+        self.keywords = set()
+        for line in lines:
+            for start, end in statements(line):
+                first = line[start] if start < end else None
+                if isinstance(first, BasicKeyword) and first.value in JUMP_TOKENS:
+                    if end - start == 2 and isinstance(line[start + 1], BasicInt):
+                        self.line_literals.add(id(line[start + 1]))
+                        targets.add(line[start + 1].value)
+                    elif end - start > 1:
+                        self.computed = True
+                elif isinstance(first, BasicKeyword) and first.value in LINE_START_TOKENS:
+                    targets.add(line[0].value)
+                for i in range(start, end):
+                    token = line[i]
+                    if isinstance(token, BasicKeyword):
+                        self.keywords.add(token.value)
+                        if token.value == LINE:
+                            if i + 1 < end and isinstance(line[i + 1], BasicInt):
+                                self.line_literals.add(id(line[i + 1]))
+                                targets.add(line[i + 1].value)
+                            else:
+                                self.computed = True
+        if self.keywords & UNTRACKED_TOKENS:
+            self.computed = True
+        # a jump to a line that does not exist continues at the next one
+        line_numbers = [line[0].value for line in lines]
+        self.targets = set()
+        for target in targets:
+            i = bisect_left(line_numbers, target)
+            if i < len(line_numbers):
+                self.targets.add(line_numbers[i])
+
+    def rewritable(self, line, i):
+        """number literals that can be replaced by other expressions"""
+        token = line[i]
+        return is_literal(token) and id(token) not in self.line_literals and \
+            not is_keyword(line[i - 1], BIN)
+
+
+def used_letters(lines):
+    """the first letters of all identifiers in the program, including the ones in
+    the strings of VAL and VAL$"""
+    letters = set()
+    for line in lines:
+        for i, token in enumerate(line[1:], 1):
+            if isinstance(token, BasicSyntaxChars) or \
+               (isinstance(token, BasicString) and (is_keyword(line[i - 1], VAL) or
+                                                    is_keyword(line[i - 1], VAL_STR))):
+                letters.update(name[0].lower() for name in IDENTIFIER.findall(token.value))
+    return letters
+
+
+def keeps_code_rem(lines):
+    """a REM in the first line of a program that calls USR probably contains machine code"""
+    return len(lines) > 0 and len(lines[0]) > 1 and is_keyword(lines[0][1], REM) and \
+        any(is_keyword(token, USR) for line in lines for token in line)
+
+
+def strip_rems(lines):
+    result = []
+    keep_first = keeps_code_rem(lines)
+    for line in lines:
+        if keep_first:
+            result.append(line)
+            keep_first = False
+            continue
+        for i in range(1, len(line)):
+            if is_keyword(line[i], REM):
+                if is_keyword(line[i - 1], THEN):  # IF ... THEN REM needs its REM
+                    line = line[:i + 1]
+                elif i == 1:
+                    line = line[:1]
+                else:  # the ':' in front of it
+                    line = line[:i - 1]
+                break
+        if len(line) > 1:
+            result.append(line)
+    return result
+
+
+def cheap_form(token):
+    """the replacement for a number literal, regardless of the context"""
+    if token.value == 1:
+        return [BasicKeyword(SGN), BasicKeyword(PI)]
+    return [BasicKeyword(VAL), BasicString(token.strvalue)]
+
+
+def not_pi_allowed(line, i):
+    """NOT PI can replace 0 only if the expression ends after it"""
+    if i + 1 == len(line):
+        return True
+    token = line[i + 1]
+    if isinstance(token, BasicSyntaxChars):
+        return token.value in (',', ')', ';', ':')
+    return isinstance(token, BasicKeyword) and token.value in NOT_PI_FOLLOWERS
+
+
+def pool_constants(lines, info, autostart):
+    """returns (lines, autostart, number of pooled constants)"""
+    if len(lines) == 0 or lines[0][0].value == 0 or info.keywords & CLEARING_TOKENS or \
+       keeps_code_rem(lines):
+        return lines, autostart, 0
+    first = lines[0][0].value
+    if autostart < NO_AUTOSTART and autostart > first:
+        return lines, autostart, 0
+
+    uses = {}
+    for line in lines:
+        for i in range(1, len(line)):
+            if info.rewritable(line, i):
+                uses.setdefault(line[i].value, []).append(line[i])
+    candidates = []
+    for value, tokens in uses.items():
+        cost = sum(t.num_bytes() for t in cheap_form(tokens[0]))
+        if value == 0:
+            cost = 2
+        # every use becomes a single letter, the LET statement costs 'LET v=' + cost + ':'
+        saved = len(tokens) * (cost - 1) - (cost + 4)
+        if saved > 0:
+            candidates.append((saved, value, tokens))
+    candidates.sort(key=lambda c: (-c[0], c[1]))
+    used = used_letters(lines)
+    free = [chr(c) for c in range(ord('a'), ord('z') + 1) if chr(c) not in used]
+    candidates = candidates[:len(free)]
+    if sum(saved for saved, _, _ in candidates) <= 5:  # the new line costs 5 bytes
+        return lines, autostart, 0
+
+    replacements = {}
+    pool_line = [BasicLineNumber(first - 1)]
+    for letter, (saved, value, tokens) in zip(free, candidates):
+        if len(pool_line) > 1:
+            pool_line.append(BasicSyntaxChars(':'))
+        pool_line += [BasicKeyword(LET), BasicSyntaxChars(letter), BasicSyntaxChars('='), tokens[0]]
+        for token in tokens:
+            replacements[id(token)] = letter
+    lines = [pool_line] + [[BasicSyntaxChars(replacements[id(token)]) if id(token) in replacements
+                            else token for token in line] for line in lines]
+    if autostart == first:
+        autostart = first - 1
+    return lines, autostart, len(candidates)
+
+
+def rewrite_numbers(lines, info):
+    result = []
+    for line in lines:
+        out = line[:1]
+        for i in range(1, len(line)):
+            token = line[i]
+            if not info.rewritable(line, i):
+                out.append(token)
+            elif token.value == 0 and not_pi_allowed(line, i):
+                out += [BasicKeyword(NOT), BasicKeyword(PI)]
+            else:
+                out += cheap_form(token)
+        result.append(out)
+    return result
+
+
+def merge_lines(lines, info, max_line_bytes=MAX_LINE_BYTES):
+    if info.computed:
+        return lines
+    result = []
+    prev_bytes = 0
+    for line in lines:
+        line_bytes = sum(token.num_bytes() for token in line[1:])
+        if len(result) > 0 and line[0].value not in info.targets and \
+           prev_bytes + 1 + line_bytes <= max_line_bytes and \
+           not any(is_keyword(token, IF) or is_keyword(token, REM) for token in result[-1]):
+            result[-1] = result[-1] + [BasicSyntaxChars(':')] + line[1:]
+            prev_bytes += 1 + line_bytes
+        else:
+            result.append(line)
+            prev_bytes = line_bytes
+    return result
+
+
+class Optimization:
+    """The optimized program with the size after every pass"""
+
+    def __init__(self, lines, autostart=NO_AUTOSTART, rems=True, pool=True, numbers=True, merge=True):
+        self.sizes = [('original', program_size(lines))]
+        self.pooled = 0
+        if rems:
+            lines = strip_rems(lines)
+            self.sizes.append(('strip REMs', program_size(lines)))
+        if autostart < NO_AUTOSTART:  # resolve it like GO TO does
+            line_numbers = [line[0].value for line in lines]
+            i = bisect_left(line_numbers, autostart)
+            if i < len(lines):
+                autostart = line_numbers[i]
+        if pool:
+            lines, autostart, self.pooled = pool_constants(lines, ProgramInfo(lines), autostart)
+            self.sizes.append(('pool constants', program_size(lines)))
+        info = ProgramInfo(lines)
+        if autostart < NO_AUTOSTART:
+            info.targets.add(autostart)
+        if numbers:
+            lines = rewrite_numbers(lines, info)
+            self.sizes.append(('rewrite numbers', program_size(lines)))
+        if merge:
+            lines = merge_lines(lines, info)
+            self.sizes.append(('merge lines', program_size(lines)))
+        self.lines = lines
+        self.autostart = autostart
+
+    @property
+    def bytes_saved(self):
+        return self.sizes[0][1] - self.sizes[-1][1]
+
+    def __str__(self):
+        out = ''
+        for (_, prev_size), (name, size) in zip(self.sizes, self.sizes[1:]):
+            out += '%-16s: %6d bytes saved\n' % (name, prev_size - size)
+            if name == 'pool constants' and self.pooled > 0:
+                out = out.rstrip('\n') + ' (%d constants)\n' % self.pooled
+        out += 'Program size    : %d -> %d bytes' % (self.sizes[0][1], self.sizes[-1][1])
+        return out
+
+
+def optimize(lines, autostart=NO_AUTOSTART, **kwargs):
+    """optimize a tokenized program given as a list of token lists"""
+    return Optimization(lines, autostart, **kwargs)
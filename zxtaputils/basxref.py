@@ -0,0 +1,279 @@
+import json
+import re
+from array import array
+from collections import deque
+from .basic_tokens import TOKENS, REV_TOKENS
+from .bas2asc import BasicProgram, decode_numbers, NUMBER_LENGTH
+from .tapinfo import program_blocks
+from .archive import input_files
+
+"""
+basxref.py - Cross reference and control flow analysis of tokenized BASIC programs
+
+The program is walked once, every line is split into statements of items
+(keywords, numbers, identifiers, other characters) and collected into:
+
+  - line targets of GO TO, GO SUB, RUN, RESTORE and SAVE ... LINE, as parallel
+    arrays of (source line, keyword, target line)
+  - jumps to computed targets (GO TO n*100), which the analysis can't follow
+  - the lines where each variable is defined (LET, FOR, DIM, INPUT, READ, DEF FN)
+    and used
+  - lines that can not be reached from the start of the program or the
+    autostart line
+
+A line falls through to the next one unless its last statement is an unconditional
+GO TO, RUN, RETURN, STOP or NEW. IF makes the rest of its line conditional, so
+lines containing IF always fall through.
+"""
+
+KW, NUM, ID, CHAR = range(4)
+
+GO_TO = TOKENS['GO TO']
+GO_SUB = TOKENS['GO SUB']
+RUN = TOKENS['RUN']
+RESTORE = TOKENS['RESTORE']
+LINE = TOKENS['LINE']
+IF = TOKENS['IF']
+THEN = TOKENS['THEN']
+REM = TOKENS['REM']
+FN = TOKENS['FN']
+DEF_FN = TOKENS['DEF FN']
+
+JUMP_TOKENS = {GO_TO, GO_SUB, RUN, RESTORE}
+FLOW_TOKENS = {GO_TO, GO_SUB, RUN}  # RESTORE only moves the DATA pointer
+TERMINATING_TOKENS = {GO_TO, RUN, TOKENS['RETURN'], TOKENS['STOP'], TOKENS['NEW']}
+DEFINING_TOKENS = {TOKENS['LET'], TOKENS['FOR'], TOKENS['DIM']}
+ALL_DEFINING_TOKENS = {TOKENS['INPUT'], TOKENS['READ']}
+
+NUMBER_MARKER = 0x0e
+NUMBER_TEXT = re.compile(rb'[0-9.]*(?:[eE][+-]?[0-9]+)?$')
+IDENTIFIER = re.compile(rb'[A-Za-z][A-Za-z0-9 ]*')
+STATEMENT_SEPARATOR = ord(':')
+QUOTE = ord('"')
+
+
+def scan_line(line_bytes):
+    """split a tokenized line into statements, every statement is a list of (kind, value)"""
+    statements = []
+    items = []
+    pos = 0
+    end = len(line_bytes)
+    while pos < end:
+        b = line_bytes[pos]
+        if b == QUOTE:  # skip strings
+            close = line_bytes.find(b'"', pos + 1)
+            items.append((CHAR, '""'))
+            pos = end if close < 0 else close + 1
+        elif b == REM:
+            items.append((KW, b))
+            break
+        elif b == STATEMENT_SEPARATOR or b == THEN:
+            statements.append(items)
+            items = []
+            pos += 1
+        elif b in REV_TOKENS:
+            items.append((KW, b))
+            pos += 1
+        elif 0x30 <= b <= 0x39 or b == 0x2e:  # a number literal, digits up to the number marker
+            marker = line_bytes.find(NUMBER_MARKER, pos, end)
+            match = NUMBER_TEXT.match(line_bytes, pos, marker) if marker >= 0 else None
+            if match is not None and marker + NUMBER_LENGTH < end and match.end() == marker:
+                value = decode_numbers(line_bytes[marker + 1:marker + 1 + NUMBER_LENGTH])[0]
+                items.append((NUM, value))
+                pos = marker + 1 + NUMBER_LENGTH
+            else:
+                items.append((CHAR, chr(b)))
+                pos += 1
+        elif b == NUMBER_MARKER:  # e.g. after BIN
+            value = decode_numbers(line_bytes[pos + 1:pos + 1 + NUMBER_LENGTH].ljust(NUMBER_LENGTH, b'\0'))[0]
+            items.append((NUM, value))
+            pos += 1 + NUMBER_LENGTH
+        elif (0x41 <= b <= 0x5a) or (0x61 <= b <= 0x7a):
+            match = IDENTIFIER.match(line_bytes, pos)
+            name = match.group(0).decode('ascii').replace(' ', '').lower()
+            pos = match.end()
+            if pos < end and line_bytes[pos] == ord('$'):
+                name += '$'
+                pos += 1
+            if pos < end and line_bytes[pos] == ord('(') and len(name) <= 2 and \
+               not (items and items[-1] == (KW, FN)) and not (items and items[-1] == (KW, DEF_FN)):
+                name += '()'
+            items.append((ID, name))
+        elif b == 0x20 or b == 0x0d:
+            pos += 1
+        else:
+            items.append((CHAR, chr(b)))
+            pos += 1
+    statements.append(items)
+    return [statement for statement in statements if len(statement) > 0]
+
+
+class CrossReference:
+    """The result of analysing one program"""
+
+    def __init__(self, program, autostart=None):
+        self.program = program
+        self.autostart = autostart
+        # line targets as parallel arrays
+        self.jump_sources = array('H')
+        self.jump_tokens = array('B')
+        self.jump_targets = array('H')
+        self.computed_jumps = []  # (line number, keyword)
+        self.definitions = {}     # variable name -> array of line numbers
+        self.uses = {}
+        self.falls_through = array('B')
+        self.positions = {line_number: i for i, line_number in enumerate(program.line_numbers)}
+        self.analyze()
+        self.unreachable = self.find_unreachable()
+
+    def add_variable(self, table, name, line_number):
+        lines = table.get(name)
+        if lines is None:
+            lines = table[name] = array('H')
+        if len(lines) == 0 or lines[-1] != line_number:
+            lines.append(line_number)
+
+    def add_jump(self, line_number, token, target):
+        self.jump_sources.append(line_number)
+        self.jump_tokens.append(token)
+        self.jump_targets.append(target)
+
+    def analyze_statement(self, line_number, statement):
+        first_kind, first = statement[0]
+        if first_kind == KW and first in JUMP_TOKENS:
+            if len(statement) == 1:
+                if first == RUN:
+                    self.add_jump(line_number, first, 0)
+            elif len(statement) == 2 and statement[1][0] == NUM:
+                self.add_jump(line_number, first, int(statement[1][1]) & 0xffff)
+            else:
+                self.computed_jumps.append((line_number, first))
+
+        for i, (kind, value) in enumerate(statement):
+            if kind == KW and value == LINE and i + 1 < len(statement) and statement[i + 1][0] == NUM:
+                self.add_jump(line_number, LINE, int(statement[i + 1][1]) & 0xffff)
+            elif kind == ID:
+                prev = statement[i - 1] if i > 0 else None
+                if prev == (KW, FN) or prev == (KW, DEF_FN):
+                    value = 'fn ' + value
+                if prev == (KW, DEF_FN) or \
+                   (first_kind == KW and first in ALL_DEFINING_TOKENS) or \
+                   (first_kind == KW and first in DEFINING_TOKENS and i == 1):
+                    self.add_variable(self.definitions, value, line_number)
+                else:
+                    self.add_variable(self.uses, value, line_number)
+
+    def analyze(self):
+        program = self.program
+        for i in range(len(program)):
+            line_number = program.line_numbers[i]
+            statements = scan_line(program.line_bytes(i))
+            conditional = False
+            for statement in statements:
+                if statement[0] == (KW, IF):
+                    conditional = True
+                self.analyze_statement(line_number, statement)
+            last = statements[-1][0] if len(statements) > 0 else None
+            terminates = not conditional and last is not None and \
+                last[0] == KW and last[1] in TERMINATING_TOKENS
+            self.falls_through.append(0 if terminates else 1)
+
+    def line_position(self, target):
+        """the index of the line a jump to target ends up in"""
+        line_number = self.program.next_line_number(target)
+        if line_number is None:
+            return None
+        return self.positions[line_number]
+
+    def find_unreachable(self):
+        program = self.program
+        num_lines = len(program)
+        if num_lines == 0:
+            return array('H')
+        successors = [[] for _ in range(num_lines)]
+        for source, token, target in zip(self.jump_sources, self.jump_tokens, self.jump_targets):
+            if token in FLOW_TOKENS or token == LINE:
+                pos = self.line_position(target)
+                if pos is not None:
+                    successors[self.positions[source]].append(pos)
+
+        reached = bytearray(num_lines)
+        queue = deque([0])
+        if self.autostart is not None:
+            pos = self.line_position(self.autostart)
+            if pos is not None:
+                queue.append(pos)
+        while queue:
+            i = queue.popleft()
+            if reached[i]:
+                continue
+            reached[i] = 1
+            if self.falls_through[i] and i + 1 < num_lines:
+                queue.append(i + 1)
+            queue.extend(successors[i])
+        return array('H', (program.line_numbers[i] for i in range(num_lines) if not reached[i]))
+
+    def to_dict(self):
+        return {
+            'lines': len(self.program),
+            'autostart': self.autostart,
+            'targets': [{'line': source, 'statement': REV_TOKENS[token], 'target': target,
+                         'resolved': self.program.next_line_number(target)}
+                        for source, token, target in zip(self.jump_sources, self.jump_tokens,
+                                                         self.jump_targets)],
+            'computed': [{'line': line_number, 'statement': REV_TOKENS[token]}
+                         for line_number, token in self.computed_jumps],
+            'variables': {name: {'defined': list(self.definitions.get(name, [])),
+                                 'used': list(self.uses.get(name, []))}
+                          for name in sorted(set(self.definitions) | set(self.uses))},
+            'unreachable': list(self.unreachable),
+            'unreachable_exact': len(self.computed_jumps) == 0
+        }
+
+    def __str__(self):
+        out = 'Line targets:\n'
+        for source, token, target in zip(self.jump_sources, self.jump_tokens, self.jump_targets):
+            resolved = self.program.next_line_number(target)
+            out += '  %5d %-8s %5d' % (source, REV_TOKENS[token], target)
+            if resolved is None:
+                out += ' (no such line)'
+            elif resolved != target:
+                out += ' (line %d)' % resolved
+            out += '\n'
+        if len(self.computed_jumps) > 0:
+            out += 'Computed targets:\n'
+            for line_number, token in self.computed_jumps:
+                out += '  %5d %s\n' % (line_number, REV_TOKENS[token])
+        out += 'Variables:\n'
+        for name in sorted(set(self.definitions) | set(self.uses)):
+            out += '  %-10s defined: %s\n' % (name, ', '.join(str(n) for n in self.definitions.get(name, [])))
+            out += '  %-10s used   : %s\n' % ('', ', '.join(str(n) for n in self.uses.get(name, [])))
+        out += 'Unreachable lines: %s' % (', '.join(str(n) for n in self.unreachable) or 'none')
+        if len(self.computed_jumps) > 0:
+            out += ' (approximate, the program has computed jumps)'
+        return out
+
+
+def cross_reference(prog_bytes, autostart=None):
+    """analyze a tokenized program, autostart values >= 32768 mean no autostart"""
+    if autostart is not None and autostart >= 0x8000:
+        autostart = None
+    return CrossReference(BasicProgram(prog_bytes), autostart)
+
+
+def basxref(args):
+    results = []
+    for path, infile in input_files(args.tapfiles):
+        for blocknum, header, prog_bytes in program_blocks(infile):
+            xref = cross_reference(prog_bytes, header.params[0])
+            if args.json:
+                result = xref.to_dict()
+                result['file'] = path
+                result['block'] = blocknum
+                results.append(result)
+            else:
+                print('%s, block %d ("%s")' % (path, blocknum, header.file_name.rstrip()))
+                print(xref)
+                print()
+    if args.json:
+        print(json.dumps(results, indent=2))
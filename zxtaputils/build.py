@@ -0,0 +1,194 @@
+import argparse
+import hashlib
+import json
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from .util import BT_PROGRAM
+from .tapinfo import ZXHeader, ZXData
+from .bas2tokens import bas2token_lines, render_lines
+from .compress import CompressedCode
+from . import tapify
+
+"""
+build.py - Assemble a TAP file from the pieces listed in a JSON manifest
+
+  {
+    "output": "game.tap",
+    "blocks": [
+      {"type": "basic", "source": "loader.bas", "name": "game", "autostart": 10},
+      {"type": "code", "source": "screen.scr", "name": "screen", "start": 16384},
+      {"type": "code", "source": "main.bin", "name": "main", "start": 32768, "compress": true},
+      {"type": "nums", "source": "table.csv", "name": "table", "varname": "t"}
+    ]
+  }
+
+Block types: basic (BASIC source, "optimize": true runs the size optimizer),
+program (already tokenized), code ("exec" is the address the decompressor calls),
+nums and chars (CSV, NumPy or raw array data). Paths are relative to the manifest.
+
+A compressed code block is loaded above "start" and has to be started at the
+address of its decompressor, which is after the compressed data: tapbuild prints
+"start with RANDOMIZE USR <address>" for it, the loader has to call that address.
+Code that does not get smaller is saved uncompressed, with a warning.
+
+Every block is built into its header + data TAP bytes separately. The result is
+cached under the SHA-256 of the block description, the contents of its source file
+and CACHE_VERSION, so after changing one file only its block is rebuilt. Blocks
+that are not in the cache are built in worker processes in parallel, the output is
+the cached blocks concatenated in manifest order. The report of a compressed block
+is cached next to it, so it is also printed when the block is not rebuilt.
+"""
+
+CACHE_VERSION = 3  # increase when the output of a block type changes
+DEFAULT_CACHE_DIR = '.tapbuild-cache'
+BLOCK_TYPES = ('basic', 'program', 'code', 'nums', 'chars')
+
+
+def read_manifest(path):
+    with open(path) as infile:
+        manifest = json.load(infile)
+    if not manifest.get('blocks'):
+        raise ValueError("'%s' does not list any blocks" % path)
+    for num, spec in enumerate(manifest['blocks']):
+        if spec.get('type') not in BLOCK_TYPES:
+            raise ValueError("block %d: type must be one of %s" % (num, ', '.join(BLOCK_TYPES)))
+        if 'source' not in spec:
+            raise ValueError("block %d: no source file" % num)
+    return manifest
+
+
+def block_key(spec, source_bytes):
+    """the cache key of a block: its description and the contents of its source"""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([CACHE_VERSION, spec], sort_keys=True).encode('utf-8'))
+    digest.update(source_bytes)
+    return digest.hexdigest()
+
+
+def tap_bytes(header, data_bytes):
+    header_bytes = header.bytes()
+    dblock_bytes = ZXData(data_bytes).bytes()
+    return (struct.pack('<H', len(header_bytes)) + header_bytes +
+            struct.pack('<H', len(dblock_bytes)) + dblock_bytes)
+
+
+def build_basic(spec, path):
+    autostart = spec.get('autostart', 0x8000)
+    with open(path) as infile:
+        lines = bas2token_lines(infile)
+    if spec.get('optimize'):
+        from .basopt import optimize
+        optimization = optimize(lines, autostart)
+        lines, autostart = optimization.lines, optimization.autostart
+    prog_bytes = render_lines(lines) or b''
+    return tap_bytes(ZXHeader(BT_PROGRAM, spec.get('name', ''), len(prog_bytes),
+                              [autostart, len(prog_bytes)]), prog_bytes)
+
+
+def build_block(spec, path):
+    """the header and data block of a manifest entry as TAP bytes, and the report of a
+    compressed block (None for the others)"""
+    if spec['type'] == 'basic':
+        return build_basic(spec, path), None
+    # everything else is what tapify does for a single file
+    args = argparse.Namespace(infile=path, objtype=spec['type'], filename=spec.get('name', ''),
+                              startaddr=spec.get('start', 0x4000), varname=spec.get('varname', 'a'),
+                              autostart_line=spec.get('autostart', 0x8000))
+    data_bytes = tapify.read_data_bytes(args)
+    report = None
+    if spec.get('compress'):
+        if spec['type'] != 'code':
+            raise ValueError("only code blocks can be compressed")
+        compressed = CompressedCode(data_bytes, args.startaddr, spec.get('exec'))
+        if compressed.is_smaller:
+            report = compressed.report(data_bytes)
+            data_bytes, args.startaddr = compressed.data_bytes, compressed.start_addr
+        else:
+            report = compressed.warning()
+    header = ZXHeader(tapify.type_byte(args.objtype), args.filename, len(data_bytes),
+                      tapify.make_block_parameters(args, data_bytes))
+    return tap_bytes(header, data_bytes), report
+
+
+def write_atomic(path, data):
+    """other builds sharing the cache never see half written files"""
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as outfile:
+        outfile.write(data)
+    os.replace(tmp_path, path)
+
+
+class BlockCache:
+    """Built blocks in a directory, one file per key, and a .txt file with the report
+    of compressed blocks"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.tap')
+
+    def report_path(self, key):
+        return os.path.join(self.cache_dir, key + '.txt')
+
+    def get(self, key):
+        """(block bytes, report), (None, None) if the block is not in the cache"""
+        try:
+            with open(self.path(key), 'rb') as infile:
+                block_bytes = infile.read()
+        except FileNotFoundError:
+            return None, None
+        try:
+            with open(self.report_path(key), 'rb') as infile:
+                return block_bytes, infile.read().decode('utf-8')
+        except FileNotFoundError:
+            return block_bytes, None
+
+    def put(self, key, block_bytes, report=None):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if report is not None:  # before the block, so a cached block always has its report
+            write_atomic(self.report_path(key), report.encode('utf-8'))
+        write_atomic(self.path(key), block_bytes)
+
+
+def build(manifest_path, output=None, cache_dir=None, jobs=None, use_cache=True):
+    """build the TAP file, returns (output path, list of (spec, cached or not, report))"""
+    manifest = read_manifest(manifest_path)
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    if output is None:
+        output = os.path.join(base_dir, manifest.get('output', os.path.splitext(os.path.basename(manifest_path))[0] + '.tap'))
+    cache = BlockCache(cache_dir if cache_dir is not None else os.path.join(base_dir, DEFAULT_CACHE_DIR))
+
+    specs = manifest['blocks']
+    paths = [os.path.join(base_dir, spec['source']) for spec in specs]
+    keys = []
+    for path, spec in zip(paths, specs):
+        with open(path, 'rb') as infile:
+            keys.append(block_key(spec, infile.read()))
+    cached = [cache.get(key) if use_cache else (None, None) for key in keys]
+    blocks = [block_bytes for block_bytes, _ in cached]
+    reports = [report for _, report in cached]
+    missing = [i for i, block in enumerate(blocks) if block is None]
+
+    if len(missing) > 1 and jobs != 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            built = list(executor.map(build_block, [specs[i] for i in missing], [paths[i] for i in missing]))
+    else:  # not worth starting workers
+        built = [build_block(specs[i], paths[i]) for i in missing]
+    for i, (block_bytes, report) in zip(missing, built):
+        blocks[i], reports[i] = block_bytes, report
+        cache.put(keys[i], block_bytes, report)
+
+    write_atomic(output, b''.join(blocks))
+    missing = set(missing)
+    return output, [(spec, i not in missing, reports[i]) for i, spec in enumerate(specs)]
+
+
+def tapbuild(args):
+    output, results = build(args.manifest, args.outfile, args.cachedir, args.jobs, not args.nocache)
+    for spec, cached, report in results:
+        print('%-8s %-7s %s' % ('cached' if cached else 'built', spec['type'], spec['source']))
+        if report is not None:
+            print('\n'.join('  ' + line for line in report.splitlines()))
+    print("Writing '%s' (%d blocks)" % (output, 2 * len(results)))
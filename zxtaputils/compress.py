@@ -0,0 +1,207 @@
+import struct
+from array import array
+from .tzx import assemble
+from .taptiming import block_timing, ROM_TIMINGS
+from .tapinfo import ZXData
+
+"""
+compress.py - Compress code blocks and build a Z80 decompressor stub for them
+
+The compressed data is a sequence of tokens:
+
+  - 0x00: end of data
+  - 0x01 - 0x7f: literal run, followed by that many bytes that are copied
+  - 0x80 - 0xff: match of (token & 0x7f) + MIN_MATCH bytes, followed by the
+    2 byte (little endian) distance back into the already decompressed data
+
+Which can be decompressed with a few LDIRs on the Spectrum (decompressor_source()).
+
+Matches are found with hash chains: for every position, the previous position
+with the same MIN_MATCH bytes is remembered, only these candidates are compared.
+
+Decompression works in place: the compressed block is loaded to the end of the
+area the code will occupy, with a gap that is large enough that writing the
+decompressed data never overtakes reading the compressed data. The stub follows
+the compressed data and is called instead of the code.
+"""
+
+MIN_MATCH = 4
+MAX_MATCH = 0x7f + MIN_MATCH
+MAX_LITERALS = 0x7f
+MAX_OFFSET = 0xffff
+MAX_CHAIN = 48
+
+
+def match_length(data, cand, pos, limit):
+    """the number of bytes (up to limit) that are equal at cand and pos"""
+    length = 0
+    while length + 8 <= limit and data[cand + length:cand + length + 8] == data[pos + length:pos + length + 8]:
+        length += 8
+    while length < limit and data[cand + length] == data[pos + length]:
+        length += 1
+    return length
+
+
+def compress(data):
+    """compress a bytes object, returns the compressed bytes including the end marker"""
+    data = bytes(data)
+    size = len(data)
+    head = {}
+    prev = array('l', [-1]) * size
+    out = bytearray()
+    literal_start = 0
+
+    def insert(p):
+        if p + MIN_MATCH <= size:
+            key = data[p:p + MIN_MATCH]
+            prev[p] = head.get(key, -1)
+            head[key] = p
+
+    def flush_literals(end):
+        start = literal_start
+        while start < end:
+            count = min(MAX_LITERALS, end - start)
+            out.append(count)
+            out.extend(data[start:start + count])
+            start += count
+
+    pos = 0
+    while pos < size:
+        best_len = 0
+        best_offset = 0
+        limit = min(MAX_MATCH, size - pos)
+        if limit >= MIN_MATCH:
+            cand = head.get(data[pos:pos + MIN_MATCH], -1)
+            chain = MAX_CHAIN
+            while cand >= 0 and chain > 0 and pos - cand <= MAX_OFFSET:
+                # only candidates that could be longer are compared (best_len < limit here)
+                if data[cand + best_len] == data[pos + best_len]:
+                    length = match_length(data, cand, pos, limit)
+                    if length > best_len:
+                        best_len = length
+                        best_offset = pos - cand
+                        if length == limit:
+                            break
+                cand = prev[cand]
+                chain -= 1
+        if best_len >= MIN_MATCH:
+            flush_literals(pos)
+            out.append(0x80 | (best_len - MIN_MATCH))
+            out.extend(struct.pack('<H', best_offset))
+            for p in range(pos, pos + best_len):
+                insert(p)
+            pos += best_len
+            literal_start = pos
+        else:
+            insert(pos)
+            pos += 1
+    flush_literals(size)
+    out.append(0x00)
+    return bytes(out)
+
+
+def decompress(comp_bytes):
+    """decompress, mainly for verification"""
+    out = bytearray()
+    pos = 0
+    while True:
+        token = comp_bytes[pos]
+        pos += 1
+        if token == 0:
+            break
+        if token < 0x80:
+            out.extend(comp_bytes[pos:pos + token])
+            pos += token
+        else:
+            offset = struct.unpack_from('<H', comp_bytes, pos)[0]
+            pos += 2
+            start = len(out) - offset
+            for i in range(MIN_MATCH + (token & 0x7f)):
+                out.append(out[start + i])
+    return bytes(out)
+
+
+def inplace_gap(comp_bytes):
+    """the minimum distance between the start of the decompressed and the start of the
+    compressed data, so decompressing never overwrites unread compressed bytes"""
+    gap = 0
+    in_pos = 0
+    out_pos = 0
+    while True:
+        token = comp_bytes[in_pos]
+        in_pos += 1
+        if token == 0:
+            break
+        if token < 0x80:
+            in_pos += token
+            out_pos += token
+        else:
+            in_pos += 2
+            out_pos += MIN_MATCH + (token & 0x7f)
+        gap = max(gap, out_pos - in_pos)
+    return gap
+
+
+def decompressor_source(comp_addr, dest_addr, exec_addr):
+    """the stub: decompress from comp_addr to dest_addr, then jump to exec_addr or
+    return to BASIC if it is None"""
+    done = [b'\xc3', struct.pack('<H', exec_addr)] if exec_addr is not None else [b'\xc9']
+    return [
+        b'\x21', struct.pack('<H', comp_addr),   # ld hl,comp_addr
+        b'\x11', struct.pack('<H', dest_addr),   # ld de,dest_addr
+        b'\xcd', ('abs', 'dzx')] + done + [      # call dzx
+        'dzx',
+        b'\x7e', b'\x23', b'\xb7', b'\xc8',      # ld a,(hl) / inc hl / or a / ret z
+        b'\xfe\x80',                             # cp 0x80
+        b'\x30', ('jr', 'match'),                # jr nc,match
+        b'\x4f', b'\x06\x00', b'\xed\xb0',       # ld c,a / ld b,0 / ldir
+        b'\x18', ('jr', 'dzx'),                  # jr dzx
+        'match',
+        b'\xe6\x7f', b'\xc6', bytes([MIN_MATCH]),  # and 0x7f / add a,MIN_MATCH
+        b'\x4f', b'\x06\x00',                    # ld c,a / ld b,0
+        b'\x7e', b'\x23', b'\xe5',               # ld a,(hl) / inc hl / push hl
+        b'\x66', b'\x6f',                        # ld h,(hl) / ld l,a
+        b'\xd5', b'\xeb',                        # push de / ex de,hl
+        b'\xb7', b'\xed\x52',                    # or a / sbc hl,de
+        b'\xd1', b'\xed\xb0',                    # pop de / ldir
+        b'\xe1', b'\x23',                        # pop hl / inc hl
+        b'\x18', ('jr', 'dzx')]                  # jr dzx
+
+
+class CompressedCode:
+    """A compressed code block: load data_bytes at start_addr and call stub_addr"""
+    def __init__(self, data, dest_addr, exec_addr=None):
+        self.original_len = len(data)
+        comp_bytes = compress(data)
+        self.comp_len = len(comp_bytes)
+        self.start_addr = dest_addr + max(inplace_gap(comp_bytes), 0)
+        self.stub_addr = self.start_addr + self.comp_len
+        stub = assemble(self.stub_addr, decompressor_source(self.start_addr, dest_addr, exec_addr))
+        self.data_bytes = comp_bytes + stub
+        if self.start_addr + len(self.data_bytes) > 0x10000:
+            raise ValueError("compressed code and decompressor do not fit below 65536")
+
+    @property
+    def ratio(self):
+        return self.comp_len / self.original_len if self.original_len > 0 else 1.0
+
+    @property
+    def is_smaller(self):
+        """is the block with the decompressor smaller than the original code"""
+        return len(self.data_bytes) < self.original_len
+
+    def warning(self):
+        """for code that is not worth compressing, it is saved uncompressed"""
+        return "Warning: compressed code with decompressor is not smaller (%d -> %d bytes), " \
+               "saving it uncompressed" % (self.original_len, len(self.data_bytes))
+
+    def report(self, original_bytes, timings=ROM_TIMINGS):
+        """describe the compression ratio and the load time saving"""
+        original = block_timing(ZXData(original_bytes).bytes(), timings)
+        compressed = block_timing(ZXData(self.data_bytes).bytes(), timings)
+        out = "Compressed %d -> %d bytes (%.1f%%, %d bytes with decompressor)\n" % (
+            self.original_len, self.comp_len, self.ratio * 100, len(self.data_bytes))
+        out += "Load at %d, start with RANDOMIZE USR %d\n" % (self.start_addr, self.stub_addr)
+        out += "Load time: %.2f s -> %.2f s (saved %.2f s)" % (
+            original.seconds, compressed.seconds, original.seconds - compressed.seconds)
+        return out
@@ -0,0 +1,337 @@
+import mmap
+import os
+import struct
+from .util import BT_PROGRAM
+from .bas2asc import plus3dos_header_from_bytes, detokenize_bytes, PLUS3DOS_HEADER_LENGTH
+
+"""
+dsk.py - Read the files on +3 disk images (.dsk)
+
+Both the standard ("MV - CPC") and the extended ("EXTENDED CPC DSK File") image
+formats are supported. The image is mmapped, the track and sector tables are read
+once into an index (cylinder, side, sector id) -> position in the image, the
+sector data itself is only touched when a file is read.
+
+The file system is CP/M 2.2 / +3DOS:
+
+  - the disk specification in the first sector of track 0 describes the geometry
+    (tracks, sectors, reserved tracks, block and directory size), disks without
+    one (CPC system/data formats, unformatted boot sector) use the defaults of
+    their format
+  - the directory follows the reserved tracks, every 32 byte entry describes an
+    extent (16K) of a file: user, name, extension, extent number, number of 128
+    byte records in the last logical extent and the allocation blocks
+  - files written by +3DOS start with a 128 byte PLUS3DOS header, its file
+    length is the exact length, otherwise the length is the number of records
+
+Disk spec (16 bytes at the start of track 0, sector 1):
+
+  0: format (0 = +3/PCW single sided, 3 = PCW double sided)
+  1: sides (bits 0-1: 0 single, 1 alternating, 2 successive)
+  2: tracks per side, 3: sectors per track, 4: log2(sector size) - 7
+  5: reserved tracks, 6: log2(block size) - 7, 7: directory blocks
+"""
+
+STANDARD_SIGNATURE = b'MV - CPC'
+EXTENDED_SIGNATURE = b'EXTENDED CPC DSK File'
+DISK_INFO_SIZE = 256
+TRACK_INFO_SIZE = 256
+TRACK_SIGNATURE = b'Track-Info'
+SECTOR_INFO_OFFSET = 0x18
+SECTOR_INFO_SIZE = 8
+
+DIR_ENTRY_SIZE = 32
+RECORD_SIZE = 128
+RECORDS_PER_EXTENT = 128
+UNUSED_ENTRY = 0xe5
+MAX_USER = 15
+
+CPC_SYSTEM_FIRST_SECTOR = 0x41
+CPC_DATA_FIRST_SECTOR = 0xc1
+
+
+class DiskSpec:
+    """The geometry and file system parameters of a disk"""
+
+    def __init__(self, sides=1, tracks=40, sectors=9, sector_size=512, reserved_tracks=1,
+                 block_size=1024, dir_blocks=2, alternating_sides=True):
+        self.sides = sides
+        self.tracks = tracks
+        self.sectors = sectors
+        self.sector_size = sector_size
+        self.reserved_tracks = reserved_tracks
+        self.block_size = block_size
+        self.dir_blocks = dir_blocks
+        self.alternating_sides = alternating_sides
+
+    @property
+    def num_blocks(self):
+        data_sectors = (self.tracks * self.sides - self.reserved_tracks) * self.sectors
+        return data_sectors * self.sector_size // self.block_size
+
+    @property
+    def dir_entries(self):
+        return self.dir_blocks * self.block_size // DIR_ENTRY_SIZE
+
+
+def disk_spec_from_bytes(spec_bytes):
+    """the DiskSpec of a +3/PCW disk specification, None if it does not look like one"""
+    if len(spec_bytes) < 10 or spec_bytes[0] not in (0, 3):
+        return None
+    fmt, sidedness, tracks, sectors, psh, reserved, bsh, dir_blocks = struct.unpack_from('<8B', spec_bytes)
+    if tracks == 0 or sectors == 0 or psh > 3 or bsh > 7 or dir_blocks == 0:
+        return None
+    return DiskSpec(sides=2 if sidedness & 0x03 else 1, tracks=tracks, sectors=sectors,
+                    sector_size=128 << psh, reserved_tracks=reserved, block_size=128 << bsh,
+                    dir_blocks=dir_blocks, alternating_sides=(sidedness & 0x03) != 2)
+
+
+class DskFile:
+    """A file in the directory of a disk image"""
+
+    def __init__(self, user, name, ext):
+        self.user = user
+        self.name = name
+        self.ext = ext
+        self.extents = []  # (extent number, record count, block numbers)
+        self.data = None
+        self.plus3dos_header = None
+
+    @property
+    def filename(self):
+        return self.name + '.' + self.ext if self.ext else self.name
+
+    @property
+    def num_records(self):
+        extent, records, _ = max(self.extents)
+        return extent * RECORDS_PER_EXTENT + records
+
+    @property
+    def contents(self):
+        """the file without +3DOS header, cut to the length in the header"""
+        if self.plus3dos_header is None:
+            return self.data
+        return self.data[PLUS3DOS_HEADER_LENGTH:self.plus3dos_header.file_len]
+
+    def __str__(self):
+        header = self.plus3dos_header
+        size = header.file_len if header is not None else self.num_records * RECORD_SIZE
+        out = '%-12s %7d bytes' % (self.filename, size)
+        if self.user != 0:
+            out += ', user %d' % self.user
+        if header is not None:
+            if header.block_type == BT_PROGRAM:
+                out += ', program, %d bytes, autostart %d' % (header.params[1], header.params[0])
+            else:
+                out += ', +3DOS type %d, %d bytes' % (header.block_type, header.inner_file_len)
+        return out
+
+
+class DskImage:
+    """An mmapped .dsk image and its sector index"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            self.file.close()
+            raise ValueError("'%s' is empty" % path)
+        self.sectors = {}  # (cylinder, side, sector id) -> (offset, length)
+        self.track_sectors = {}  # (cylinder, side) -> sector ids in the order of the track
+        try:
+            self.read_tracks()
+            self.spec = self.disk_spec()
+            self.files = self.read_directory()
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        self.buf.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read_tracks(self):
+        buf = self.buf
+        if buf[:len(EXTENDED_SIGNATURE)] == EXTENDED_SIGNATURE:
+            extended = True
+        elif buf[:len(STANDARD_SIGNATURE)] == STANDARD_SIGNATURE:
+            extended = False
+        else:
+            raise ValueError("'%s' is not a DSK image" % self.path)
+        num_tracks, num_sides = buf[0x30], buf[0x31]
+        track_size = struct.unpack_from('<H', buf, 0x32)[0]
+        offset = DISK_INFO_SIZE
+        for num in range(num_tracks * num_sides):
+            if extended:
+                track_size = buf[0x34 + num] * 256
+                if track_size == 0:  # unformatted track
+                    continue
+            if offset + TRACK_INFO_SIZE > len(buf):
+                break
+            if buf[offset:offset + len(TRACK_SIGNATURE)] != TRACK_SIGNATURE:
+                raise ValueError("no track information at offset %d" % offset)
+            cylinder, side = buf[offset + 0x10], buf[offset + 0x11]
+            size_code, num_sectors = buf[offset + 0x14], buf[offset + 0x15]
+            data_offset = offset + TRACK_INFO_SIZE
+            ids = []
+            for i in range(num_sectors):
+                info = offset + SECTOR_INFO_OFFSET + i * SECTOR_INFO_SIZE
+                sector_id = buf[info + 2]
+                length = struct.unpack_from('<H', buf, info + 6)[0] if extended else 128 << min(size_code, 6)
+                self.sectors[(cylinder, side, sector_id)] = (data_offset, length)
+                ids.append(sector_id)
+                data_offset += length
+            self.track_sectors[(cylinder, side)] = ids
+            offset += track_size
+
+    def first_sector_id(self, cylinder=0, side=0):
+        ids = self.track_sectors.get((cylinder, side))
+        if not ids:
+            raise ValueError("track %d, side %d is not formatted" % (cylinder, side))
+        return min(ids)
+
+    def sector(self, cylinder, side, sector_id):
+        found = self.sectors.get((cylinder, side, sector_id))
+        if found is None:
+            raise ValueError("sector %d of track %d, side %d is missing" % (sector_id, cylinder, side))
+        offset, length = found
+        return self.buf[offset:offset + length]
+
+    def disk_spec(self):
+        first_id = self.first_sector_id()
+        num_sides = 2 if any(side == 1 for _, side in self.track_sectors) else 1
+        num_tracks = max(cylinder for cylinder, _ in self.track_sectors) + 1
+        if first_id == CPC_DATA_FIRST_SECTOR:
+            return DiskSpec(sides=num_sides, tracks=num_tracks, reserved_tracks=0)
+        if first_id == CPC_SYSTEM_FIRST_SECTOR:
+            return DiskSpec(sides=num_sides, tracks=num_tracks, reserved_tracks=2)
+        spec = disk_spec_from_bytes(self.sector(0, 0, first_id)[:16])
+        return spec if spec is not None else DiskSpec(sides=num_sides, tracks=num_tracks)
+
+    def logical_sector(self, num):
+        """the bytes of the num-th sector, counted from the start of the disk"""
+        spec = self.spec
+        track, index = divmod(num, spec.sectors)
+        if spec.sides == 1:
+            cylinder, side = track, 0
+        elif spec.alternating_sides:
+            cylinder, side = divmod(track, 2)
+        else:
+            side, cylinder = divmod(track, spec.tracks)
+        return self.sector(cylinder, side, self.first_sector_id(cylinder, side) + index)
+
+    def block(self, num):
+        spec = self.spec
+        per_block = spec.block_size // spec.sector_size
+        first = spec.reserved_tracks * spec.sectors + num * per_block
+        return b''.join(self.logical_sector(first + i) for i in range(per_block))
+
+    def read_directory(self):
+        spec = self.spec
+        directory = b''.join(self.block(num) for num in range(spec.dir_blocks))
+        wide_blocks = spec.num_blocks > 255
+        files = {}
+        for pos in range(0, spec.dir_entries * DIR_ENTRY_SIZE, DIR_ENTRY_SIZE):
+            entry = directory[pos:pos + DIR_ENTRY_SIZE]
+            if len(entry) < DIR_ENTRY_SIZE or entry[0] == UNUSED_ENTRY or entry[0] > MAX_USER:
+                continue
+            name = bytes(b & 0x7f for b in entry[1:9]).decode('ascii', 'replace').rstrip()
+            ext = bytes(b & 0x7f for b in entry[9:12]).decode('ascii', 'replace').rstrip()
+            extent = entry[12] + 32 * entry[14]
+            if wide_blocks:
+                blocks = struct.unpack_from('<8H', entry, 16)
+            else:
+                blocks = tuple(entry[16:32])
+            key = (entry[0], name, ext)
+            if key not in files:
+                files[key] = DskFile(entry[0], name, ext)
+            files[key].extents.append((extent, entry[15], [b for b in blocks if b != 0]))
+        return list(files.values())
+
+    def read_file(self, dskfile):
+        """the bytes of a file, +3DOS header included"""
+        if dskfile.data is None:
+            blocks = [num for _, _, extent_blocks in sorted(dskfile.extents) for num in extent_blocks]
+            data = b''.join(self.block(num) for num in blocks if num < self.spec.num_blocks)
+            dskfile.data = data[:dskfile.num_records * RECORD_SIZE]
+            dskfile.plus3dos_header = plus3dos_header_from_bytes(dskfile.data)
+        return dskfile.data
+
+    def read_files(self):
+        for dskfile in self.files:
+            self.read_file(dskfile)
+        return self.files
+
+
+def dsk_paths(paths):
+    """the images in paths, directories are replaced by the .dsk files in them"""
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith('.dsk'):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def safe_filename(name):
+    return ''.join(c if c.isalnum() or c in '._-' else '_' for c in name)
+
+
+def output_path(image_dir, dskfile, written):
+    """the files of user 0 go into image_dir, the other users into image_dir/u<user>/,
+    names that are the same after safe_filename() get a number"""
+    user_dir = image_dir if dskfile.user == 0 else os.path.join(image_dir, 'u%d' % dskfile.user)
+    filepath = os.path.join(user_dir, safe_filename(dskfile.filename))
+    if filepath in written:
+        base, ext = os.path.splitext(filepath)
+        num = 2
+        while '%s-%d%s' % (base, num, ext) in written:
+            num += 1
+        print("Warning: '%s' was already written, using '%s-%d%s'" % (filepath, base, num, ext))
+        filepath = '%s-%d%s' % (base, num, ext)
+    written.add(filepath)
+    return filepath
+
+
+def extract_image(path, outdir, listings=False, list_only=False):
+    """write all files of an image to outdir/<image name>/ (outdir/<image name>/u<user>/
+    for users other than 0), returns the number of files"""
+    with DskImage(path) as image:
+        files = image.read_files()
+        if list_only:
+            for dskfile in files:
+                print(dskfile)
+            return len(files)
+        image_dir = os.path.join(outdir, os.path.splitext(os.path.basename(path))[0])
+        written = set()
+        for dskfile in files:
+            filepath = output_path(image_dir, dskfile, written)
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            print("Writing '%s'" % filepath)
+            with open(filepath, 'wb') as outfile:
+                outfile.write(dskfile.data)
+            header = dskfile.plus3dos_header
+            if listings and header is not None and header.block_type == BT_PROGRAM:
+                with open(filepath + '.bas', 'w') as outfile:
+                    detokenize_bytes(dskfile.contents[:header.params[1]], outfile)
+        return len(files)
+
+
+def dskextract(args):
+    num_files = 0
+    outdir = args.outdir if args.outdir is not None else '.'
+    paths = list(dsk_paths(args.dskfiles))
+    for path in paths:
+        if len(paths) > 1 or args.list:
+            print('%s:' % path)
+        num_files += extract_image(path, outdir, args.basic, args.list)
+    print("%d file(s) in %d image(s)." % (num_files, len(paths)))
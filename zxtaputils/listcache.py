@@ -0,0 +1,188 @@
+import hashlib
+import io
+import json
+import os
+from collections import OrderedDict
+from . import bas2asc, basic_tokens
+
+try:
+    import fcntl
+except ImportError:  # Windows: eviction is not locked
+    fcntl = None
+
+"""
+listcache.py - Disk cache of detokenized listings
+
+Listings are stored under the SHA-256 of the program bytes, the listing format,
+the kind of output and its options, so a program block that was listed before is
+not detokenized again, also not by other processes sharing the cache directory.
+The listing format is LISTING_FORMAT and the source of the detokenizer, so a
+changed detokenizer never returns the listings of the old one.
+
+  - entries are files in <cache dir>/<first 2 hex digits>/<key>, written to a
+    temporary file and moved into place with os.replace(), readers see either
+    nothing or the complete entry
+  - a hit touches the file, the modification times are the LRU order
+  - the oldest entries are removed until the cache is below EVICT_TO * max_bytes,
+    under an flock() on <cache dir>/lock so two processes don't evict at the same
+    time. This needs a scan of the whole directory, so it is done on the first
+    write of a process, when the writes since the last scan take the cache over
+    max_bytes and every EVICT_INTERVAL writes for what other processes wrote
+  - the last memory_entries hits are also kept in memory per process
+"""
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'zxtaputils')
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MEMORY_ENTRIES = 256
+LOCK_FILE = 'lock'
+LISTING_FORMAT = 1  # increase when the listings change in a way the source hash does not show
+EVICT_INTERVAL = 64
+EVICT_TO = 0.9  # eviction goes down to this part of max_bytes, so the next writes fit
+
+_listing_format = None
+
+
+def listing_format():
+    """LISTING_FORMAT and a hash of the detokenizer's source"""
+    global _listing_format
+    if _listing_format is None:
+        digest = hashlib.sha256()
+        for module in (bas2asc, basic_tokens):
+            try:
+                with open(module.__file__, 'rb') as infile:
+                    digest.update(infile.read())
+            except (OSError, TypeError):  # no source, e.g. frozen
+                pass
+        _listing_format = '%d-%s' % (LISTING_FORMAT, digest.hexdigest()[:16])
+    return _listing_format
+
+
+class ListingCache:
+    """Text results keyed by program bytes and options, on disk with an in-memory front"""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES,
+                 memory_entries=DEFAULT_MEMORY_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()  # key -> text, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.disk_bytes = None  # size on disk at the last scan plus what was written since
+        self.puts_since_scan = 0
+
+    def key(self, kind, data_bytes, options):
+        digest = hashlib.sha256()
+        digest.update(json.dumps([listing_format(), kind, options], sort_keys=True).encode('utf-8'))
+        digest.update(data_bytes)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def remember(self, key, text):
+        self.memory[key] = text
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        text = self.memory.get(key)
+        if text is not None:
+            self.memory.move_to_end(key)
+            return text
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as infile:
+                text = infile.read().decode('utf-8')
+            os.utime(path)
+        except FileNotFoundError:  # also when it was evicted between open() and utime()
+            if text is None:
+                return None
+        self.remember(key, text)
+        return text
+
+    def put(self, key, text):
+        self.remember(key, text)
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        text_bytes = text.encode('utf-8')
+        with open(tmp_path, 'wb') as outfile:
+            outfile.write(text_bytes)
+        os.replace(tmp_path, path)
+        self.puts_since_scan += 1
+        if self.disk_bytes is not None:
+            self.disk_bytes += len(text_bytes)
+        if self.disk_bytes is None or self.disk_bytes > self.max_bytes or \
+           self.puts_since_scan >= EVICT_INTERVAL:
+            self.evict()
+
+    def entries(self):
+        """(modification time, size, path) of all entries on disk"""
+        result = []
+        for subdir in os.scandir(self.cache_dir):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                result.append((stat.st_mtime, stat.st_size, entry.path))
+        return result
+
+    def evict(self):
+        """when the cache is larger than max_bytes, remove the least recently used
+        entries until it fits into EVICT_TO * max_bytes"""
+        with open(os.path.join(self.cache_dir, LOCK_FILE), 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            if total > self.max_bytes:
+                for _, size, path in sorted(entries):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+                    if total <= self.max_bytes * EVICT_TO:
+                        break
+            self.disk_bytes = total
+            self.puts_since_scan = 0
+
+    def cached(self, kind, data_bytes, options, compute):
+        """the cached result of compute() for the program bytes, options must be
+        JSON serializable and describe everything the result depends on"""
+        key = self.key(kind, data_bytes, options)
+        text = self.get(key)
+        if text is not None:
+            self.hits += 1
+            return text
+        self.misses += 1
+        text = compute()
+        self.put(key, text)
+        return text
+
+
+_caches = {}
+
+
+def get_cache(cache_dir=DEFAULT_CACHE_DIR):
+    """one cache per directory and process, so the memory tier is shared"""
+    cache = _caches.get(cache_dir)
+    if cache is None:
+        cache = _caches[cache_dir] = ListingCache(cache_dir)
+    return cache
+
+
+def cached_listing(data_bytes, detokenize, options, cache_dir=DEFAULT_CACHE_DIR):
+    """the listing that detokenize(data_bytes, outfile) writes, from the cache if possible"""
+    def compute():
+        outfile = io.StringIO()
+        detokenize(data_bytes, outfile)
+        return outfile.getvalue()
+    return get_cache(cache_dir).cached('listing', bytes(data_bytes), options, compute)
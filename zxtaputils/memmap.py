@@ -0,0 +1,186 @@
+import struct
+from bisect import bisect_left
+from .util import BT_PROGRAM, BT_BINARY, BLOCK_TYPES
+
+"""
+memmap.py - Where the blocks of a tape end up in memory, and which of them overlap
+
+Only the headers are read, the data blocks are skipped. Code blocks are placed at
+their start address, programs (with their variables) at PROG. Together with the
+ROM and the system variables they go into an interval index: the regions sorted
+by start address, with the running maximum of the end addresses, so the regions
+at an address range are found with a binary search and a short backwards scan.
+
+Overlaps are found by a sweep over the sorted regions, programs are not checked
+against each other, a program that is loaded replaces the one before it.
+"""
+
+ROM_END = 0x4000
+SYSVARS = 23552
+PROG = 23755
+MEMORY_SIZE = 0x10000
+MAP_CELL = 256  # bytes per character of the map
+MAP_ROW = 64  # characters per row
+REGION_CHARS = '0123456789abcdefghijklmnopqrstuvwxyz'
+OVERLAP_CHAR = '#'
+FREE_CHAR = '.'
+MAX_OVERLAPS = 100  # a tape of blocks that all overlap has n * (n - 1) / 2 of them
+
+
+class Region:
+    """The addresses start to end - 1, filled by a block of a tape or the system"""
+
+    def __init__(self, start, end, kind, name='', blocknum=None):
+        self.start = start
+        self.end = end
+        self.kind = kind
+        self.name = name
+        self.blocknum = blocknum
+        self.char = None
+
+    @property
+    def is_fixed(self):
+        return self.blocknum is None
+
+    def __str__(self):
+        if self.is_fixed:
+            return self.kind
+        return '%s "%s" (block %d)' % (self.kind, self.name, self.blocknum)
+
+
+FIXED_REGIONS = [Region(0, ROM_END, 'ROM'), Region(SYSVARS, PROG, 'System variables')]
+FIXED_REGIONS[0].char = 'R'
+FIXED_REGIONS[1].char = 'S'
+
+
+def header_blocks(infile):
+    """yields (block number, header bytes) of a TAP file, data blocks are skipped"""
+    blocknum = 0
+    while True:
+        length_bytes = infile.read(2)
+        if len(length_bytes) < 2:
+            break
+        length = struct.unpack('<H', length_bytes)[0]
+        if length == 19:
+            block_bytes = infile.read(length)
+            if len(block_bytes) < length:
+                break
+            if block_bytes[0] == 0x00:
+                yield blocknum, block_bytes
+        else:
+            infile.seek(length, 1)
+        blocknum += 1
+
+
+def tape_regions(infile):
+    """the regions the code and program blocks of a tape load into"""
+    regions = []
+    for blocknum, header in header_blocks(infile):
+        block_type = header[1]
+        data_len, param1 = struct.unpack_from('<HH', header, 12)
+        name = header[2:12].decode('latin-1').rstrip()
+        if data_len == 0:
+            continue
+        if block_type == BT_BINARY:
+            start = param1
+        elif block_type == BT_PROGRAM:
+            start = PROG
+        else:
+            continue  # arrays are in the variables area
+        regions.append(Region(start, min(start + data_len, MEMORY_SIZE), BLOCK_TYPES[block_type], name,
+                              blocknum))
+    return regions
+
+
+class IntervalIndex:
+    """Regions sorted by start address, for overlap and range queries"""
+
+    def __init__(self, regions):
+        self.regions = sorted(regions, key=lambda region: (region.start, region.end))
+        self.starts = [region.start for region in self.regions]
+        self.max_ends = []  # the largest end of the regions up to i
+        max_end = 0
+        for region in self.regions:
+            max_end = max(max_end, region.end)
+            self.max_ends.append(max_end)
+
+    def overlapping(self, start, end):
+        """the regions that have addresses in start to end - 1"""
+        result = []
+        i = bisect_left(self.starts, end) - 1
+        while i >= 0 and self.max_ends[i] > start:
+            if self.regions[i].end > start:
+                result.append(self.regions[i])
+            i -= 1
+        result.reverse()
+        return result
+
+    def overlaps(self, limit=None):
+        """(start, end, region, region) of the overlapping pairs (up to limit), programs
+        are not checked against each other and the system regions not against each other"""
+        result = []
+        active = []
+        for region in self.regions:
+            active = [other for other in active if other.end > region.start]
+            for other in active:
+                if (other.kind == region.kind == BLOCK_TYPES[BT_PROGRAM]) or (other.is_fixed and region.is_fixed):
+                    continue
+                result.append((region.start, min(region.end, other.end), other, region))
+                if len(result) == limit:
+                    return result
+            active.append(region)
+        return result
+
+    def gaps(self, start, end):
+        """the (start, end) ranges between start and end that no region covers"""
+        result = []
+        pos = start
+        for region in self.regions:
+            if region.start > pos and pos < end:
+                result.append((pos, min(region.start, end)))
+            pos = max(pos, region.end)
+        if pos < end:
+            result.append((pos, end))
+        return result
+
+
+def memory_map(index, overlap_index, cell=MAP_CELL, row=MAP_ROW):
+    """the 64K as characters, one per cell bytes, with the start address of each row"""
+    lines = []
+    for row_start in range(0, MEMORY_SIZE, cell * row):
+        chars = []
+        for cell_start in range(row_start, row_start + cell * row, cell):
+            regions = index.overlapping(cell_start, cell_start + cell)
+            if len(regions) == 0:
+                chars.append(FREE_CHAR)
+            elif overlap_index.overlapping(cell_start, cell_start + cell):
+                chars.append(OVERLAP_CHAR)
+            else:
+                loaded = [region for region in regions if not region.is_fixed]
+                chars.append((loaded[0] if loaded else regions[0]).char)
+        lines.append('$%04x %s' % (row_start, ''.join(chars)))
+    return lines
+
+
+def memmap_report(infile):
+    """returns (report lines, number of overlaps)"""
+    regions = tape_regions(infile)
+    for num, region in enumerate(regions):
+        region.char = REGION_CHARS[num] if num < len(REGION_CHARS) else '*'
+    index = IntervalIndex(FIXED_REGIONS + regions)
+    overlaps = index.overlaps(MAX_OVERLAPS)
+    overlap_index = IntervalIndex([Region(start, end, 'Overlap') for start, end, _, _ in overlaps])
+    out = []
+    for region in regions:
+        out.append('  %s $%04x-$%04x %5d bytes  %s' % (region.char, region.start, region.end - 1,
+                                                      region.end - region.start, region))
+    for start, end, first, second in overlaps:
+        out.append('  overlap $%04x-$%04x (%d bytes): %s and %s' % (start, end - 1, end - start, first, second))
+    if len(overlaps) == MAX_OVERLAPS:
+        out.append('  (only the first %d overlaps are shown)' % MAX_OVERLAPS)
+    free = ['$%04x-$%04x (%d)' % (start, end - 1, end - start) for start, end in index.gaps(PROG, MEMORY_SIZE)]
+    out.append('  free: %s' % (', '.join(free) if free else 'none'))
+    out.append('  map (%d bytes per character, %s free, %s overlap, R ROM, S system variables):' %
+               (MAP_CELL, FREE_CHAR, OVERLAP_CHAR))
+    out += ['  ' + line for line in memory_map(index, overlap_index)]
+    return out, len(overlaps)
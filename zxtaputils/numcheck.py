@@ -0,0 +1,99 @@
+import re
+import struct
+from .bas2asc import (decode_numbers, number_text, text_value, numbers_match, format_number, is_placeholder,
+                      NUMBER_LENGTH)
+from .tapinfo import program_blocks
+from .archive import input_files
+
+"""
+numcheck.py - Verify the numbers embedded in tokenized BASIC programs
+
+Every number literal in a tokenized program is stored twice: as the characters
+that LIST shows and, after the 0x0e number marker, as the 5 byte value the
+interpreter uses. A program can show "GO TO 10" and jump to line 20, this module
+finds all literals where the two disagree. The parameters of DEF FN also have a
+number marker and 5 bytes (for the argument), but no characters, they are skipped.
+
+The lines are scanned with a regular expression that only stops at quotes,
+number markers and REM, so strings, the 5 byte values and comments are skipped
+without looking at each byte, and all 5 byte values of a program are decoded in a
+single batch.
+"""
+
+NUMBER_MARKER = 0x0e
+REM_TOKEN = 0xea
+QUOTE = 0x22
+SPECIAL_BYTES = re.compile(rb'["\x0e\xea]')
+
+
+class NumberMismatch:
+    """A number literal whose characters do not match its binary value"""
+    def __init__(self, line_number, offset, text, binary_value):
+        self.line_number = line_number
+        self.offset = offset  # offset of the number marker in the program
+        self.text = text      # None if the characters are not a number at all
+        self.binary_value = binary_value
+
+    def __str__(self):
+        text = '"%s"' % self.text if self.text is not None else '<no digits>'
+        return 'line %d: text %s, value %s' % (self.line_number, text, format_number(self.binary_value))
+
+
+def find_numbers(prog_bytes):
+    """Find all number literals in a tokenized program, returns a list of
+    (line number, marker offset, text, is_bin) tuples and the bytes of their 5 byte values"""
+    literals = []
+    value_bytes = []
+    offset = 0
+    end = len(prog_bytes)
+    while offset + 4 <= end:
+        line_number = struct.unpack_from('>H', prog_bytes, offset)[0]  # Big endian
+        num_line_bytes = struct.unpack_from('<H', prog_bytes, offset + 2)[0]
+        start = offset + 4
+        line_end = min(start + num_line_bytes, end)
+        prev_end = start
+        match = SPECIAL_BYTES.search(prog_bytes, start, line_end)
+        while match is not None:
+            pos = match.start()
+            if prog_bytes[pos] == REM_TOKEN:
+                break  # comments can contain anything
+            if prog_bytes[pos] == QUOTE:
+                close_pos = prog_bytes.find(b'"', pos + 1, line_end)
+                if close_pos < 0:
+                    break
+                next_pos = prev_end = close_pos + 1
+            else:
+                next_pos = pos + 1 + NUMBER_LENGTH
+                if next_pos > line_end:
+                    break
+                if not is_placeholder(prog_bytes, pos):  # DEF FN parameters are not literals
+                    text, is_bin = number_text(prog_bytes, pos, prev_end)
+                    literals.append((line_number, pos, text, is_bin))
+                    value_bytes.append(prog_bytes[pos + 1:next_pos])
+                prev_end = next_pos
+            match = SPECIAL_BYTES.search(prog_bytes, next_pos, line_end)
+        offset = start + num_line_bytes
+    return literals, b''.join(value_bytes)
+
+
+def verify_numbers(prog_bytes):
+    """returns a list of NumberMismatch objects for the specified tokenized program"""
+    literals, value_bytes = find_numbers(prog_bytes)
+    values = decode_numbers(value_bytes)
+    result = []
+    for (line_number, pos, text, is_bin), binary_value in zip(literals, values):
+        text_val = text_value(text, is_bin) if text is not None else None
+        if text_val is None or not numbers_match(text_val, binary_value):
+            result.append(NumberMismatch(line_number, pos, text, binary_value))
+    return result
+
+
+def numcheck(args):
+    num_mismatches = 0
+    for path, infile in input_files(args.tapfiles):
+        for blocknum, header, prog_bytes in program_blocks(infile):
+            for mismatch in verify_numbers(prog_bytes):
+                print('%s: block %d, %s' % (path, blocknum, mismatch))
+                num_mismatches += 1
+    print("%d mismatch(es) found." % num_mismatches)
+    return num_mismatches
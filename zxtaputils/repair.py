@@ -0,0 +1,228 @@
+import os
+import struct
+from .util import compute_checksum, BLOCK_TYPES
+from .archive import open_input, expand_paths, split_path
+
+"""
+repair.py - Recover the blocks of damaged TAP files
+
+A TAP file is a chain of (length word, block) pairs, a single damaged length word
+makes every reader lose the rest of the file. The scanner follows the chain as
+long as it is consistent and resynchronizes at the next plausible block start
+when it is not:
+
+  - a block is good if its flag is 0x00 or 0xff, its checksum is right, and headers
+    are 19 bytes with a known block type
+  - a block with a wrong checksum is kept (and reported) if the next block starts
+    right after it or it is the last one in the file, and also if it is the data
+    block after a header with the length that header announces
+  - a data block following a header is expected to be data length + 2 bytes long,
+    if its length word is damaged but the block at that length is good, the
+    length word is repaired
+  - otherwise the bytes are skipped up to the next candidate: the next header
+    (found with bytes.find() for the length 19 + flag 0 pattern, then checked),
+    the next length word + 0xff flag that matches the length expected after the
+    last header, or a 0xff flag whose length word makes the block end where the
+    next header starts
+
+Checksums of long blocks are computed by folding the block as a big integer
+instead of XORing byte by byte.
+"""
+
+HEADER_LENGTH = 19
+HEADER_START = struct.pack('<HB', HEADER_LENGTH, 0x00)
+GOOD, BAD_CHECKSUM, LENGTH_REPAIRED = range(3)
+STATUS_NAMES = ['ok', 'checksum error', 'length word repaired']
+
+
+def xor_fold(data):
+    """the XOR of all bytes of data"""
+    value = int.from_bytes(data, 'little')
+    size = len(data)
+    while size > 1:
+        half = (size + 1) // 2
+        value = (value >> (8 * half)) ^ (value & ((1 << (8 * half)) - 1))
+        size = half
+    return value
+
+
+def header_block_ok(buf, start):
+    """is there a good header block (without length word) at start"""
+    if start + HEADER_LENGTH > len(buf) or buf[start] != 0x00:
+        return False
+    block = buf[start:start + HEADER_LENGTH]
+    return block[1] < len(BLOCK_TYPES) and compute_checksum(block[:-1]) == block[-1]
+
+
+def header_ok(buf, pos):
+    """is there a good header block with its length word at pos"""
+    return buf[pos:pos + 3] == HEADER_START and header_block_ok(buf, pos + 2)
+
+
+def block_ok(buf, pos, length):
+    """is there a good block of the specified length at pos + 2"""
+    if length < 2 or pos + 2 + length > len(buf) or buf[pos + 2] not in (0x00, 0xff):
+        return False
+    if buf[pos + 2] == 0x00 and length == HEADER_LENGTH:
+        return header_ok(buf, pos)
+    return xor_fold(buf[pos + 2:pos + 2 + length]) == 0
+
+
+class RecoveredBlock:
+    def __init__(self, offset, block_bytes, status):
+        self.offset = offset  # of the length word in the damaged file
+        self.block_bytes = block_bytes
+        self.status = status
+
+    def __str__(self):
+        return 'offset %d: %d byte %s block, %s' % (
+            self.offset, len(self.block_bytes), 'header' if self.block_bytes[0] == 0 else 'data',
+            STATUS_NAMES[self.status])
+
+
+class Recovery:
+    """The result of scanning a damaged TAP file: the recovered blocks and what
+    happened on the way"""
+
+    def __init__(self, buf):
+        self.buf = bytes(buf)
+        self.blocks = []
+        self.skipped = []  # (offset, number of bytes)
+        self.truncated = None  # offset of an incomplete last block
+        self.scan()
+
+    def next_header(self, start):
+        pos = self.buf.find(HEADER_START, start)
+        while pos >= 0 and not header_ok(self.buf, pos):
+            pos = self.buf.find(HEADER_START, pos + 1)
+        return pos
+
+    def next_data(self, start, expected):
+        """the next good data block of the expected length"""
+        pattern = struct.pack('<HB', expected, 0xff)
+        pos = self.buf.find(pattern, start)
+        while pos >= 0 and not block_ok(self.buf, pos, expected):
+            pos = self.buf.find(pattern, pos + 1)
+        return pos
+
+    def next_chained(self, start, end):
+        """the next good data block before end that ends where the next header
+        starts or at the end of the file"""
+        buf = self.buf
+        flag = buf.find(b'\xff', start + 2, end + 2)
+        while flag >= 0:
+            pos = flag - 2
+            block_end = flag + struct.unpack_from('<H', buf, pos)[0]
+            if (block_end == len(buf) or header_ok(buf, block_end)) and \
+               block_ok(buf, pos, block_end - flag):
+                return pos
+            flag = buf.find(b'\xff', flag + 1, end + 2)
+        return -1
+
+    def block_at(self, pos, expected):
+        """returns (length, status) of the block at pos, None if there is none"""
+        buf = self.buf
+        length = struct.unpack_from('<H', buf, pos)[0]
+        if block_ok(buf, pos, length):
+            return length, GOOD
+        if expected is not None and expected != length and \
+           pos + 2 < len(buf) and buf[pos + 2] == 0xff and block_ok(buf, pos, expected):
+            return expected, LENGTH_REPAIRED
+        if length != HEADER_LENGTH and header_block_ok(buf, pos + 2):
+            return HEADER_LENGTH, LENGTH_REPAIRED
+        end = pos + 2 + length
+        if length == expected and end <= len(buf) and buf[pos + 2] == 0xff:
+            return length, BAD_CHECKSUM  # the data of the last header, whatever follows it
+        if length >= 2 and buf[pos + 2] in (0x00, 0xff) and \
+           (end == len(buf) or (end + 2 < len(buf) and self.chain_continues(end))):
+            return length, BAD_CHECKSUM
+        return None
+
+    def chain_continues(self, pos):
+        length = struct.unpack_from('<H', self.buf, pos)[0]
+        return block_ok(self.buf, pos, length)
+
+    def scan(self):
+        buf = self.buf
+        pos = 0
+        expected = None  # the data block length announced by the last header
+        while pos + 2 < len(buf):
+            found = self.block_at(pos, expected)
+            if found is not None:
+                length, status = found
+                block_bytes = buf[pos + 2:pos + 2 + length]
+                self.blocks.append(RecoveredBlock(pos, block_bytes, status))
+                expected = None
+                if block_bytes[0] == 0x00 and length == HEADER_LENGTH:
+                    expected = struct.unpack_from('<H', block_bytes, 12)[0] + 2
+                pos += 2 + length
+                continue
+
+            candidates = [p for p in (self.next_header(pos + 1),
+                                      self.next_data(pos + 1, expected) if expected is not None else -1)
+                          if p >= 0]
+            chained = self.next_chained(pos + 1, min(candidates) if candidates else len(buf))
+            if chained >= 0:
+                candidates.append(chained)
+            if len(candidates) == 0:
+                length = struct.unpack_from('<H', buf, pos)[0]
+                if buf[pos + 2] in (0x00, 0xff) and pos + 2 + length > len(buf):
+                    self.truncated = pos
+                else:
+                    self.skipped.append((pos, len(buf) - pos))
+                return
+            next_pos = min(candidates)
+            self.skipped.append((pos, next_pos - pos))
+            pos = next_pos
+        if pos < len(buf):
+            self.skipped.append((pos, len(buf) - pos))
+
+    @property
+    def damaged(self):
+        return len(self.skipped) > 0 or self.truncated is not None or \
+            any(block.status != GOOD for block in self.blocks)
+
+    def tap_bytes(self):
+        return b''.join(struct.pack('<H', len(block.block_bytes)) + block.block_bytes
+                        for block in self.blocks)
+
+    def report(self):
+        events = [(block.offset, str(block)) for block in self.blocks if block.status != GOOD]
+        events += [(offset, 'offset %d: skipped %d bytes' % (offset, num_bytes))
+                   for offset, num_bytes in self.skipped]
+        if self.truncated is not None:
+            events.append((self.truncated, 'offset %d: incomplete last block dropped' % self.truncated))
+        lines = [text for offset, text in sorted(events)]
+        lines.append('%d blocks recovered%s' % (len(self.blocks), '' if self.damaged else ', no damage found'))
+        return '\n'.join(lines)
+
+
+def recover(buf):
+    return Recovery(buf)
+
+
+def repaired_path(path, outdir):
+    name = os.path.basename(split_path(path)[1] or path)
+    base, ext = os.path.splitext(name)
+    return os.path.join(outdir, base + '-repaired' + (ext or '.tap'))
+
+
+def taprepair(args):
+    outdir = args.outdir if args.outdir is not None else '.'
+    num_damaged = 0
+    for path in expand_paths(args.tapfiles):
+        with open_input(path) as infile:
+            recovery = recover(infile.read())
+        print('%s:' % path)
+        print(recovery.report())
+        if recovery.damaged:
+            num_damaged += 1
+            if not args.dryrun:
+                if not os.path.exists(outdir):
+                    os.makedirs(outdir)
+                outpath = repaired_path(path, outdir)
+                with open(outpath, 'wb') as outfile:
+                    outfile.write(recovery.tap_bytes())
+                print("Writing '%s'" % outpath)
+    print("%d damaged file(s)." % num_damaged)
+    return num_damaged
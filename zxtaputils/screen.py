@@ -0,0 +1,141 @@
+import os
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .tapinfo import ZXHeader, block_pairs
+from .util import BT_BINARY
+from .archive import open_input, expand_paths, split_path
+
+"""
+screen.py - Decode SCREEN$ blocks and export them as PNG or PPM images
+
+A screen is a 6912 byte code block loaded to 16384:
+
+  - 6144 bytes bitmap, 32 bytes per pixel line, but the lines are interleaved:
+    the address of pixel line y is made of the bits
+    0 1 0 y7 y6 y2 y1 y0 | y5 y4 y3 x4 x3 x2 x1 x0
+    i.e. the screen is split into 3 thirds of 8 character rows, and within a
+    third, all first pixel lines of the rows come first, then the second lines...
+  - 768 bytes attributes, one per 8x8 character cell:
+    bit 7 flash, bit 6 bright, bits 5-3 paper, bits 2-0 ink
+
+The de-interleaving and the attribute colouring are done with array operations
+on the whole screen.
+"""
+
+SCREEN_ADDR = 16384
+SCREEN_SIZE = 6912
+BITMAP_SIZE = 6144
+WIDTH = 256
+HEIGHT = 192
+
+# black, blue, red, magenta, green, cyan, yellow, white, normal then bright
+PALETTE = np.array([
+    [0x00, 0x00, 0x00], [0x00, 0x00, 0xd7], [0xd7, 0x00, 0x00], [0xd7, 0x00, 0xd7],
+    [0x00, 0xd7, 0x00], [0x00, 0xd7, 0xd7], [0xd7, 0xd7, 0x00], [0xd7, 0xd7, 0xd7],
+    [0x00, 0x00, 0x00], [0x00, 0x00, 0xff], [0xff, 0x00, 0x00], [0xff, 0x00, 0xff],
+    [0x00, 0xff, 0x00], [0x00, 0xff, 0xff], [0xff, 0xff, 0x00], [0xff, 0xff, 0xff]
+], dtype=np.uint8)
+
+
+def is_screen_header(header):
+    return isinstance(header, ZXHeader) and header.block_type == BT_BINARY and \
+        header.data_len == SCREEN_SIZE and header.params[0] == SCREEN_ADDR
+
+
+def screen_to_indices(screen_bytes):
+    """turn the 6912 screen bytes into a 192x256 array of palette indices"""
+    # (third, pixel line, character row, column) -> (third, character row, pixel line, column)
+    bitmap = np.frombuffer(screen_bytes, dtype=np.uint8, count=BITMAP_SIZE).reshape(3, 8, 8, 32)
+    bitmap = bitmap.transpose(0, 2, 1, 3).reshape(HEIGHT, 32)
+    pixels = np.unpackbits(bitmap, axis=1).astype(bool)
+
+    attrs = np.frombuffer(screen_bytes, dtype=np.uint8, count=768, offset=BITMAP_SIZE).reshape(24, 32)
+    bright = (attrs >> 3) & 0x08
+    ink = (attrs & 0x07) | bright
+    paper = ((attrs >> 3) & 0x07) | bright
+    ink = ink.repeat(8, axis=0).repeat(8, axis=1)
+    paper = paper.repeat(8, axis=0).repeat(8, axis=1)
+    return np.where(pixels, ink, paper)
+
+
+def screen_to_rgb(screen_bytes, scale=1, thumbnail=False):
+    """turn the screen bytes into a HEIGHT x WIDTH x 3 RGB array. A thumbnail is half size,
+    every 2x2 pixel square is averaged"""
+    rgb = PALETTE[screen_to_indices(screen_bytes)]
+    if thumbnail:
+        rgb = rgb.reshape(HEIGHT // 2, 2, WIDTH // 2, 2, 3).mean(axis=(1, 3)).astype(np.uint8)
+    if scale > 1:
+        rgb = rgb.repeat(scale, axis=0).repeat(scale, axis=1)
+    return rgb
+
+
+def ppm_bytes(rgb):
+    height, width = rgb.shape[:2]
+    return b'P6\n%d %d\n255\n' % (width, height) + rgb.tobytes()
+
+
+def png_chunk(chunk_type, data):
+    chunk = chunk_type + data
+    return struct.pack('>L', len(data)) + chunk + struct.pack('>L', zlib.crc32(chunk) & 0xffffffff)
+
+
+def png_bytes(rgb):
+    height, width = rgb.shape[:2]
+    # every row is prefixed with filter type 0 (none)
+    rows = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    rows[:, 1:] = rgb.reshape(height, width * 3)
+    header = struct.pack('>LLBBBBB', width, height, 8, 2, 0, 0, 0)  # 8 bit RGB
+    return (b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', header) +
+            png_chunk(b'IDAT', zlib.compress(rows.tobytes(), 9)) + png_chunk(b'IEND', b''))
+
+
+def write_image(rgb, path):
+    with open(path, 'wb') as outfile:
+        if path.lower().endswith('.ppm'):
+            outfile.write(ppm_bytes(rgb))
+        else:
+            outfile.write(png_bytes(rgb))
+
+
+def screen_blocks(infile):
+    """iterate over the screens of a TAP file, yields (block number, header, screen bytes)"""
+    for blocknum, header_block, data_block in block_pairs(infile):
+        if is_screen_header(header_block):
+            yield blocknum, header_block, data_block.data_bytes[1:-1]
+
+
+def render_tap(path, outdir, imgformat='png', scale=1, thumbnail=False):
+    """render all screens of a TAP file, returns the paths of the written images"""
+    basename = os.path.splitext(os.path.basename(split_path(path)[1] or path))[0]
+    result = []
+    with open_input(path) as infile:
+        for blocknum, header, screen_bytes in screen_blocks(infile):
+            if len(screen_bytes) < SCREEN_SIZE:
+                continue
+            outpath = os.path.join(outdir, '%s-%03d.%s' % (basename, blocknum, imgformat))
+            write_image(screen_to_rgb(screen_bytes, scale, thumbnail), outpath)
+            result.append(outpath)
+    return result
+
+
+def tapscreen(args):
+    outdir = args.outdir if args.outdir is not None else '.'
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    paths = list(expand_paths(args.tapfiles))
+    if len(paths) == 1 or args.jobs == 1:
+        results = [render_tap(path, outdir, args.format, args.scale, args.thumbnail)
+                   for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [executor.submit(render_tap, path, outdir, args.format, args.scale, args.thumbnail)
+                       for path in paths]
+            results = [future.result() for future in futures]
+    num_images = 0
+    for path, images in zip(paths, results):
+        for image in images:
+            print("Writing '%s'" % image)
+        num_images += len(images)
+    print("%d screen(s) written." % num_images)
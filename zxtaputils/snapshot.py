@@ -0,0 +1,276 @@
+import re
+import struct
+
+"""
+snapshot.py - Write 48K .sna and .z80 snapshots that contain a BASIC program
+and/or code, so an emulator can start them without loading from tape
+
+The memory is set up like the ROM leaves it after NEW, with the program at PROG
+and the system variables that point behind it (VARS, E_LINE, WORKSP...) adjusted.
+The machine stack sits below RAMTOP:
+
+  RAMTOP     0x3e  end marker of the GO SUB stack
+  RAMTOP-1   0x00
+  RAMTOP-3   0x1303 (MAIN-4), ERR_SP points here, errors and the end of the
+             program return to the editor through it
+
+To run a program, the snapshot starts at STMT-RET (0x1b76), which continues at
+NEWPPC/NSPPC, like GO TO does. Without autostart, it starts at MAIN-4 with
+ERR_NR = 0xff, which prints "0 OK". Code is started by jumping to its address,
+a RET returns to BASIC.
+
+The UDGs are not set up, they are copied from the ROM character set on a real
+machine.
+
+.sna: 27 byte register header, then the 48K, PC is pushed onto the stack
+.z80: version 1, 30 byte header, the 48K is compressed: runs of 5 or more equal
+      bytes (2 or more for 0xed) are stored as ED ED count byte. Runs are found
+      with a regular expression, so the memory is not scanned byte by byte in Python.
+"""
+
+RAM_START = 0x4000
+RAM_SIZE = 0xc000
+ATTRS = 0x5800
+ATTRS_SIZE = 768
+DEFAULT_RAMTOP = 0xff57
+UDG = 0xff58
+
+# system variables
+KSTATE = 23552
+REPDEL = 23561
+REPPER = 23562
+STRMS = 23568
+CHARS = 23606
+RASP = 23608
+ERR_NR = 23610
+FLAGS = 23611
+ERR_SP = 23613
+NEWPPC = 23618
+NSPPC = 23620
+PPC = 23621
+BORDCR = 23624
+VARS = 23627
+CHANS_VAR = 23631
+CURCHL = 23633
+PROG_VAR = 23635
+DATADD = 23639
+E_LINE = 23641
+K_CUR = 23643
+CH_ADD = 23645
+WORKSP = 23649
+STKBOT = 23651
+STKEND = 23653
+MEM = 23656
+DF_SZ = 23659
+UDG_VAR = 23675
+P_POSN = 23679
+PR_CC = 23680
+ECHO_E = 23682
+DF_CC = 23684
+DF_CCL = 23686
+S_POSN = 23688
+SPOSNL = 23690
+SCR_CT = 23692
+ATTR_P = 23693
+ATTR_T = 23695
+MEMBOT = 23698
+RAMTOP = 23730
+P_RAMT = 23732
+CHANS = 23734
+PROG = 23755
+
+STREAMS_INIT = bytes([0x01, 0x00, 0x06, 0x00, 0x0b, 0x00, 0x01, 0x00, 0x01, 0x00, 0x06, 0x00, 0x10, 0x00])
+# keyboard, screen, workspace, printer: output routine, input routine, name
+CHANNELS_INIT = (struct.pack('<HHc', 0x09f4, 0x10a8, b'K') + struct.pack('<HHc', 0x09f4, 0x15c4, b'S') +
+                 struct.pack('<HHc', 0x0f81, 0x15c4, b'R') + struct.pack('<HHc', 0x09f4, 0x15c4, b'P') +
+                 b'\x80')
+
+MAIN_4 = 0x1303
+STMT_RET = 0x1b76
+NO_AUTOSTART = 0x8000
+
+RLE_RUN = re.compile(rb'(.)\1{4,}|\xed\xed+', re.DOTALL)
+
+
+class Snapshot:
+    """A 48K machine with a BASIC program and code blocks in memory"""
+
+    def __init__(self, prog_bytes=b'', autostart=NO_AUTOSTART, border=7):
+        self.prog_bytes = bytes(prog_bytes)
+        self.autostart = autostart
+        self.border = border
+        self.code_blocks = []
+        self.exec_addr = None
+
+    def add_code(self, addr, data_bytes):
+        if addr < RAM_START or addr + len(data_bytes) > 0x10000:
+            raise ValueError("code at %d-%d does not fit into RAM" % (addr, addr + len(data_bytes) - 1))
+        self.code_blocks.append((addr, bytes(data_bytes)))
+
+    @property
+    def basic_end(self):
+        """the first address after E_LINE, the workspace and calculator stack start here"""
+        return PROG + len(self.prog_bytes) + 3
+
+    @property
+    def ramtop(self):
+        """below the lowest code block above the BASIC area, like CLEAR address-1 does"""
+        ramtop = DEFAULT_RAMTOP
+        for addr, data_bytes in self.code_blocks:
+            if addr + len(data_bytes) > PROG and addr <= ramtop:
+                if addr < self.basic_end + 0x100:
+                    raise ValueError("code at %d overlaps the BASIC program" % addr)
+                ramtop = addr - 1
+        return ramtop
+
+    def memory(self):
+        """the 48K RAM as bytearray, index 0 is address 16384"""
+        ram = bytearray(RAM_SIZE)
+
+        def poke(addr, data):
+            ram[addr - RAM_START:addr - RAM_START + len(data)] = data
+
+        def poke_word(addr, value):
+            struct.pack_into('<H', ram, addr - RAM_START, value)
+
+        ramtop = self.ramtop
+        vars_addr = PROG + len(self.prog_bytes)
+        e_line = vars_addr + 1
+        workspace = e_line + 2
+        ram[ATTRS - RAM_START:ATTRS - RAM_START + ATTRS_SIZE] = b'\x38' * ATTRS_SIZE
+
+        poke(KSTATE, b'\xff')
+        poke(KSTATE + 4, b'\xff')
+        poke(REPDEL, b'\x23')
+        poke(REPPER, b'\x05')
+        poke(STRMS, STREAMS_INIT)
+        poke_word(CHARS, 0x3c00)
+        poke(RASP, b'\x40')
+        poke(ERR_NR, b'\xff')
+        poke(FLAGS, b'\xcc')
+        poke_word(ERR_SP, ramtop - 3)
+        poke(BORDCR, bytes([self.border << 3]))
+        poke_word(PPC, 0xfffe)
+        poke_word(VARS, vars_addr)
+        poke_word(CHANS_VAR, CHANS)
+        poke_word(CURCHL, CHANS + 5)
+        poke_word(PROG_VAR, PROG)
+        poke_word(DATADD, PROG - 1)
+        poke_word(E_LINE, e_line)
+        poke_word(K_CUR, e_line)
+        poke_word(CH_ADD, e_line)
+        for var in (WORKSP, STKBOT, STKEND):
+            poke_word(var, workspace)
+        poke_word(MEM, MEMBOT)
+        poke(DF_SZ, b'\x02')
+        poke_word(UDG_VAR, UDG)
+        poke(P_POSN, b'\x21')
+        poke_word(PR_CC, 0x5b00)
+        poke(ECHO_E, b'\x21\x17')
+        poke_word(DF_CC, 0x4000)
+        poke_word(DF_CCL, 0x50e0)
+        poke(S_POSN, b'\x21\x18')
+        poke(SPOSNL, b'\x21\x17')
+        poke(SCR_CT, b'\x01')
+        poke(ATTR_P, b'\x38')
+        poke(ATTR_T, b'\x38')
+        poke_word(RAMTOP, ramtop)
+        poke_word(P_RAMT, 0xffff)
+        poke(CHANS, CHANNELS_INIT)
+
+        poke(PROG, self.prog_bytes)
+        poke(vars_addr, b'\x80')
+        poke(e_line, b'\x0d\x80')
+        if self.autostart < NO_AUTOSTART and len(self.prog_bytes) > 0:
+            poke_word(NEWPPC, self.autostart)
+            poke(NSPPC, b'\x00')
+        else:
+            poke(NSPPC, b'\xff')
+
+        poke(ramtop - 3, struct.pack('<HBB', MAIN_4, 0x00, 0x3e))
+        for addr, data_bytes in self.code_blocks:
+            poke(addr, data_bytes)
+        return ram
+
+    def registers(self):
+        """the CPU state, as a dict"""
+        if self.exec_addr is not None:
+            pc = self.exec_addr
+        elif self.autostart < NO_AUTOSTART and len(self.prog_bytes) > 0:
+            pc = STMT_RET
+        else:
+            pc = MAIN_4
+        return {'af': 0, 'bc': 0, 'de': 0, 'hl': 0, 'ix': 0, 'iy': ERR_NR,
+                'af_': 0, 'bc_': 0, 'de_': 0, 'hl_': 0x2758,
+                'sp': self.ramtop - 3, 'pc': pc, 'i': 0x3f, 'r': 0, 'iff': 1, 'im': 1}
+
+    def sna_bytes(self):
+        ram = self.memory()
+        regs = self.registers()
+        sp = regs['sp'] - 2  # RETN pops the PC
+        struct.pack_into('<H', ram, sp - RAM_START, regs['pc'])
+        header = struct.pack('<BHHHHHHHHHBBHHBB', regs['i'], regs['hl_'], regs['de_'], regs['bc_'],
+                             regs['af_'], regs['hl'], regs['de'], regs['bc'], regs['iy'], regs['ix'],
+                             regs['iff'] << 2, regs['r'], regs['af'], sp, regs['im'], self.border)
+        return header + bytes(ram)
+
+    def z80_bytes(self):
+        regs = self.registers()
+        flags = ((regs['r'] >> 7) & 0x01) | (self.border << 1) | 0x20  # compressed
+        header = struct.pack('<BBHHHHBBBHHHHBBHHBBB',
+                             regs['af'] >> 8, regs['af'] & 0xff, regs['bc'], regs['hl'],
+                             regs['pc'], regs['sp'], regs['i'], regs['r'] & 0x7f, flags,
+                             regs['de'], regs['bc_'], regs['de_'], regs['hl_'],
+                             regs['af_'] >> 8, regs['af_'] & 0xff, regs['iy'], regs['ix'],
+                             regs['iff'], regs['iff'], regs['im'])
+        return header + rle_encode(self.memory()) + b'\x00\xed\xed\x00'
+
+
+def rle_encode(data):
+    """the .z80 compression: ED ED count byte for runs, the byte after a single ED is
+    never the start of a run"""
+    data = bytes(data)
+    out = bytearray()
+    pos = 0
+    literal_ed = False  # the last byte written is an uncompressed ED
+    for match in RLE_RUN.finditer(data):
+        start, end = match.span()
+        if start > pos:
+            out += data[pos:start]
+            literal_ed = data[start - 1] == 0xed
+        if literal_ed:
+            out.append(data[start])
+            start += 1
+        value = data[start]
+        min_run = 2 if value == 0xed else 5
+        while end - start >= min_run:
+            count = min(end - start, 0xff)
+            out += bytes((0xed, 0xed, count, value))
+            start += count
+        out += data[start:end]
+        literal_ed = start < end and value == 0xed
+        pos = end
+    out += data[pos:]
+    return bytes(out)
+
+
+def rle_decode(comp_bytes):
+    """decompress .z80 version 1 data (without the end marker), mainly for verification"""
+    out = bytearray()
+    pos = 0
+    while pos < len(comp_bytes):
+        if comp_bytes[pos] == 0xed and comp_bytes[pos + 1:pos + 2] == b'\xed':
+            out += bytes([comp_bytes[pos + 3]]) * comp_bytes[pos + 2]
+            pos += 4
+        else:
+            out.append(comp_bytes[pos])
+            pos += 1
+    return bytes(out)
+
+
+def write_snapshot(path, snapshot, snapformat):
+    with open(path, 'wb') as outfile:
+        if snapformat == 'sna':
+            outfile.write(snapshot.sna_bytes())
+        else:
+            outfile.write(snapshot.z80_bytes())
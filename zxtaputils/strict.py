@@ -0,0 +1,121 @@
+import io
+import struct
+from .util import TapFormatError
+from .tapinfo import zxheader_from_bytes, ZXData, HEADER_LENGTH
+from .bas2asc import detokenize_line, MAX_LINE_NUMBER
+
+"""
+strict.py - Parsing with limits, for files that can't be trusted
+
+The normal readers trust every length word and line length. In strict mode:
+
+  - at most max_file_size bytes are read, a larger file is rejected before its
+    contents are looked at
+  - all length words are checked against the file size before a block is
+    parsed: every block must have a flag byte and a checksum and end inside the
+    file, there can be at most max_blocks blocks
+  - header blocks must have 19 bytes, a known block type and an ASCII file name
+  - programs are detokenized only if every line header and line fits into the
+    program, with at most max_lines lines and max_output characters of listing
+
+Every problem raises TapFormatError (a ValueError) with the offset and block number,
+tools print it instead of a traceback.
+"""
+
+
+class Limits:
+    """The limits of strict parsing"""
+
+    def __init__(self, max_file_size=16 * 1024 * 1024, max_blocks=10000, max_lines=MAX_LINE_NUMBER + 1,
+                 max_output=4 * 1024 * 1024):
+        self.max_file_size = max_file_size
+        self.max_blocks = max_blocks
+        self.max_lines = max_lines
+        self.max_output = max_output
+
+
+DEFAULT_LIMITS = Limits()
+
+
+def read_limited(infile, limits=DEFAULT_LIMITS):
+    """the contents of infile, TapFormatError if it is larger than max_file_size"""
+    buf = infile.read(limits.max_file_size + 1)
+    if len(buf) > limits.max_file_size:
+        raise TapFormatError("file is larger than %d bytes" % limits.max_file_size)
+    return buf
+
+
+def validate_tap(buf, limits=DEFAULT_LIMITS):
+    """check the chain of length words, returns the (offset, length) of all blocks"""
+    blocks = []
+    pos = 0
+    while pos < len(buf):
+        if len(blocks) == limits.max_blocks:
+            raise TapFormatError("more than %d blocks" % limits.max_blocks, pos, len(blocks))
+        if pos + 2 > len(buf):
+            raise TapFormatError("incomplete length word at the end of the file", pos, len(blocks))
+        length = struct.unpack_from('<H', buf, pos)[0]
+        if length < 2:
+            raise TapFormatError("block of %d bytes has no room for flag and checksum" % length,
+                                 pos, len(blocks))
+        if pos + 2 + length > len(buf):
+            raise TapFormatError("block of %d bytes ends %d bytes after the end of the file" %
+                                 (length, pos + 2 + length - len(buf)), pos, len(blocks))
+        blocks.append((pos, length))
+        pos += 2 + length
+    return blocks
+
+
+def strict_blocks(infile, limits=DEFAULT_LIMITS):
+    """like tapinfo.next_tap_block() in a loop, but the whole file is validated first"""
+    buf = read_limited(infile, limits)
+    for num, (offset, length) in enumerate(validate_tap(buf, limits)):
+        block_bytes = buf[offset + 2:offset + 2 + length]
+        if block_bytes[0] == 0x00:
+            if length != HEADER_LENGTH:
+                raise TapFormatError("header block has %d bytes instead of %d" % (length, HEADER_LENGTH),
+                                     offset, num)
+            try:
+                yield zxheader_from_bytes(block_bytes, strict=True)
+            except TapFormatError as error:
+                raise TapFormatError(error.message, offset, num)
+        else:
+            yield ZXData(block_bytes)
+
+
+def strict_lines(data_bytes, limits=DEFAULT_LIMITS, show_numbers=False, first=0, last=MAX_LINE_NUMBER):
+    """generates the detokenized lines first to last of a program, every line of the
+    program is checked, also the ones that are not listed"""
+    offset = 0
+    num_lines = 0
+    output_size = 0
+    end = len(data_bytes)
+    while offset < end:
+        if offset + 4 > end:
+            raise TapFormatError("incomplete line header", offset)
+        line_number = struct.unpack_from(">H", data_bytes, offset)[0]
+        if line_number > MAX_LINE_NUMBER:
+            raise TapFormatError("line number %d is out of range" % line_number, offset)
+        num_line_bytes = struct.unpack_from("<H", data_bytes, offset + 2)[0]
+        if offset + 4 + num_line_bytes > end:
+            raise TapFormatError("line %d is %d bytes longer than the program" %
+                                 (line_number, offset + 4 + num_line_bytes - end), offset)
+        num_lines += 1
+        if num_lines > limits.max_lines:
+            raise TapFormatError("more than %d lines" % limits.max_lines, offset)
+        if first <= line_number <= last:
+            outline = detokenize_line(data_bytes[offset + 4:offset + 4 + num_line_bytes], line_number,
+                                      show_numbers)
+            output_size += len(outline)
+            if output_size > limits.max_output:
+                raise TapFormatError("listing is longer than %d characters" % limits.max_output, offset)
+            yield outline
+        offset += num_line_bytes + 4
+
+
+def strict_listing(data_bytes, limits=DEFAULT_LIMITS, show_numbers=False, first=0, last=MAX_LINE_NUMBER):
+    """the listing of the lines first to last, nothing of it if the program is not valid"""
+    outfile = io.StringIO()
+    for outline in strict_lines(data_bytes, limits, show_numbers, first, last):
+        outfile.write(outline)
+    return outfile.getvalue()
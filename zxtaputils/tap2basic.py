@@ -1,22 +1,64 @@
-from .bas2asc import detokenize_bytes
-from .tapinfo import next_tap_block
+from .bas2asc import detokenize_bytes, detokenize_range, parse_line_range, MAX_LINE_NUMBER
+from .tapinfo import next_tap_block, ZXHeader
+from .util import BT_PROGRAM, TapFormatError
+from .archive import open_input
 
 """
 tap2basic.py - Extracts the BASIC code from the specified block in the TAP file
 """
 
+def detokenize_uncached(data_bytes, args, outfile=None):
+    if args.lines is not None:
+        first, last = parse_line_range(args.lines)
+        detokenize_range(data_bytes, first, last, outfile, args.numbers)
+    else:
+        detokenize_bytes(data_bytes, outfile, args.numbers)
+
+
+def detokenize_strict(data_bytes, args, outfile=None):
+    """the whole program is checked before anything is written"""
+    from .strict import strict_listing
+    first, last = parse_line_range(args.lines) if args.lines is not None else (0, MAX_LINE_NUMBER)
+    listing = strict_listing(data_bytes, show_numbers=args.numbers, first=first, last=last)
+    if outfile is None:
+        print(listing, end="")
+    else:
+        outfile.write(listing)
+
+
+def detokenize(data_bytes, args, outfile=None):
+    strict = getattr(args, 'strict', False)
+    detokenize_with = detokenize_strict if strict else detokenize_uncached
+    cache_dir = getattr(args, 'cache', None)
+    if cache_dir is None:
+        detokenize_with(data_bytes, args, outfile)
+        return
+    from .listcache import cached_listing
+    listing = cached_listing(data_bytes, lambda data, out: detokenize_with(data, args, out),
+                             {'lines': args.lines, 'numbers': args.numbers, 'strict': strict}, cache_dir)
+    if outfile is None:
+        print(listing, end="")
+    else:
+        outfile.write(listing)
+
+
 def tap2basic(args):
     blocknum = 0
-    with open(args.infile, "rb") as infile:
+    strict = getattr(args, 'strict', False)
+    with open_input(args.infile) as infile:
+        if strict:
+            from .strict import strict_blocks
+            blocks = strict_blocks(infile)
+        else:
+            blocks = iter(lambda: next_tap_block(infile), None)
         while True:
-            header_block = next_tap_block(infile)
-            if header_block is None:
-                print("Could not find block %d" % args.blocknum)
-                break
-            data_block = next_tap_block(infile)
+            header_block = next(blocks, None)
+            data_block = next(blocks, None) if header_block is not None else None
             if data_block is None:
+                if strict:
+                    raise TapFormatError("there is no block %d" % args.blocknum)
                 print("Could not find block %d" % args.blocknum)
-                break
+                return
             if blocknum == args.blocknum:
                 break
             blocknum += 1
@@ -30,8 +72,11 @@ def tap2basic(args):
                         outfile.write(data_block.data_bytes[1:-1])
             else:
                 # block found, now parse the BASIC data, remember the block still has flag and checksum,
+                prog_bytes = data_block.data_bytes[1:-1]
+                if strict and isinstance(header_block, ZXHeader) and header_block.block_type == BT_PROGRAM:
+                    prog_bytes = prog_bytes[:header_block.params[1]]  # without the variables
                 if args.outfile is not None:
                     with open(args.outfile, "w") as outfile:
-                        detokenize_bytes(data_block.data_bytes[1:-1], outfile)
+                        detokenize(prog_bytes, args, outfile)
                 else:
-                    detokenize_bytes(data_block.data_bytes[1:-1])
+                    detokenize(prog_bytes, args)
@@ -0,0 +1,294 @@
+import difflib
+import hashlib
+import re
+import struct
+from .util import BT_PROGRAM, BT_BINARY, BLOCK_TYPES
+from .bas2asc import BasicProgram
+from .archive import open_input
+
+"""
+tapdiff.py - Compare two TAP files block by block
+
+Every block is reduced to a key, a digest of its bytes (for headers that is all
+header fields), and the two key sequences are aligned with Myers' O(ND) diff in
+its linear space form (find the middle snake, recurse on both sides), so blocks
+that are the same on both sides are never compared byte by byte. Blocks that
+only occur in one file are left out before aligning, and the search gives up on
+the shortest alignment after MAX_COST edits, so tapes with thousands of blocks
+are compared in well under a second.
+
+Blocks that were replaced by a block of the same kind are shown in detail:
+
+  - headers: the fields that differ
+  - programs: a line diff of the detokenized listings
+  - everything else: the byte ranges that differ, found by XORing both blocks as
+    integers and searching the non-zero bytes with a regular expression
+"""
+
+HEADER_LENGTH = 19
+RANGE_GAP = 4  # differences closer than this are reported as one range
+DIFF_RANGE = re.compile(rb'[^\x00]+(?:\x00{1,%d}[^\x00]+)*' % (RANGE_GAP - 1))
+MAX_RANGES = 10
+MAX_COST = 200  # edit distance at which the alignment stops looking for the optimum
+
+
+class TapBlock:
+    """A block of a TAP file with the header it belongs to (if any)"""
+
+    def __init__(self, index, block_bytes, header=None):
+        self.index = index
+        self.block_bytes = block_bytes
+        self.header = header
+        self.key = hashlib.blake2b(block_bytes, digest_size=16).digest()
+
+    @property
+    def is_header(self):
+        return len(self.block_bytes) == HEADER_LENGTH and self.block_bytes[0] == 0x00
+
+    @property
+    def payload(self):
+        return self.block_bytes[1:-1]
+
+    def header_fields(self):
+        block_type = self.block_bytes[1]
+        data_len, param1, param2 = struct.unpack_from('<HHH', self.block_bytes, 12)
+        return {'type': BLOCK_TYPES[block_type] if block_type < len(BLOCK_TYPES) else str(block_type),
+                'name': self.block_bytes[2:12].decode('latin-1').rstrip(),
+                'length': data_len, 'param1': param1, 'param2': param2}
+
+    def describe(self):
+        if self.is_header:
+            fields = self.header_fields()
+            return 'header %s "%s", %d bytes' % (fields['type'], fields['name'], fields['length'])
+        if self.header is not None:
+            fields = self.header.header_fields()
+            return 'data of %s "%s", %d bytes' % (fields['type'], fields['name'], len(self.payload))
+        return 'data, %d bytes (flag %d)' % (len(self.payload), self.block_bytes[0])
+
+
+def read_blocks(infile):
+    """read all blocks of a TAP file, data blocks know the header in front of them"""
+    buf = infile.read()
+    blocks = []
+    pos = 0
+    while pos + 2 <= len(buf):
+        length = struct.unpack_from('<H', buf, pos)[0]
+        block_bytes = buf[pos + 2:pos + 2 + length]
+        if len(block_bytes) == 0:
+            break
+        prev = blocks[-1] if blocks else None
+        header = prev if prev is not None and prev.is_header else None
+        blocks.append(TapBlock(len(blocks), block_bytes, header))
+        pos += 2 + length
+    return blocks
+
+
+def middle_snake(a, alo, ahi, b, blo, bhi):
+    """returns (d, x, y, u, v): the length of the shortest edit script and the middle
+    snake from (x, y) to (u, v), relative to alo and blo"""
+    n = ahi - alo
+    m = bhi - blo
+    delta = n - m
+    odd = delta & 1
+    max_d = (n + m + 1) // 2
+    offset = max_d + 1
+    forward = [0] * (2 * offset + 1)
+    backward = [0] * (2 * offset + 1)
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and forward[offset + k - 1] < forward[offset + k + 1]):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            if odd and -(d - 1) <= delta - k <= d - 1 and x + backward[offset + delta - k] >= n:
+                return 2 * d - 1, x0, y0, x, y
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and backward[offset + k - 1] < backward[offset + k + 1]):
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[ahi - 1 - x] == b[bhi - 1 - y]:
+                x += 1
+                y += 1
+            backward[offset + k] = x
+            if not odd and -d <= delta - k <= d and x + forward[offset + delta - k] >= n:
+                return 2 * d, n - x, m - y, n - x0, m - y0
+        if d >= MAX_COST:
+            # too expensive (many equal blocks in a different order), split at the
+            # end of the forward path that got furthest, the result is still a
+            # valid alignment, just not always the shortest one
+            _, x, y = max((2 * forward[offset + k] - k, forward[offset + k], forward[offset + k] - k)
+                          for k in range(-d, d + 1, 2)
+                          if forward[offset + k] <= n and 0 <= forward[offset + k] - k <= m)
+            return 2 * d, x, y, x, y
+    raise AssertionError("no middle snake")
+
+
+def common_pairs(a, b):
+    """the index pairs (i, j) with a[i] == b[j] of a longest common subsequence"""
+    # blocks that only occur on one side can never match, leaving them out keeps
+    # D small for tapes that have little in common
+    shared = set(a) & set(b)
+    a_index = [i for i, key in enumerate(a) if key in shared]
+    b_index = [j for j, key in enumerate(b) if key in shared]
+    a = [a[i] for i in a_index]
+    b = [b[j] for j in b_index]
+    pairs = []
+
+    def diff(alo, ahi, blo, bhi):
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:  # common prefix
+            pairs.append((alo, blo))
+            alo += 1
+            blo += 1
+        suffix = []
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            suffix.append((ahi, bhi))
+        if alo < ahi and blo < bhi:
+            d, x, y, u, v = middle_snake(a, alo, ahi, b, blo, bhi)
+            if d > 1:
+                diff(alo, alo + x, blo, blo + y)
+                pairs.extend((alo + i, blo + y + i - x) for i in range(x, u))
+                diff(alo + u, ahi, blo + v, bhi)
+            else:  # a single insertion or deletion, the rest is equal
+                i, j = alo, blo
+                while i < ahi and j < bhi:
+                    if a[i] == b[j]:
+                        pairs.append((i, j))
+                        i += 1
+                        j += 1
+                    elif ahi - alo > bhi - blo:
+                        i += 1
+                    else:
+                        j += 1
+        pairs.extend(reversed(suffix))
+
+    diff(0, len(a), 0, len(b))
+    return [(a_index[i], b_index[j]) for i, j in pairs]
+
+
+def opcodes(a, b):
+    """like difflib.SequenceMatcher.get_opcodes(), from the Myers alignment"""
+    result = []
+    i = j = 0
+    for ai, bj in common_pairs(a, b) + [(len(a), len(b))]:
+        if ai > i and bj > j:
+            result.append(('replace', i, ai, j, bj))
+        elif ai > i:
+            result.append(('delete', i, ai, j, bj))
+        elif bj > j:
+            result.append(('insert', i, ai, j, bj))
+        if ai < len(a):
+            if result and result[-1][0] == 'equal' and result[-1][2] == ai:
+                result[-1] = ('equal', result[-1][1], ai + 1, result[-1][3], bj + 1)
+            else:
+                result.append(('equal', ai, ai + 1, bj, bj + 1))
+        i, j = ai + 1, bj + 1
+    return result
+
+
+def byte_ranges(a, b):
+    """the (start, end) ranges of the common length in which a and b differ"""
+    n = min(len(a), len(b))
+    mask = (int.from_bytes(a[:n], 'little') ^ int.from_bytes(b[:n], 'little')).to_bytes(n, 'little')
+    return [match.span() for match in DIFF_RANGE.finditer(mask)]
+
+
+def header_diff(old, new):
+    old_fields = old.header_fields()
+    new_fields = new.header_fields()
+    return ['    %s: %s -> %s' % (name, old_fields[name], new_fields[name])
+            for name in ('type', 'name', 'length', 'param1', 'param2') if old_fields[name] != new_fields[name]]
+
+
+def program_lines(block):
+    prog_len = block.header.header_fields()['param2']
+    return [line.rstrip('\n') for line in BasicProgram(block.payload[:prog_len]).lines()]
+
+
+def program_diff(old, new, context):
+    lines = difflib.unified_diff(program_lines(old), program_lines(new), lineterm='', n=context)
+    return ['    ' + line for line in lines if not line.startswith('---') and not line.startswith('+++')]
+
+
+def data_diff(old, new):
+    old_bytes, new_bytes = old.payload, new.payload
+    origin = 0
+    if new.header is not None and new.header.block_bytes[1] == BT_BINARY:
+        origin = new.header.header_fields()['param1']
+    out = []
+    if len(old_bytes) != len(new_bytes):
+        out.append('    length: %d -> %d' % (len(old_bytes), len(new_bytes)))
+    ranges = byte_ranges(old_bytes, new_bytes)
+    num_bytes = sum(end - start for start, end in ranges)
+    if ranges:
+        out.append('    %d byte(s) differ in %d range(s)%s:' % (
+            num_bytes, len(ranges), ' (addresses)' if origin else ' (offsets)'))
+    for start, end in ranges[:MAX_RANGES]:
+        out.append('      %d-%d' % (origin + start, origin + end - 1) if end - start > 1 else
+                   '      %d' % (origin + start))
+    if len(ranges) > MAX_RANGES:
+        out.append('      ...')
+    return out
+
+
+def is_program(block):
+    return block.header is not None and block.header.block_bytes[1] == BT_PROGRAM
+
+
+def changed_block(old, new, context):
+    """the lines describing how old became new"""
+    out = ['~ block %d -> %d: %s' % (old.index, new.index, new.describe())]
+    if old.is_header and new.is_header:
+        out += header_diff(old, new)
+    elif is_program(old) and is_program(new):
+        out += program_diff(old, new, context)
+    else:
+        out += data_diff(old, new)
+    return out
+
+
+def diff_blocks(old_blocks, new_blocks, context=3):
+    """returns the lines of the diff, an empty list if the files have the same blocks"""
+    keys = {}
+    a = [keys.setdefault(block.key, len(keys)) for block in old_blocks]
+    b = [keys.setdefault(block.key, len(keys)) for block in new_blocks]
+    codes = opcodes(a, b)
+    if all(tag == 'equal' for tag, _, _, _, _ in codes):
+        return []
+    out = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal':
+            out.append('  blocks %d-%d = %d-%d (%d identical)' % (i1, i2 - 1, j1, j2 - 1, i2 - i1))
+            continue
+        old, new = old_blocks[i1:i2], new_blocks[j1:j2]
+        # pair up blocks of the same kind, the rest was deleted or inserted
+        while old and new and old[0].is_header == new[0].is_header:
+            out += changed_block(old.pop(0), new.pop(0), context)
+        out += ['- block %d: %s' % (block.index, block.describe()) for block in old]
+        out += ['+ block %d: %s' % (block.index, block.describe()) for block in new]
+    return out
+
+
+def tapdiff(args):
+    with open_input(args.oldfile) as infile:
+        old_blocks = read_blocks(infile)
+    with open_input(args.newfile) as infile:
+        new_blocks = read_blocks(infile)
+    lines = diff_blocks(old_blocks, new_blocks, args.context)
+    if len(lines) == 0:
+        print("The files contain the same blocks.")
+        return False
+    print('--- %s (%d blocks)' % (args.oldfile, len(old_blocks)))
+    print('+++ %s (%d blocks)' % (args.newfile, len(new_blocks)))
+    print('\n'.join(lines))
+    return True
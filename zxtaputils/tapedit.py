@@ -0,0 +1,283 @@
+import mmap
+import os
+import shutil
+import struct
+from .util import BLOCK_TYPES
+from .repair import xor_fold
+from .archive import open_input
+
+"""
+tapedit.py - Edit the blocks of a TAP file without rebuilding it
+
+Blocks are numbered from 0 like in tapdiff, headers and data blocks count
+separately. Only the length words are read to index the file, an edit is a list
+of blocks that are either ranges of the original file (maybe with patched bytes)
+or new blocks, so block contents are only read when they are changed.
+
+Saving:
+
+  - if the blocks are still the original ones in the original order (rename,
+    patch), the changed bytes are written into the file through an mmap
+  - otherwise a new file is written next to the output and moved over it with
+    os.replace(). Runs of unchanged blocks are copied with os.copy_file_range(),
+    so their bytes don't pass through Python, read()/write() is the fallback where
+    it is not available
+
+A rename only changes the name and the checksum of the header. A patch of a data
+block updates its checksum from the old checksum and the replaced bytes, the rest
+of the block is not read.
+"""
+
+COPY_CHUNK = 1024 * 1024
+
+
+class Block:
+    """A block of the edited tape: size bytes at offset in the original file, or data"""
+
+    def __init__(self, offset=None, size=0, data=None):
+        self.offset = offset  # of the length word, None for new blocks
+        self.size = size  # without the length word
+        self.data = data  # flag byte to checksum of new blocks
+        self.patches = []  # (position in the block, bytes) of original blocks
+
+    @property
+    def is_original(self):
+        return self.data is None
+
+
+def tap_blocks(buf):
+    """the blocks of a TAP file in buf, as new blocks"""
+    blocks = []
+    pos = 0
+    while pos + 2 <= len(buf):
+        length = struct.unpack_from('<H', buf, pos)[0]
+        if pos + 2 + length > len(buf):
+            raise ValueError("incomplete block at offset %d" % pos)
+        blocks.append(Block(data=bytes(buf[pos + 2:pos + 2 + length]), size=length))
+        pos += 2 + length
+    return blocks
+
+
+def write_all(dst, data):
+    """write() of the unbuffered dst can write less than it was given"""
+    view = memoryview(data)
+    while len(view) > 0:
+        view = view[dst.write(view):]
+
+
+def copy_range(src, dst, offset, count):
+    """copy count bytes at offset in src to the current position of the unbuffered dst"""
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while count > 0:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), count, offset)
+                if copied == 0:
+                    break
+                offset += copied
+                count -= copied
+        except OSError:  # not supported for these files, copy the rest by hand
+            pass
+    src.seek(offset)
+    while count > 0:
+        chunk = src.read(min(count, COPY_CHUNK))
+        if len(chunk) == 0:
+            raise ValueError("the file got shorter while editing")
+        write_all(dst, chunk)
+        count -= len(chunk)
+
+
+class TapEditor:
+    """The blocks of a TAP file and the changes made to them"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file_size = os.path.getsize(path)
+        self.blocks = []
+        with open(path, 'rb') as infile:
+            if self.file_size == 0:
+                return
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                pos = 0
+                while pos + 2 <= self.file_size:
+                    length = struct.unpack_from('<H', buf, pos)[0]
+                    if pos + 2 + length > self.file_size:
+                        raise ValueError("incomplete block at offset %d, run taprepair first" % pos)
+                    self.blocks.append(Block(pos, length))
+                    pos += 2 + length
+                if pos != self.file_size:
+                    raise ValueError("%d extra byte(s) at the end of the file" % (self.file_size - pos))
+
+    def block(self, num):
+        if num < 0 or num >= len(self.blocks):
+            raise ValueError("there is no block %d, the tape has %d blocks" % (num, len(self.blocks)))
+        return self.blocks[num]
+
+    def read(self, block, start, end):
+        """the current bytes start to end of the block, patches applied"""
+        if not block.is_original:
+            return block.data[start:end]
+        with open(self.path, 'rb') as infile:
+            infile.seek(block.offset + 2 + start)
+            result = bytearray(infile.read(end - start))
+        for pos, patch in block.patches:
+            lo, hi = max(pos, start), min(pos + len(patch), end)
+            if lo < hi:
+                result[lo - start:hi - start] = patch[lo - pos:hi - pos]
+        return bytes(result)
+
+    def write(self, block, pos, data):
+        if block.is_original:
+            block.patches.append((pos, bytes(data)))
+        else:
+            block.data = block.data[:pos] + bytes(data) + block.data[pos + len(data):]
+
+    def describe(self, num):
+        block = self.block(num)
+        if block.size == 19 and self.read(block, 0, 1) == b'\x00':
+            header = self.read(block, 0, 19)
+            block_type = BLOCK_TYPES[header[1]] if header[1] < len(BLOCK_TYPES) else str(header[1])
+            return '%d: header %s "%s"' % (num, block_type, header[2:12].decode('latin-1').rstrip())
+        return '%d: data, %d bytes' % (num, block.size - 2)
+
+    def rename(self, num, name):
+        """replace the 10 bytes of the file name, the rest of the header is kept"""
+        block = self.block(num)
+        if block.size != 19 or self.read(block, 0, 1) != b'\x00':
+            raise ValueError("block %d is not a header" % num)
+        try:
+            name_bytes = name.encode('ascii')
+        except UnicodeEncodeError:
+            raise ValueError('"%s" is not an ASCII file name' % name)
+        if len(name_bytes) > 10:
+            raise ValueError('"%s" is longer than 10 characters' % name)
+        name_bytes = name_bytes.ljust(10, b' ')
+        checksum = self.read(block, 18, 19)[0] ^ xor_fold(self.read(block, 2, 12)) ^ xor_fold(name_bytes)
+        self.write(block, 2, name_bytes)
+        self.write(block, 18, bytes([checksum]))
+
+    def patch(self, num, offset, data):
+        """overwrite data bytes of a block, offset 0 is the byte after the flag"""
+        block = self.block(num)
+        start = offset + 1
+        if offset < 0 or start + len(data) > block.size - 1:
+            raise ValueError("%d bytes at offset %d do not fit into the %d data bytes of block %d" %
+                             (len(data), offset, block.size - 2, num))
+        checksum = self.read(block, block.size - 1, block.size)[0]
+        checksum ^= xor_fold(self.read(block, start, start + len(data))) ^ xor_fold(data)
+        self.write(block, start, data)
+        self.write(block, block.size - 1, bytes([checksum]))
+
+    def delete(self, num):
+        self.block(num)
+        del self.blocks[num]
+
+    def insert(self, num, blocks):
+        if num < 0 or num > len(self.blocks):
+            raise ValueError("can't insert at %d, the tape has %d blocks" % (num, len(self.blocks)))
+        self.blocks[num:num] = blocks
+
+    def append(self, blocks):
+        self.blocks.extend(blocks)
+
+    def move(self, num, to):
+        block = self.block(num)
+        del self.blocks[num]
+        self.insert(to, [block])
+
+    @property
+    def layout_unchanged(self):
+        """are the blocks still the original ones at their original offsets"""
+        pos = 0
+        for block in self.blocks:
+            if not block.is_original or block.offset != pos:
+                return False
+            pos += 2 + block.size
+        return pos == self.file_size
+
+    def patch_in_place(self):
+        patches = [(block.offset + 2 + pos, patch) for block in self.blocks for pos, patch in block.patches]
+        if len(patches) == 0:
+            return
+        with open(self.path, 'r+b') as outfile:
+            with mmap.mmap(outfile.fileno(), 0) as buf:
+                for pos, patch in patches:
+                    buf[pos:pos + len(patch)] = patch
+                buf.flush()
+
+    def write_file(self, outpath):
+        tmp_path = '%s.%d.tmp' % (outpath, os.getpid())
+        try:
+            with open(self.path, 'rb') as src, open(tmp_path, 'wb', buffering=0) as dst:
+                run_start = run_end = None  # unchanged original bytes not written yet
+                for block in self.blocks:
+                    if block.is_original and len(block.patches) == 0:
+                        if block.offset != run_end:
+                            if run_start is not None:
+                                copy_range(src, dst, run_start, run_end - run_start)
+                            run_start = block.offset
+                        run_end = block.offset + 2 + block.size
+                        continue
+                    if run_start is not None:
+                        copy_range(src, dst, run_start, run_end - run_start)
+                        run_start = run_end = None
+                    write_all(dst, struct.pack('<H', block.size) + self.read(block, 0, block.size))
+                if run_start is not None:
+                    copy_range(src, dst, run_start, run_end - run_start)
+                os.fsync(dst.fileno())
+            if os.path.exists(outpath):
+                shutil.copymode(outpath, tmp_path)
+            os.replace(tmp_path, outpath)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def save(self, outpath=None):
+        """write the result to outpath (default: the edited file), returns True if the
+        file was patched in place"""
+        if outpath is None or os.path.abspath(outpath) == os.path.abspath(self.path):
+            if self.layout_unchanged:
+                self.patch_in_place()
+                return True
+            outpath = self.path
+        self.write_file(outpath)
+        return False
+
+
+def read_tap_file(path):
+    with open_input(path) as infile:
+        return tap_blocks(infile.read())
+
+
+def read_data_file(path):
+    with open(path, 'rb') as infile:
+        return infile.read()
+
+
+def apply_operation(editor, operation, values):
+    if operation == 'rename':
+        editor.rename(int(values[0]), values[1])
+    elif operation == 'delete':
+        editor.delete(int(values[0]))
+    elif operation == 'insert':
+        editor.insert(int(values[0]), read_tap_file(values[1]))
+    elif operation == 'append':
+        editor.append(read_tap_file(values[0]))
+    elif operation == 'move':
+        editor.move(int(values[0]), int(values[1]))
+    elif operation == 'patch':
+        editor.patch(int(values[0]), int(values[1], 0), read_data_file(values[2]))
+
+
+def tapedit(args):
+    editor = TapEditor(args.tapfile)
+    for operation, values in args.operations:
+        apply_operation(editor, operation, values)
+    if args.operations:
+        outpath = args.outfile if args.outfile is not None else args.tapfile
+        in_place = editor.save(args.outfile)
+        print("Writing '%s'%s" % (outpath, ' (patched in place)' if in_place else ''))
+        editor = TapEditor(outpath)
+    if args.list or not args.operations:
+        for num in range(len(editor.blocks)):
+            print(editor.describe(num))
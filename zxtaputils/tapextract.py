@@ -1,6 +1,7 @@
 import struct
 import traceback
-from .util import compute_checksum
+from .util import compute_checksum, BT_NUM_ARRAY, BT_CHAR_ARRAY
+from .archive import open_input
 
 """
 tapextract.py - Extract the binary data from a TAP file
@@ -21,13 +22,28 @@ def read_tap_block(infile):
     data_len = struct.unpack("<H", data_bytes)[0]
     return infile.read(data_len)
 
+def write_array(header_bytes, out_bytes, args):
+    """write the contents of an array block as CSV or NumPy file"""
+    from . import arraycodec
+    block_type = header_bytes[1]
+    if block_type not in {BT_NUM_ARRAY, BT_CHAR_ARRAY}:
+        print("Error: block %d is not an array block" % args.blocknum)
+        return
+    arr = arraycodec.decode_array(block_type, out_bytes)
+    if args.outformat == 'csv':
+        arraycodec.write_csv(arr, args.outfile, block_type)
+    else:
+        import numpy as np
+        np.save(args.outfile, arr)
+
+
 def tapextract(args):
     blocknum = 0
-    with open(args.tapfile, "rb") as infile:
+    with open_input(args.tapfile) as infile:
         try:
             while True:
-                data_bytes = read_tap_block(infile)  # header
-                if data_bytes is None:
+                header_bytes = read_tap_block(infile)  # header
+                if header_bytes is None:
                     print("Error: block %d not found" % args.blocknum)
                     break
                 data_bytes = read_tap_block(infile)  # data
@@ -37,8 +53,11 @@ def tapextract(args):
                 out_bytes = read_headerless_data(data_bytes)
                 if blocknum == args.blocknum:
                     print("Extracting block %d" % blocknum)
-                    with open(args.outfile, 'wb') as outfile:
-                        outfile.write(out_bytes)
+                    if args.outformat == 'raw':
+                        with open(args.outfile, 'wb') as outfile:
+                            outfile.write(out_bytes)
+                    else:
+                        write_array(header_bytes, out_bytes, args)
                     break
                 blocknum = blocknum + 1
         except:
@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
 import struct
-from .util import BT_PROGRAM, BT_NUM_ARRAY, BT_CHAR_ARRAY, BT_BINARY, compute_checksum
+from .util import BT_PROGRAM, BT_NUM_ARRAY, BT_CHAR_ARRAY, BT_BINARY, compute_checksum, array_name_byte
 from .tapinfo import ZXHeader, ZXData
+from .compress import CompressedCode
+from . import tzx
+from . import snapshot
 
 """
 tapify.py - Put the specified file into a TAP file
@@ -23,16 +26,85 @@ def type_byte(objtype):
 
 def make_block_parameters(args, data_bytes):
     if args.objtype in ["nums", "chars"]:  # array data
-        return [args.varname[0], 0x8000]
+        return [0x00, array_name_byte(type_byte(args.objtype), args.varname), 0x8000]
     elif args.objtype == "program":
         return [args.autostart_line, len(data_bytes)]
     elif args.objtype == 'code':
         return [args.startaddr, 0x8000]
 
 
-def tapify(args):
+def read_array_file(args):
+    """CSV and NumPy files are converted into the Spectrum's array format,
+    everything else is assumed to already be in it"""
+    from . import arraycodec
+    block_type = type_byte(args.objtype)
+    if args.infile.lower().endswith('.csv'):
+        arr = arraycodec.read_csv(args.infile, block_type)
+    else:
+        import numpy as np
+        arr = np.load(args.infile)
+        if block_type == BT_CHAR_ARRAY and arr.dtype.kind in 'US':
+            arr = arraycodec.strings_to_char_array([str(s) for s in arr.ravel()])
+    return arraycodec.encode_array(block_type, arr)
+
+
+def read_data_bytes(args):
+    if args.objtype in ["nums", "chars"] and args.infile.lower().endswith(('.csv', '.npy')):
+        return read_array_file(args)
     with open(args.infile, "rb") as infile:
-        data_bytes = infile.read()
+        return infile.read()
+
+
+def turbo_timings(args):
+    return tzx.turbo_timings(zero_pulse=args.zero, one_pulse=args.one, pilot_pulses=args.pilotpulses)
+
+
+def write_tzx(args, data_bytes, tap_blocks):
+    if args.turbo:
+        if args.objtype != 'code':
+            raise ValueError("turbo blocks are only supported for code")
+        outbytes, report = tzx.turbo_tzx(args.filename, [(args.startaddr, data_bytes)],
+                                         args.execaddr, turbo_timings(args))
+        tzx.print_report(report)
+    else:
+        outbytes = tzx.standard_tzx(tap_blocks)
+    with open(args.outfile, "wb") as outfile:
+        outfile.write(outbytes)
+
+
+def write_snapshot(args, data_bytes):
+    if args.objtype == 'program':
+        snap = snapshot.Snapshot(data_bytes, args.autostart_line)
+    elif args.objtype == 'code':
+        snap = snapshot.Snapshot()
+        snap.add_code(args.startaddr, data_bytes)
+        snap.exec_addr = args.execaddr
+    else:
+        raise ValueError("only programs and code can be put into a snapshot")
+    snapshot.write_snapshot(args.outfile, snap, args.format)
+
+
+def compress_code(args, data_bytes):
+    """replace the code by its compressed form plus decompressor, returns the new data,
+    start address and the address to call after loading. Code that does not get
+    smaller is returned unchanged"""
+    if args.objtype != 'code':
+        raise ValueError("only code blocks can be compressed")
+    compressed = CompressedCode(data_bytes, args.startaddr, args.execaddr)
+    if not compressed.is_smaller:
+        print(compressed.warning())
+        return data_bytes, args.startaddr, args.execaddr
+    if args.format == 'tzx' and args.turbo:
+        print(compressed.report(data_bytes, turbo_timings(args)))
+    else:
+        print(compressed.report(data_bytes))
+    return compressed.data_bytes, compressed.start_addr, compressed.stub_addr
+
+
+def tapify(args):
+    data_bytes = read_data_bytes(args)
+    if args.compress:
+        data_bytes, args.startaddr, args.execaddr = compress_code(args, data_bytes)
     filename = args.filename
     data_size = len(data_bytes)
     parameters = make_block_parameters(args, data_bytes)
@@ -41,6 +113,15 @@ def tapify(args):
     header_bytes = zxheader.bytes()
     dblock_bytes = zxdata.bytes()
 
+    if args.format == 'tzx':
+        write_tzx(args, data_bytes, [header_bytes, dblock_bytes])
+        print("done")
+        return
+    if args.format in ('sna', 'z80'):
+        write_snapshot(args, data_bytes)
+        print("done")
+        return
+
     with open(args.outfile, "wb") as outfile:
 
         # write header (2 + 19 bytes)
@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 
+import io
 import struct
 import traceback
-from .util import BT_PROGRAM, BT_NUM_ARRAY, BT_CHAR_ARRAY, BT_BINARY, BLOCK_TYPES, compute_checksum
+from .util import BT_PROGRAM, BT_NUM_ARRAY, BT_CHAR_ARRAY, BT_BINARY, BLOCK_TYPES, compute_checksum, array_name, \
+    TapFormatError
+from .taptiming import block_timing
+from .archive import open_input, expand_paths
 
 """
 tapinfo.py - Print the block information of a TAP file for Sinclair ZX Spectrum.
@@ -58,8 +62,20 @@ def read_std_params(data_bytes):
     return param1, param2
 
 
-def zxheader_from_bytes(data_bytes):
-    """Make a ZXHeader object from the specified bytes object"""
+HEADER_LENGTH = 19
+
+
+def zxheader_from_bytes(data_bytes, strict=False):
+    """Make a ZXHeader object from the specified bytes object, in strict mode file names
+    that are not ASCII and unknown block types raise TapFormatError"""
+    if len(data_bytes) < HEADER_LENGTH:
+        raise TapFormatError("header block has %d bytes instead of %d" % (len(data_bytes), HEADER_LENGTH))
+    if strict:
+        if data_bytes[1] >= len(BLOCK_TYPES):
+            raise TapFormatError("unknown block type %d" % data_bytes[1])
+        if any(b >= 0x80 for b in data_bytes[2:12]):
+            raise TapFormatError("file name is not ASCII")
+
     # 1 byte flag byte
     flag1 = struct.unpack_from("<B", data_bytes, 0)[0]
 
@@ -101,7 +117,7 @@ class ZXHeader:
 
     def array_params_tostr(self):
         out = 'Reserved1     : "%02x"\n' % self.params[0]
-        out += 'Variable Name : "%c"\n' % self.params[1]
+        out += 'Variable Name : "%s"\n' % array_name(self.params[1])
         out += 'Reserved2     : "%04x"\n' % self.params[2]  # always $0080
         return out
 
@@ -117,7 +133,7 @@ class ZXHeader:
 
     def make_block_parameters(self):
         if self.block_type in [BT_NUM_ARRAY, BT_CHAR_ARRAY]:  # array data
-            return bytes([0x00, str.encode(self.params[1]), 0x00, 0x80])
+            return struct.pack("<BBH", self.params[0], self.params[1], self.params[2])
         elif self.block_type == BT_PROGRAM:
             asl_data = struct.pack("<H", self.params[0])
             lp_data = struct.pack("<H", self.params[1])
@@ -239,16 +255,106 @@ def next_tap_block(infile):
     return next_zxtap_block(data_bytes)
 
 
-def tapinfo(args):
+def block_pairs(infile):
+    """iterate over the header/data block pairs of a TAP file, yields (block number, header, data block),
+    the block number counts header/data pairs like tap2bas does"""
+    blocknum = 0
+    while True:
+        header_block = next_tap_block(infile)
+        if header_block is None:
+            break
+        data_block = next_tap_block(infile)
+        if data_block is None:
+            break
+        yield blocknum, header_block, data_block
+        blocknum += 1
+
+
+def program_blocks(infile):
+    """iterate over the program blocks of a TAP file, yields (block number, header, program bytes)"""
+    for blocknum, header_block, data_block in block_pairs(infile):
+        if isinstance(header_block, ZXHeader) and header_block.block_type == BT_PROGRAM:
+            prog_len = header_block.params[1]  # the variables are not part of the program
+            yield blocknum, header_block, data_block.data_bytes[1:-1][:prog_len]
+
+
+def print_tap_info(infile, timing=False):
     block_num = 0
-    with open(args.tapfile, "rb") as infile:
-        try:
-            while True:
-                data_bytes = read_tap_block(infile, block_num)
-                if data_bytes is None:
-                    break
-                read_zxtap_block(data_bytes)
-                block_num += 1
-        except:
-            traceback.print_exc()
-        print("Done.")
+    total_seconds = 0.0
+    try:
+        while True:
+            data_bytes = read_tap_block(infile, block_num)
+            if data_bytes is None:
+                break
+            read_zxtap_block(data_bytes)
+            if timing:
+                block_time = block_timing(data_bytes)
+                total_seconds += block_time.seconds
+                print(block_time)
+            block_num += 1
+    except:
+        traceback.print_exc()
+    if timing:
+        print("----------------------------------------------------------")
+        print("Total load time: %.2f s (%d blocks)" % (total_seconds, block_num))
+
+
+def print_recovered_info(infile, timing=False):
+    """like print_tap_info(), but for damaged files: the blocks the resynchronizing
+    scanner finds"""
+    from .repair import recover, GOOD, STATUS_NAMES
+    recovery = recover(infile.read())
+    total_seconds = 0.0
+    for block_num, block in enumerate(recovery.blocks):
+        print("----------------------------------------------------------")
+        print("TAP Block %02d, length: %d" % (block_num, len(block.block_bytes)), end=" ")
+        read_zxtap_block(block.block_bytes)
+        if block.status != GOOD:
+            print("Recovered     : %s (offset %d)" % (STATUS_NAMES[block.status], block.offset))
+        if timing:
+            block_time = block_timing(block.block_bytes)
+            total_seconds += block_time.seconds
+            print(block_time)
+    print("----------------------------------------------------------")
+    if timing:
+        print("Total load time: %.2f s (%d blocks)" % (total_seconds, len(recovery.blocks)))
+    print(recovery.report())
+
+
+def validated_input(infile):
+    """strict mode: the file as BytesIO, after all of its blocks were checked"""
+    from .strict import read_limited, strict_blocks
+    buf = read_limited(infile)
+    for _ in strict_blocks(io.BytesIO(buf)):
+        pass
+    return io.BytesIO(buf)
+
+
+def tapinfo(args):
+    """returns the number of files that were rejected in strict mode or have
+    overlapping blocks (--memmap)"""
+    num_invalid = 0
+    paths = list(expand_paths(args.tapfiles))
+    for path in paths:
+        if len(paths) > 1:
+            print("==========================================================")
+            print(path)
+        with open_input(path) as infile:
+            if getattr(args, 'strict', False):
+                try:
+                    infile = validated_input(infile)
+                except TapFormatError as error:
+                    print("%s: %s" % (path, error))
+                    num_invalid += 1
+                    continue
+            if getattr(args, 'memmap', False):
+                from .memmap import memmap_report
+                report, num_overlaps = memmap_report(infile)
+                print('\n'.join(report))
+                num_invalid += num_overlaps > 0
+            elif args.recover:
+                print_recovered_info(infile, args.timing)
+            else:
+                print_tap_info(infile, args.timing)
+    print("Done.")
+    return num_invalid
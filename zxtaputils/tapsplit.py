@@ -2,6 +2,7 @@
 
 import struct
 import os
+from .archive import open_input, split_path
 
 """
 tapsplit.py - Split tap file into individual blocks
@@ -18,8 +19,8 @@ def read_tap_block(infile, block_num):
 
 def tapsplit(args):
     block_num = 0
-    basename = os.path.basename(args.tapfile).replace('.tap', '')
-    with open(args.tapfile, "rb") as infile:
+    basename = os.path.basename(split_path(args.tapfile)[1] or args.tapfile).replace('.tap', '')
+    with open_input(args.tapfile) as infile:
         try:
             while True:
                 data_bytes = read_tap_block(infile, block_num)
@@ -0,0 +1,81 @@
+"""
+taptiming.py - Estimate how long a tape takes to load on a real machine
+
+Every block is saved by the ROM as ([3] in tapinfo.py):
+
+  - a pilot tone of 2168 T-state pulses, 8063 pulses for headers (flag < 128),
+    3223 pulses for data blocks
+  - two sync pulses of 667 and 735 T-states
+  - every bit of the block (flag and checksum included) as two pulses,
+    855 T-states each for a 0 bit, 1710 T-states each for a 1 bit
+  - a pause, TAP files assume 1 second after every block
+
+So the time only depends on the block length and the number of 1 bits, which
+is counted for the whole buffer at once with bytes.translate().
+"""
+
+CPU_CLOCK = 3500000  # T-states per second
+
+# number of 1 bits for every byte value
+POPCOUNT_TABLE = bytes(bin(i).count('1') for i in range(256))
+
+
+def popcount(data_bytes):
+    """the number of 1 bits in data_bytes"""
+    return sum(data_bytes.translate(POPCOUNT_TABLE))
+
+
+class PulseTimings:
+    """Pulse lengths in T-states and pause length in ms, the defaults are the ROM timings"""
+    def __init__(self, pilot_pulse=2168, header_pilot_pulses=8063, data_pilot_pulses=3223,
+                 sync1_pulse=667, sync2_pulse=735, zero_pulse=855, one_pulse=1710, pause=1000):
+        self.pilot_pulse = pilot_pulse
+        self.header_pilot_pulses = header_pilot_pulses
+        self.data_pilot_pulses = data_pilot_pulses
+        self.sync1_pulse = sync1_pulse
+        self.sync2_pulse = sync2_pulse
+        self.zero_pulse = zero_pulse
+        self.one_pulse = one_pulse
+        self.pause = pause
+
+    def pilot_pulses(self, flag):
+        return self.header_pilot_pulses if flag < 128 else self.data_pilot_pulses
+
+
+ROM_TIMINGS = PulseTimings()
+
+
+class BlockTiming:
+    """The loading time of a single TAP block"""
+    def __init__(self, num_bytes, num_ones, pilot_pulses, tstates, pause):
+        self.num_bytes = num_bytes
+        self.num_ones = num_ones
+        self.pilot_pulses = pilot_pulses
+        self.tstates = tstates  # pilot, sync and data, without the pause
+        self.pause = pause
+
+    @property
+    def num_pulses(self):
+        return self.pilot_pulses + 2 + self.num_bytes * 8 * 2
+
+    @property
+    def seconds(self):
+        return self.tstates / CPU_CLOCK + self.pause / 1000.0
+
+    def __str__(self):
+        return "Load time     : %.2f s (%d pulses, %d T-states + %d ms pause)" % (
+            self.seconds, self.num_pulses, self.tstates, self.pause)
+
+
+def block_timing(block_bytes, timings=ROM_TIMINGS):
+    """the timing of a TAP block, block_bytes includes the flag and checksum bytes"""
+    num_bits = len(block_bytes) * 8
+    num_ones = popcount(block_bytes)
+    pilot_pulses = timings.pilot_pulses(block_bytes[0]) if len(block_bytes) > 0 else 0
+    tstates = (pilot_pulses * timings.pilot_pulse + timings.sync1_pulse + timings.sync2_pulse +
+               2 * ((num_bits - num_ones) * timings.zero_pulse + num_ones * timings.one_pulse))
+    return BlockTiming(len(block_bytes), num_ones, pilot_pulses, tstates, timings.pause)
+
+
+def total_seconds(block_timings):
+    return sum(timing.seconds for timing in block_timings)
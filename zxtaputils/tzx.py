@@ -0,0 +1,311 @@
+import struct
+from .tapinfo import ZXHeader, ZXData
+from .taptiming import PulseTimings, block_timing
+from .basic_tokens import TOKENS
+from .bas2tokens import BasicInt
+from .util import BT_PROGRAM
+
+"""
+tzx.py - Write TZX files, including turbo speed blocks with a matching loader
+
+TZX is a block based tape format, every block starts with its ID byte:
+
+  - 0x10: standard speed data block:
+    2 bytes pause after block (ms), 2 bytes data length, data (flag, data, checksum)
+  - 0x11: turbo speed data block:
+    2 bytes pilot pulse, 2 bytes sync1 pulse, 2 bytes sync2 pulse,
+    2 bytes zero bit pulse, 2 bytes one bit pulse, 2 bytes pilot tone length (pulses),
+    1 byte used bits in last byte, 2 bytes pause (ms), 3 bytes data length, data
+
+All pulse lengths are in T-states of a 3.5 MHz Z80.
+
+The ROM loader can't read turbo blocks, so they are preceded by a BASIC program
+that contains the loader in a REM statement in line 1 and calls it from line 2.
+The loader is a copy of the ROM's LD-BYTES routine with its timing constants
+computed from the turbo pulse lengths.
+
+Source:
+
+[1] https://worldofspectrum.net/TZXformat.html
+[2] The Complete Spectrum ROM Disassembly, LD-BYTES at 0x0556
+"""
+
+TZX_SIGNATURE = b'ZXTape!\x1a'
+TZX_MAJOR = 1
+TZX_MINOR = 20
+
+ID_STANDARD = 0x10
+ID_TURBO = 0x11
+
+# where the loader ends up: PROG + line number (2) + length (2) + REM token (1)
+PROG = 23755
+LOADER_ORG = PROG + 5
+
+BORDCR = 23624
+SAMPLE_LOOP = 59     # T-states of one iteration of LD-SAMPLE
+BIT_OVERHEAD = 268   # T-states of a bit measurement besides the delays and samples
+WAIT_LOOP = 3328     # T-states of one LD-WAIT iteration (256 * DJNZ)
+
+
+def tzx_header():
+    return TZX_SIGNATURE + bytes([TZX_MAJOR, TZX_MINOR])
+
+
+def standard_block(block_bytes, pause=1000):
+    """block_bytes is a TAP block with flag and checksum"""
+    return bytes([ID_STANDARD]) + struct.pack('<HH', pause, len(block_bytes)) + block_bytes
+
+
+def turbo_block(block_bytes, timings):
+    """block_bytes is a TAP block with flag and checksum"""
+    length = struct.pack('<L', len(block_bytes))[:3]
+    return (bytes([ID_TURBO]) +
+            struct.pack('<HHHHHHBH', timings.pilot_pulse, timings.sync1_pulse, timings.sync2_pulse,
+                        timings.zero_pulse, timings.one_pulse, timings.data_pilot_pulses, 8,
+                        timings.pause) +
+            length + block_bytes)
+
+
+def turbo_timings(zero_pulse=427, one_pulse=855, pilot_pulse=2168, pilot_pulses=1500,
+                  sync1_pulse=667, sync2_pulse=735, pause=500):
+    return PulseTimings(pilot_pulse=pilot_pulse, header_pilot_pulses=pilot_pulses,
+                        data_pilot_pulses=pilot_pulses, sync1_pulse=sync1_pulse,
+                        sync2_pulse=sync2_pulse, zero_pulse=zero_pulse, one_pulse=one_pulse,
+                        pause=pause)
+
+
+def loader_constants(timings):
+    """Compute the counter values of the loader for the specified pulse lengths.
+    A measurement of the time t between two edges increments B about
+    (t - 32 * delay - BIT_OVERHEAD) / SAMPLE_LOOP times, the start values and
+    thresholds keep the ratios the ROM uses for the standard timings, and are the
+    ROM's values for them. WAIT is not: it is derived from the length of the data
+    pilot tone (a quarter of it) and is 524 for the standard timings, the ROM waits
+    0x415 iterations"""
+    zero, one, pilot = timings.zero_pulse, timings.one_pulse, timings.pilot_pulse
+    if zero < 250 or one < zero * 3 // 2:
+        raise ValueError("zero pulse must be at least 250 T-states and one pulse 1.5 times as long")
+    delay = max(1, min(22, (zero * 6 // 10 - 134) // 16))
+
+    def pair_count(t):
+        return (t - 32 * delay - BIT_OVERHEAD) / SAMPLE_LOOP
+
+    def edge_count(t):
+        return (t - 16 * delay - BIT_OVERHEAD / 2) / SAMPLE_LOOP
+
+    k_zero, k_one, k_pilot = pair_count(2 * zero), pair_count(2 * one), pair_count(2 * pilot)
+    k_sync, k_half = edge_count(timings.sync1_pulse), edge_count(pilot)
+    consts = {
+        'DELAY': delay,
+        'LEADER_B': 256 - round(k_pilot * 1.75),
+        'LEADER_T': 256 - round(k_pilot * 1.75) + round(k_pilot * 0.74),
+        'SYNC_B': 256 - round(k_half * 1.93),
+        'SYNC_T': 256 - round(k_half * 1.93) + round(k_sync + (k_half - k_sync) * 0.3),
+        'BIT_B0': 256 - round(k_one * 1.93),
+        'BIT_T': 256 - round(k_one * 1.93) + round((k_zero + k_one) / 2),
+        'WAIT': max(1, int(timings.data_pilot_pulses * pilot * 0.25 / WAIT_LOOP))
+    }
+    consts['BIT_B1'] = consts['BIT_B0'] + 2
+    if any(not 0 < consts[name] < 256 for name in consts if name != 'WAIT') or k_sync < 1:
+        raise ValueError("pulse lengths are out of range for the turbo loader")
+    if timings.data_pilot_pulses * pilot < consts['WAIT'] * WAIT_LOOP + 600 * pilot:
+        raise ValueError("pilot tone too short for the turbo loader")
+    return consts
+
+
+def assemble(org, source):
+    """A minimal two pass assembler: source is a list of bytes objects, label names (str)
+    and references ('jr', label) for relative jumps and ('abs', label) for 16 bit addresses"""
+    labels = {}
+    for pass_num in range(2):
+        addr = org
+        out = b''
+        for item in source:
+            if isinstance(item, str):
+                labels[item] = addr
+            elif isinstance(item, tuple):
+                kind, label = item
+                target = labels.get(label, addr)
+                if kind == 'jr':
+                    offset = target - (addr + 1)
+                    if pass_num == 1 and not -128 <= offset <= 127:
+                        raise ValueError("relative jump to %s out of range" % label)
+                    out += struct.pack('<b', max(-128, min(127, offset)))
+                    addr += 1
+                else:
+                    out += struct.pack('<H', target)
+                    addr += 2
+            else:
+                out += item
+                addr += len(item)
+    return out
+
+
+def loader_source(consts, blocks, exec_addr):
+    """The turbo loader: loads the (start, length) blocks in order, then jumps to
+    exec_addr, or returns to BASIC if exec_addr is None"""
+    c = consts
+    table = b''.join(struct.pack('<HH', length, start) for start, length in blocks) + b'\x00\x00'
+    done = [b'\x3a', struct.pack('<H', BORDCR),  # ld a,(BORDCR): restore the border
+            b'\x0f\x0f\x0f',                      # rrca x 3
+            b'\xe6\x07', b'\xd3\xfe',             # and 7 / out (0xfe),a
+            b'\xfb']                              # ei
+    if exec_addr is not None:
+        done += [b'\xc3', struct.pack('<H', exec_addr)]  # jp exec_addr
+    else:
+        done += [b'\xc9']                         # ret
+    return [
+        b'\xf3',                                  # di
+        b'\x21', ('abs', 'table'),                # ld hl,table
+        'next',
+        b'\x5e', b'\x23', b'\x56', b'\x23',       # ld e,(hl) / inc hl / ld d,(hl) / inc hl
+        b'\x7a', b'\xb3',                         # ld a,d / or e
+        b'\x28', ('jr', 'done'),                  # jr z,done
+        b'\x7e', b'\x23', b'\xe5',                # ld a,(hl) / inc hl / push hl
+        b'\x66', b'\x6f', b'\xe5', b'\xdd\xe1',   # ld h,(hl) / ld l,a / push hl / pop ix
+        b'\x3e\xff', b'\x37',                     # ld a,0xff / scf
+        b'\xcd', ('abs', 'ld_bytes'),             # call ld_bytes
+        b'\xe1', b'\x23',                         # pop hl / inc hl
+        b'\x30', ('jr', 'fail'),                  # jr nc,fail
+        b'\x18', ('jr', 'next'),                  # jr next
+        'fail',
+        b'\xfb', b'\xcf', b'\x1a',                # ei / rst 8 / defb 0x1a (R Tape loading error)
+        'done'] + done + [
+        'ld_bytes',
+        b'\x14', b'\x08', b'\x15',                # inc d / ex af,af' / dec d
+        b'\x3e\x0f', b'\xd3\xfe',                 # ld a,0x0f / out (0xfe),a
+        b'\xdb\xfe', b'\x1f',                     # in a,(0xfe) / rra
+        b'\xe6\x20', b'\xf6\x02', b'\x4f',        # and 0x20 / or 0x02 / ld c,a
+        b'\xbf',                                  # cp a
+        'ld_break',
+        b'\xc0',                                  # ret nz
+        'ld_start',
+        b'\xcd', ('abs', 'ld_edge_1'),            # call ld_edge_1
+        b'\x30', ('jr', 'ld_break'),              # jr nc,ld_break
+        b'\x21', struct.pack('<H', c['WAIT']),    # ld hl,WAIT
+        'ld_wait',
+        b'\x10\xfe',                              # djnz ld_wait
+        b'\x2b', b'\x7c', b'\xb5',                # dec hl / ld a,h / or l
+        b'\x20', ('jr', 'ld_wait'),               # jr nz,ld_wait
+        b'\xcd', ('abs', 'ld_edge_2'),            # call ld_edge_2
+        b'\x30', ('jr', 'ld_break'),              # jr nc,ld_break
+        'ld_leader',
+        b'\x06', bytes([c['LEADER_B']]),          # ld b,LEADER_B
+        b'\xcd', ('abs', 'ld_edge_2'),            # call ld_edge_2
+        b'\x30', ('jr', 'ld_break'),              # jr nc,ld_break
+        b'\x3e', bytes([c['LEADER_T']]), b'\xb8',  # ld a,LEADER_T / cp b
+        b'\x30', ('jr', 'ld_start'),              # jr nc,ld_start
+        b'\x24',                                  # inc h
+        b'\x20', ('jr', 'ld_leader'),             # jr nz,ld_leader
+        'ld_sync',
+        b'\x06', bytes([c['SYNC_B']]),            # ld b,SYNC_B
+        b'\xcd', ('abs', 'ld_edge_1'),            # call ld_edge_1
+        b'\x30', ('jr', 'ld_break'),              # jr nc,ld_break
+        b'\x78', b'\xfe', bytes([c['SYNC_T']]),   # ld a,b / cp SYNC_T
+        b'\x30', ('jr', 'ld_sync'),               # jr nc,ld_sync
+        b'\xcd', ('abs', 'ld_edge_1'),            # call ld_edge_1
+        b'\xd0',                                  # ret nc
+        b'\x79', b'\xee\x03', b'\x4f',            # ld a,c / xor 3 / ld c,a
+        b'\x26\x00',                              # ld h,0
+        b'\x06', bytes([c['BIT_B0']]),            # ld b,BIT_B0
+        b'\x18', ('jr', 'ld_marker'),             # jr ld_marker
+        'ld_loop',
+        b'\x08',                                  # ex af,af'
+        b'\x20', ('jr', 'ld_flag'),               # jr nz,ld_flag
+        b'\x30', ('jr', 'ld_verify'),             # jr nc,ld_verify
+        b'\xdd\x75\x00',                          # ld (ix+0),l
+        b'\x18', ('jr', 'ld_next'),               # jr ld_next
+        'ld_flag',
+        b'\xcb\x11', b'\xad', b'\xc0',            # rl c / xor l / ret nz
+        b'\x79', b'\x1f', b'\x4f', b'\x13',       # ld a,c / rra / ld c,a / inc de
+        b'\x18', ('jr', 'ld_dec'),                # jr ld_dec
+        'ld_verify',
+        b'\xdd\x7e\x00', b'\xad', b'\xc0',        # ld a,(ix+0) / xor l / ret nz
+        'ld_next',
+        b'\xdd\x23',                              # inc ix
+        'ld_dec',
+        b'\x1b', b'\x08',                         # dec de / ex af,af'
+        b'\x06', bytes([c['BIT_B1']]),            # ld b,BIT_B1
+        'ld_marker',
+        b'\x2e\x01',                              # ld l,1
+        'ld_8_bits',
+        b'\xcd', ('abs', 'ld_edge_2'),            # call ld_edge_2
+        b'\xd0',                                  # ret nc
+        b'\x3e', bytes([c['BIT_T']]), b'\xb8',    # ld a,BIT_T / cp b
+        b'\xcb\x15',                              # rl l
+        b'\x06', bytes([c['BIT_B0']]),            # ld b,BIT_B0
+        b'\xd2', ('abs', 'ld_8_bits'),            # jp nc,ld_8_bits
+        b'\x7c', b'\xad', b'\x67',                # ld a,h / xor l / ld h,a
+        b'\x7a', b'\xb3',                         # ld a,d / or e
+        b'\x20', ('jr', 'ld_loop'),               # jr nz,ld_loop
+        b'\x7c', b'\xfe\x01', b'\xc9',            # ld a,h / cp 1 / ret
+        'ld_edge_2',
+        b'\xcd', ('abs', 'ld_edge_1'),            # call ld_edge_1
+        b'\xd0',                                  # ret nc
+        'ld_edge_1',
+        b'\x3e', bytes([c['DELAY']]),             # ld a,DELAY
+        'ld_delay',
+        b'\x3d', b'\x20\xfd',                     # dec a / jr nz,ld_delay
+        b'\xa7',                                  # and a
+        'ld_sample',
+        b'\x04', b'\xc8',                         # inc b / ret z
+        b'\x3e\x7f', b'\xdb\xfe',                 # ld a,0x7f / in a,(0xfe)
+        b'\x1f', b'\xd0',                         # rra / ret nc
+        b'\xa9', b'\xe6\x20',                     # xor c / and 0x20
+        b'\x28', ('jr', 'ld_sample'),             # jr z,ld_sample
+        b'\x79', b'\x2f', b'\x4f',                # ld a,c / cpl / ld c,a
+        b'\xe6\x07', b'\xf6\x08', b'\xd3\xfe',    # and 7 / or 8 / out (0xfe),a
+        b'\x37', b'\xc9',                         # scf / ret
+        'table',
+        table]
+
+
+def loader_program(loader_code):
+    """the tokenized BASIC program: 1 REM <loader>, 2 RANDOMIZE USR LOADER_ORG"""
+    line1 = bytes([TOKENS['REM']]) + loader_code + b'\x0d'
+    line2 = bytes([TOKENS['RANDOMIZE'], TOKENS['USR']]) + BasicInt(LOADER_ORG).bytes() + b'\x0d'
+    return (struct.pack('>H', 1) + struct.pack('<H', len(line1)) + line1 +
+            struct.pack('>H', 2) + struct.pack('<H', len(line2)) + line2)
+
+
+def tap_pair(zxheader, data_bytes):
+    return [zxheader.bytes(), ZXData(data_bytes).bytes()]
+
+
+def standard_tzx(tap_blocks, pause=1000):
+    """convert TAP blocks (with flag and checksum) to a TZX file with standard speed blocks"""
+    return tzx_header() + b''.join(standard_block(block, pause) for block in tap_blocks)
+
+
+def turbo_tzx(name, blocks, exec_addr, timings):
+    """Make a TZX file loading the (start address, data bytes) blocks at turbo speed.
+    Returns the TZX bytes and a list of (description, standard seconds, turbo seconds)"""
+    consts = loader_constants(timings)
+    source = loader_source(consts, [(start, len(data)) for start, data in blocks], exec_addr)
+    program = loader_program(assemble(LOADER_ORG, source))
+    header = ZXHeader(BT_PROGRAM, name, len(program), [1, len(program)])
+    loader_blocks = tap_pair(header, program)
+
+    out = tzx_header() + b''.join(standard_block(block) for block in loader_blocks)
+    report = [('loader', block_timing(loader_blocks[0]).seconds + block_timing(loader_blocks[1]).seconds,
+               None)]
+    for start, data in blocks:
+        block = ZXData(data).bytes()
+        out += turbo_block(block, timings)
+        # loaded with ROM speed, the block would need a header
+        standard = block_timing(ZXHeader(3, name, len(data), [start, 0x8000]).bytes()).seconds + \
+            block_timing(block).seconds
+        report.append(('CODE %d,%d' % (start, len(data)), standard, block_timing(block, timings).seconds))
+    return out, report
+
+
+def print_report(report):
+    saved = 0.0
+    for description, standard, turbo in report:
+        if turbo is None:
+            print("%-20s %6.2f s" % (description, standard))
+        else:
+            print("%-20s %6.2f s (standard speed: %6.2f s, saved %6.2f s)" % (
+                description, turbo, standard, standard - turbo))
+            saved += standard - turbo
+    print("Total saved: %.2f s" % saved)
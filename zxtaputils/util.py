@@ -9,9 +9,47 @@ BT_BINARY     = 3
 BLOCK_TYPES = ['Program', 'Number array', 'Character array', 'Code']
 
 
+class TapFormatError(ValueError):
+    """A TAP file or program that can't be parsed, with the position of the problem"""
+
+    def __init__(self, message, offset=None, block=None):
+        super().__init__(message)
+        self.message = message
+        self.offset = offset  # in the file (or program)
+        self.block = block  # number of the block
+
+    def as_dict(self):
+        return {'error': self.message, 'offset': self.offset, 'block': self.block}
+
+    def __str__(self):
+        where = []
+        if self.block is not None:
+            where.append('block %d' % self.block)
+        if self.offset is not None:
+            where.append('offset %d' % self.offset)
+        return '%s: %s' % (', '.join(where), self.message) if where else self.message
+
+
 def compute_checksum(in_bytes, start_value=0):
     csum = start_value
     for i, b in enumerate(in_bytes):
         csum = csum^(b&0xff)
     return csum
 
+
+
+def array_name_byte(block_type, varname):
+    """the name byte of an array in a header: bit 7 set, bit 6 set for character arrays,
+    bits 0-4 are the letter"""
+    name = varname[:-1] if block_type == BT_CHAR_ARRAY and varname.endswith('$') else varname
+    if len(name) != 1 or not ('a' <= name.lower() <= 'z'):
+        raise ValueError("the name of an array must be a single letter, not '%s'" % varname)
+    letter = ord(name.lower()) - 0x60
+    if block_type == BT_CHAR_ARRAY:
+        return 0xc0 | letter
+    return 0x80 | letter
+
+
+def array_name(name_byte):
+    """the letter of an array from its header name byte"""
+    return chr((name_byte & 0x1f) + 0x60)
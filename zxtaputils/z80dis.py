@@ -0,0 +1,339 @@
+from .tapinfo import ZXHeader, block_pairs
+from .util import BT_BINARY
+from .archive import input_files
+
+"""
+z80dis.py - Disassemble the code blocks of TAP files
+
+The opcode tables for all pages (base, CB, ED, DD/FD and DDCB/FDCB) are generated
+once from the structure of the opcodes (http://www.z80.info/decoding.htm):
+
+  x = bits 7-6, y = bits 5-3, z = bits 2-0, p = bits 5-4, q = bit 3
+
+Every entry is (text, operands, flow, target), operands describes the bytes after
+the opcode:
+
+  ''   none
+  'n'  8 bit value
+  'nn' 16 bit value, little endian
+  'e'  relative jump offset
+  'd'  IX/IY displacement
+  'dn' displacement and 8 bit value
+
+Decoding an instruction is a lookup in the table of its page, the DD/FD tables are
+generated from the base table with HL replaced by IX/IY, H and L by IXH/IXL... and
+(HL) by (IX+d).
+
+In recursive mode, only the code reachable from the entry points (following jumps,
+calls, RST and conditional returns) is disassembled, everything else is listed as
+data.
+"""
+
+CONTINUE, JUMP, BRANCH, STOP = range(4)  # STOP: RET, JP (HL)... don't continue
+
+R = ['b', 'c', 'd', 'e', 'h', 'l', '(hl)', 'a']
+CC = ['nz', 'z', 'nc', 'c', 'po', 'pe', 'p', 'm']
+ALU = ['add a,', 'adc a,', 'sub ', 'sbc a,', 'and ', 'xor ', 'or ', 'cp ']
+ROT = ['rlc', 'rrc', 'rl', 'rr', 'sla', 'sra', 'sll', 'srl']
+IM = ['0', '0', '1', '2', '0', '0', '1', '2']
+BLOCK = [['ldi', 'cpi', 'ini', 'outi'], ['ldd', 'cpd', 'ind', 'outd'],
+         ['ldir', 'cpir', 'inir', 'otir'], ['lddr', 'cpdr', 'indr', 'otdr']]
+OPERAND_SIZES = {'': 0, 'n': 1, 'nn': 2, 'e': 1, 'd': 1, 'dn': 2}
+LABEL_FLOWS = (JUMP, BRANCH)
+DB_BYTES = 8  # data bytes per line
+
+
+def base_entry(opcode, hl, r):
+    """the entry of an unprefixed opcode, hl and r are the register names, which differ
+    for the DD/FD pages"""
+    x, y, z = opcode >> 6, (opcode >> 3) & 7, opcode & 7
+    p, q = y >> 1, y & 1
+    rp = ['bc', 'de', hl, 'sp']
+    rp2 = ['bc', 'de', hl, 'af']
+    if x == 0:
+        if z == 0:
+            return [('nop', ''), ("ex af,af'", ''), ('djnz %s', 'e', BRANCH), ('jr %s', 'e', JUMP),
+                    ('jr %s,%%s' % CC[y - 4], 'e', BRANCH)][min(y, 4)]
+        if z == 1:
+            return ('ld %s,%%s' % rp[p], 'nn') if q == 0 else ('add %s,%s' % (hl, rp[p]), '')
+        if z == 2:
+            return [[('ld (bc),a', ''), ('ld (de),a', ''), ('ld (%%s),%s' % hl, 'nn'), ('ld (%s),a', 'nn')],
+                    [('ld a,(bc)', ''), ('ld a,(de)', ''), ('ld %s,(%%s)' % hl, 'nn'), ('ld a,(%s)', 'nn')]][q][p]
+        if z == 3:
+            return ('%s %s' % (['inc', 'dec'][q], rp[p]), '')
+        if z == 4:
+            return ('inc %s' % r[y], '')
+        if z == 5:
+            return ('dec %s' % r[y], '')
+        if z == 6:
+            return ('ld %s,%%s' % r[y], 'n')
+        return (['rlca', 'rrca', 'rla', 'rra', 'daa', 'cpl', 'scf', 'ccf'][y], '')
+    if x == 1:
+        if y == 6 and z == 6:
+            return ('halt', '')
+        if y == 6 or z == 6:  # ld h,(ix+d) uses the real H
+            return ('ld %s,%s' % (R[y] if z == 6 else r[y], R[z] if y == 6 else r[z]), '')
+        return ('ld %s,%s' % (r[y], r[z]), '')
+    if x == 2:
+        return (ALU[y] + r[z], '')
+    if z == 0:
+        return ('ret %s' % CC[y], '')
+    if z == 1:
+        if q == 0:
+            return ('pop %s' % rp2[p], '')
+        return [('ret', '', STOP), ('exx', ''), ('jp (%s)' % hl, '', STOP), ('ld sp,%s' % hl, '')][p]
+    if z == 2:
+        return ('jp %s,%%s' % CC[y], 'nn', BRANCH)
+    if z == 3:
+        return [('jp %s', 'nn', JUMP), ('prefix cb', ''), ('out (%s),a', 'n'), ('in a,(%s)', 'n'),
+                ('ex (sp),%s' % hl, ''), ('ex de,hl', ''), ('di', ''), ('ei', '')][y]
+    if z == 4:
+        return ('call %s,%%s' % CC[y], 'nn', BRANCH)
+    if z == 5:
+        if q == 0:
+            return ('push %s' % rp2[p], '')
+        return [('call %s', 'nn', BRANCH), ('prefix dd', ''), ('prefix ed', ''), ('prefix fd', '')][p]
+    if z == 6:
+        return (ALU[y] + '%s', 'n')
+    return ('rst $%02x' % (y * 8), '', BRANCH, y * 8)
+
+
+def cb_entry(opcode, mem='(hl)'):
+    x, y, z = opcode >> 6, (opcode >> 3) & 7, opcode & 7
+    if mem == '(hl)':  # regular CB page
+        operand, operands = R[z], ''
+    else:  # DDCB/FDCB: always (ix+d), undocumented: also copied to a register
+        operand, operands = mem if z == 6 or x == 1 else mem + ',' + R[z], 'd'
+    if x == 0:
+        return ('%s %s' % (ROT[y], operand), operands)
+    return ('%s %d,%s' % (['bit', 'res', 'set'][x - 1], y, operand), operands)
+
+
+def ed_entry(opcode):
+    x, y, z = opcode >> 6, (opcode >> 3) & 7, opcode & 7
+    p, q = y >> 1, y & 1
+    rp = ['bc', 'de', 'hl', 'sp']
+    if x == 1:
+        if z == 0:
+            return ('in (c)' if y == 6 else 'in %s,(c)' % R[y], '')
+        if z == 1:
+            return ('out (c),0' if y == 6 else 'out (c),%s' % R[y], '')
+        if z == 2:
+            return ('%s hl,%s' % (['sbc', 'adc'][q], rp[p]), '')
+        if z == 3:
+            return ('ld (%%s),%s' % rp[p], 'nn') if q == 0 else ('ld %s,(%%s)' % rp[p], 'nn')
+        if z == 4:
+            return ('neg', '')
+        if z == 5:
+            return ('reti' if y == 1 else 'retn', '', STOP)
+        if z == 6:
+            return ('im %s' % IM[y], '')
+        return (['ld i,a', 'ld r,a', 'ld a,i', 'ld a,r', 'rrd', 'rld', 'nop', 'nop'][y], '')
+    if x == 2 and z <= 3 and y >= 4:
+        return (BLOCK[y - 4][z], '')
+    return ('db $ed,$%02x' % opcode, '')
+
+
+def make_entry(entry):
+    """(text, operands, flow, target) with defaults"""
+    text, operands = entry[0], entry[1]
+    flow = entry[2] if len(entry) > 2 else CONTINUE
+    target = entry[3] if len(entry) > 3 else None
+    return (text, operands, flow, target)
+
+
+def index_page(ix):
+    """the DD or FD page, ix is 'ix' or 'iy'"""
+    r = ['b', 'c', 'd', 'e', ix + 'h', ix + 'l', '(' + ix + '%s)', 'a']
+    page = []
+    for opcode in range(256):
+        text, operands, flow, target = make_entry(base_entry(opcode, ix, r))
+        if '(' + ix + '%s)' in text:  # the displacement comes first
+            operands = 'd' + operands
+        page.append((text, operands, flow, target))
+    return page
+
+
+BASE_PAGE = [make_entry(base_entry(opcode, 'hl', R)) for opcode in range(256)]
+CB_PAGE = [make_entry(cb_entry(opcode)) for opcode in range(256)]
+ED_PAGE = [make_entry(ed_entry(opcode)) for opcode in range(256)]
+INDEX_PAGES = {0xdd: index_page('ix'), 0xfd: index_page('iy')}
+INDEX_CB_PAGES = {0xdd: [make_entry(cb_entry(opcode, '(ix%s)')) for opcode in range(256)],
+                  0xfd: [make_entry(cb_entry(opcode, '(iy%s)')) for opcode in range(256)]}
+
+
+def signed(b):
+    return (b ^ 0x80) - 0x80
+
+
+def decode(code, pos):
+    """decode the instruction at code[pos], returns (entry, opcode length, operands position),
+    entry is None if the bytes don't form an instruction (a prefix followed by another prefix)"""
+    op = code[pos]
+    if op == 0xcb:
+        return CB_PAGE[code[pos + 1]], 2, pos + 2
+    if op == 0xed:
+        return ED_PAGE[code[pos + 1]], 2, pos + 2
+    if op == 0xdd or op == 0xfd:
+        op2 = code[pos + 1]
+        if op2 == 0xcb:  # DD CB d opcode
+            return INDEX_CB_PAGES[op][code[pos + 3]], 3, pos + 2
+        if op2 == 0xdd or op2 == 0xfd or op2 == 0xed:
+            return None, 1, pos + 1
+        return INDEX_PAGES[op][op2], 2, pos + 2
+    return BASE_PAGE[op], 1, pos + 1
+
+
+class Instruction:
+    def __init__(self, addr, length, text, operands, values, flow, target):
+        self.addr = addr
+        self.length = length
+        self.text = text
+        self.operands = operands
+        self.values = values
+        self.flow = flow
+        self.target = target
+
+    def format(self, labels=None):
+        if self.operands == '':
+            return self.text
+        args = []
+        for kind, value in zip(self.operands.replace('nn', 'w'), self.values):
+            if kind == 'd':
+                args.append('%s$%02x' % ('-' if value < 0 else '+', abs(value)))
+            elif kind == 'n':
+                args.append('$%02x' % value)
+            elif labels is not None and value in labels and self.flow in LABEL_FLOWS:
+                args.append(labels[value])
+            else:
+                args.append('$%04x' % value)
+        return self.text % tuple(args)
+
+
+def instruction_at(code, pos, org):
+    """the Instruction at code[pos], None if it is not an instruction or not complete"""
+    entry, oplen, operand_pos = decode(code, pos)
+    if entry is None:
+        return None
+    text, operands, flow, target = entry
+    length = oplen + OPERAND_SIZES[operands]
+    if pos + length > len(code) - 4:  # code is padded with 4 bytes
+        return None
+    addr = org + pos
+    if operands == '':
+        values = ()
+    elif operands == 'n':
+        values = (code[operand_pos],)
+    elif operands == 'nn':
+        values = (code[operand_pos] | (code[operand_pos + 1] << 8),)
+        if flow in LABEL_FLOWS:
+            target = values[0]
+    elif operands == 'e':
+        target = (addr + length + signed(code[operand_pos])) & 0xffff
+        values = (target,)
+    elif operands == 'd':
+        values = (signed(code[operand_pos]),)
+    else:  # 'dn'
+        values = (signed(code[operand_pos]), code[operand_pos + 1])
+    return Instruction(addr, length, text, operands, values, flow, target)
+
+
+def trace_code(code, org, entries):
+    """recursive descent from the entry addresses, returns the dict of instructions
+    by position"""
+    instructions = {}
+    end = len(code) - 4
+    pending = [addr - org for addr in entries]
+    while pending:
+        pos = pending.pop()
+        while 0 <= pos < end and pos not in instructions:
+            instruction = instruction_at(code, pos, org)
+            if instruction is None:
+                break
+            instructions[pos] = instruction
+            if instruction.target is not None:
+                pending.append(instruction.target - org)
+            if instruction.flow == JUMP or instruction.flow == STOP:
+                break
+            pos += instruction.length
+    return instructions
+
+
+def linear_code(code, org):
+    instructions = {}
+    end = len(code) - 4
+    pos = 0
+    while pos < end:
+        instruction = instruction_at(code, pos, org)
+        if instruction is None:
+            pos += 1
+        else:
+            instructions[pos] = instruction
+            pos += instruction.length
+    return instructions
+
+
+def hex_bytes(data_bytes):
+    return ' '.join('%02x' % b for b in data_bytes)
+
+
+def disassemble(code, org, entries=None, use_labels=True):
+    """disassemble code loaded at org, linear or recursive if entry addresses are
+    specified, returns the list of lines"""
+    code = bytes(code) + bytes(4)  # padding: no bounds checks while decoding
+    end = len(code) - 4
+    if entries is None:
+        instructions = linear_code(code, org)
+    else:
+        instructions = trace_code(code, org, entries)
+
+    labels = None
+    if use_labels:
+        # only targets that are the start of an instruction get a label
+        labels = {instruction.target: 'L%04X' % instruction.target
+                  for instruction in instructions.values()
+                  if instruction.target is not None and instruction.target - org in instructions}
+    lines = []
+    pos = 0
+    while pos < end:
+        addr = org + pos
+        if labels is not None and addr in labels:
+            lines.append(labels[addr] + ':')
+        instruction = instructions.get(pos)
+        if instruction is not None:
+            lines.append('%04x  %-12s  %s' % (addr, hex_bytes(code[pos:pos + instruction.length]),
+                                             instruction.format(labels)))
+            pos += instruction.length
+        else:
+            data_end = pos + 1
+            while data_end < end and data_end - pos < DB_BYTES and data_end not in instructions and \
+                  (labels is None or org + data_end not in labels):
+                data_end += 1
+            data = code[pos:data_end]
+            lines.append('%04x  %-12s  db %s' % (addr, hex_bytes(data[:4]) + ('..' if len(data) > 4 else ''),
+                                                ','.join('$%02x' % b for b in data)))
+            pos = data_end
+    return lines
+
+
+def code_blocks(infile):
+    """yields (block number, header, code bytes) of the code blocks of a TAP file"""
+    for blocknum, header_block, data_block in block_pairs(infile):
+        if isinstance(header_block, ZXHeader) and header_block.block_type == BT_BINARY:
+            yield blocknum, header_block, data_block.data_bytes[1:-1]
+
+
+def tapdis(args):
+    for path, infile in input_files(args.tapfiles):
+        for blocknum, header, code in code_blocks(infile):
+            if args.block is not None and blocknum != args.block:
+                continue
+            org = header.params[0]
+            entries = None
+            if args.recursive:
+                entries = args.entry if args.entry else [org]
+            lines = disassemble(code, org, entries, not args.nolabels)
+            print('; %s, block %d ("%s"), %d bytes at $%04x' % (path, blocknum, header.file_name.rstrip(),
+                                                                 len(code), org))
+            print('\n'.join(lines))
+            print()